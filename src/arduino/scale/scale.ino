@@ -237,6 +237,54 @@ void post_status(String post_data) {
   Serial.println(response);
 }
 
+/// @function post_status_binary
+/// Sends one weight reading using the server's compact binary format (Content-Type application/x-keg-readings).
+/// The session token and device ID are the 16 raw bytes of their UUIDs. Layout, little-endian:
+/// "KEG1", frame kind (1 = weight), session token, then per reading: device ID, time (double), weight (float).
+void post_status_binary(const uint8_t* session_token, const uint8_t* device_id, double reading_time, float weight) {
+
+  // Make sure we were given a server to connect to.
+  if (strlen(STATUS_URL) == 0) {
+    Serial.println("[ERROR] Status server not specified!");
+    return;
+  }
+
+  // Build the request body.
+  uint8_t body[4 + 1 + 16 + 16 + sizeof(double) + sizeof(float)];
+  size_t offset = 0;
+  memcpy(body + offset, "KEG1", 4);
+  offset += 4;
+  body[offset++] = 1;
+  memcpy(body + offset, session_token, 16);
+  offset += 16;
+  memcpy(body + offset, device_id, 16);
+  offset += 16;
+  memcpy(body + offset, &reading_time, sizeof(double));
+  offset += sizeof(double);
+  memcpy(body + offset, &weight, sizeof(float));
+  offset += sizeof(float);
+
+  // Connect to the status server.
+  Serial.println("[INFO] Sending status...");
+  HttpClient client = HttpClient(g_wifi_client, STATUS_URL, STATUS_PORT);
+
+  // Set headers.
+  client.beginRequest();
+  client.post(STATUS_ENDPOINT);
+  client.sendHeader("Content-Type", "application/x-keg-readings");
+  client.sendHeader("Content-Length", offset);
+  client.beginBody();
+  client.write(body, offset);
+  client.endRequest();
+
+  // Get response.
+  int status_code = client.responseStatusCode();
+
+  // Print the response.
+  Serial.print("[INFO] Http Status Code: ");
+  Serial.println(status_code);
+}
+
 /// @function setup_scale
 /// Called once to initializae all of the HX711s.
 void setup_scale(void) {
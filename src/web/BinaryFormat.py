@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""Compact binary format for uploading readings from the scale firmware.
+
+A request body is a header followed by any number of fixed size frames, all little-endian:
+
+    header:        4s  magic (b"KEG1")
+                   B   frame kind (FRAME_KIND_WEIGHT or FRAME_KIND_RAW)
+                   16s session token, as UUID bytes
+    weight frame:  16s device ID, as UUID bytes
+                   d   reading time, seconds since the epoch
+                   f   weight, in grams
+    raw frame:     16s device ID, as UUID bytes
+                   d   reading time, seconds since the epoch
+                   4i  the four raw HX711 values
+
+Raw frames carry uncalibrated HX711 counts, which can't be stored alongside weights in grams, so decode
+rejects them until the server can calibrate them per device. The body is decoded in place with struct.iter_unpack
+over a memoryview, so no per-reading copies of the request are made.
+"""
+
+import math
+import struct
+import uuid
+
+CONTENT_TYPE = "application/x-keg-readings"
+MAGIC = b"KEG1"
+FRAME_KIND_WEIGHT = 1
+FRAME_KIND_RAW = 2
+
+HEADER = struct.Struct("<4sB16s")
+WEIGHT_FRAME = struct.Struct("<16sdf")
+RAW_FRAME = struct.Struct("<16sd4i")
+
+class BinaryFormatException(Exception):
+    """Exception thrown when a binary request body can't be decoded."""
+
+    def __init__(self, message):
+        self.message = message
+        Exception.__init__(self, message)
+
+def encode(session_token, readings, kind=FRAME_KIND_WEIGHT):
+    """Encodes a list of (device_id, value, reading_time) tuples, where value is a weight or, for raw frames, a tuple of four
+    raw values. Used by tests and tools, the firmware builds the same layout in C."""
+    parts = [ HEADER.pack(MAGIC, kind, uuid.UUID(session_token).bytes) ]
+    for device_id, value, reading_time in readings:
+        if kind == FRAME_KIND_RAW:
+            parts.append(RAW_FRAME.pack(uuid.UUID(device_id).bytes, reading_time, *value))
+        else:
+            parts.append(WEIGHT_FRAME.pack(uuid.UUID(device_id).bytes, reading_time, value))
+    return b"".join(parts)
+
+def decode(data):
+    """Decodes a request body. Returns the session token and a list of (device_id, reading, reading_time) tuples."""
+    view = memoryview(data)
+    if len(view) < HEADER.size:
+        raise BinaryFormatException("Request is too short.")
+    magic, kind, token_bytes = HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise BinaryFormatException("Unknown format.")
+    if kind == FRAME_KIND_RAW:
+        raise BinaryFormatException("Raw frames are not accepted, send calibrated weights.")
+    if kind != FRAME_KIND_WEIGHT:
+        raise BinaryFormatException("Unknown frame kind.")
+    frame = WEIGHT_FRAME
+
+    frames = view[HEADER.size:]
+    if len(frames) % frame.size != 0:
+        raise BinaryFormatException("Request is not a whole number of frames.")
+
+    # A request almost always carries a single device, so only convert each distinct ID once.
+    device_ids = {}
+    readings = []
+    for device_bytes, reading_time, weight in frame.iter_unpack(frames):
+        device_id = device_ids.get(device_bytes)
+        if device_id is None:
+            device_id = device_ids[device_bytes] = str(uuid.UUID(bytes=device_bytes))
+        readings.append((device_id, weight, reading_time))
+    for _, reading, reading_time in readings:
+        if not math.isfinite(reading) or not math.isfinite(reading_time):
+            raise BinaryFormatException("Reading is not a finite number.")
+    return str(uuid.UUID(bytes=token_bytes)), readings
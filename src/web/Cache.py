@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Small in-process caches."""
+
+import collections
+import threading
+import time
+
+class TtlLruCache(object):
+    """Thread safe, size bounded cache. Entries expire after a time-to-live and, when the cache is full,
+    the least recently used entry is evicted."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict() # key -> (expires_at, value)
+        self.lock = threading.Lock()
+        self.generation_count = 0 # Bumped by every invalidation, see put
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Returns the cached value, or None if it is absent or has expired."""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if now >= expires_at:
+                del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def generation(self):
+        """Returns a stamp to pass to put, taken before looking up the value to be cached."""
+        with self.lock:
+            return self.generation_count
+
+    def put(self, key, value, ttl=None, generation=None):
+        """Adds or replaces a value. The optional ttl can shorten, but not lengthen, the cache's own time-to-live.
+        If a generation is given, the value is dropped if anything was invalidated after the stamp was taken, since the
+        value may have been looked up before the invalidation and would otherwise put back what it removed."""
+        if ttl is None or ttl > self.ttl:
+            ttl = self.ttl
+        if ttl <= 0:
+            return
+        with self.lock:
+            if generation is not None and generation != self.generation_count:
+                return
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Removes a single entry."""
+        with self.lock:
+            self.generation_count += 1
+            if self.entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        """Removes every entry."""
+        with self.lock:
+            self.generation_count += 1
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+
+    def stats(self):
+        """Returns a dictionary of the cache's counters."""
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""Cold storage for old readings, in compressed files on local disk.
+
+Readings older than a few months are rarely read, but they keep the readings table (or the status
+collection) and its index large. The archive job moves them out of the database into two files per
+device:
+- <device_id>.seg holds zlib compressed segments, one per day of readings, each the day's times
+  followed by its weights as little endian doubles. Segments are only ever appended.
+- <device_id>.idx holds one fixed size record per segment: the first and last reading time, the
+  segment's offset and length in the .seg file, and the number of readings in it. A year of readings
+  is a few kilobytes of index, which is memory-mapped and scanned to find the segments that overlap
+  a time range, so a range query only decompresses the days it asks for.
+
+The job reads a device's readings a batch at a time, writes and syncs the batch's segments, then their
+index records, and only then deletes the readings from the database, up to the last one it wrote. A
+reading is therefore always in at least one place, and one that is in both (such as after the job is
+interrupted and run again) is only returned once, since cold and hot readings are merged by time.
+"""
+
+import fcntl
+import heapq
+import mmap
+import os
+import struct
+import zlib
+
+DEFAULT_SEGMENT_SECS = 86400 # Readings per segment, the archive cutoff is rounded down to a multiple of this
+ARCHIVE_BATCH_SIZE = 100000 # Readings read from the database, archived and deleted at a time
+INDEX_RECORD = struct.Struct("<ddQII") # first_time, last_time, offset, length, count
+SEGMENT_EXTENSION = ".seg"
+INDEX_EXTENSION = ".idx"
+LOCK_FILE_NAME = "archive.lock"
+COMPRESSION_LEVEL = 9 # Segments are written once and read rarely
+
+# Keys used in the readings handed back to the caller.
+READING_KEY = "reading"
+READING_TIME_KEY = "reading_time"
+
+def encode_segment(readings):
+    """Returns the compressed form of a list of (reading_time, reading) pairs."""
+    count = len(readings)
+    times = struct.pack("<%ud" % count, *(reading_time for reading_time, _ in readings))
+    weights = struct.pack("<%ud" % count, *(reading for _, reading in readings))
+    return zlib.compress(times + weights, COMPRESSION_LEVEL)
+
+def decode_segment(data, count):
+    """Returns the times and weights from a compressed segment of count readings."""
+    values = struct.unpack("<%ud" % (2 * count), zlib.decompress(data))
+    return values[:count], values[count:]
+
+def merge(cold, hot):
+    """Merges two iterables of readings that are each in time order, yielding one reading per time."""
+    last_time = None
+    for reading in heapq.merge(cold, hot, key=lambda reading: reading[READING_TIME_KEY]):
+        reading_time = reading[READING_TIME_KEY]
+        if reading_time != last_time:
+            last_time = reading_time
+            yield reading
+
+class ColdStore(object):
+    """Per-device segment and index files in one directory."""
+
+    def __init__(self, directory, segment_secs=DEFAULT_SEGMENT_SECS):
+        self.directory = directory
+        self.segment_secs = segment_secs
+
+    def path(self, device_id, extension):
+        """Returns the path of one of the device's files."""
+        if os.path.basename(device_id) != device_id or device_id.startswith("."):
+            raise ValueError("Invalid device ID: " + device_id)
+        return os.path.join(self.directory, device_id + extension)
+
+    def find_segments(self, device_id, start_time=None, end_time=None):
+        """Returns the index records of the device's segments that overlap [start_time, end_time], in time order."""
+        try:
+            index_file = open(self.path(device_id, INDEX_EXTENSION), "rb")
+        except FileNotFoundError:
+            return []
+        with index_file:
+            # Only whole records, in case the archive job is appending one right now.
+            size = os.fstat(index_file.fileno()).st_size
+            size -= size % INDEX_RECORD.size
+            if size == 0:
+                return []
+            with mmap.mmap(index_file.fileno(), size, access=mmap.ACCESS_READ) as index:
+                records = []
+                for record in INDEX_RECORD.iter_unpack(index):
+                    first_time, last_time = record[0], record[1]
+                    if (start_time is None or last_time >= start_time) and (end_time is None or first_time <= end_time):
+                        records.append(record)
+        records.sort()
+        return records
+
+    def iter_segment(self, segment_file, record, start_time, end_time):
+        """Yields the readings of one segment that are within [start_time, end_time]. The segment is read and decoded on the
+        first call to next(), all at once, so several of these can share the file."""
+        _, _, offset, length, count = record
+        segment_file.seek(offset)
+        times, weights = decode_segment(segment_file.read(length), count)
+        for reading_time, reading in zip(times, weights):
+            if start_time is not None and reading_time < start_time:
+                continue
+            if end_time is not None and reading_time > end_time:
+                break
+            yield { READING_TIME_KEY: reading_time, READING_KEY: reading }
+
+    def iter_readings(self, device_id, start_time=None, end_time=None):
+        """Yields the device's archived readings, in time order, optionally restricted to [start_time, end_time]."""
+        records = self.find_segments(device_id, start_time, end_time)
+        if len(records) == 0:
+            return
+        with open(self.path(device_id, SEGMENT_EXTENSION), "rb") as segment_file:
+            # Segments only overlap if readings arrived late, after their day was archived. Each run of overlapping segments
+            # is merged, and the runs are read one after the other, so only one run is decoded at a time.
+            run = []
+            run_end = None
+            for record in records:
+                if len(run) > 0 and record[0] > run_end:
+                    yield from self.iter_run(segment_file, run, start_time, end_time)
+                    run = []
+                run_end = record[1] if len(run) == 0 else max(run_end, record[1])
+                run.append(record)
+            yield from self.iter_run(segment_file, run, start_time, end_time)
+
+    def iter_run(self, segment_file, records, start_time, end_time):
+        """Yields the readings of a run of overlapping segments, in time order."""
+        if len(records) == 1:
+            yield from self.iter_segment(segment_file, records[0], start_time, end_time)
+        else:
+            segments = [ self.iter_segment(segment_file, record, start_time, end_time) for record in records ]
+            yield from heapq.merge(*segments, key=lambda reading: reading[READING_TIME_KEY])
+
+    def retrieve_readings(self, device_id, start_time=None, end_time=None):
+        """Returns the device's archived readings as a list, in time order."""
+        return list(self.iter_readings(device_id, start_time, end_time))
+
+    def append(self, device_id, readings):
+        """Archives a list of (reading_time, reading) pairs, in time order, as one segment per segment_secs. Returns once
+        the segments and their index records are on disk."""
+        segments = []
+        for reading_time, reading in readings:
+            start = int(reading_time // self.segment_secs)
+            if len(segments) == 0 or segments[-1][0] != start:
+                segments.append((start, []))
+            segments[-1][1].append((reading_time, reading))
+        if len(segments) == 0:
+            return
+
+        records = []
+        with open(self.path(device_id, SEGMENT_EXTENSION), "ab") as segment_file:
+            offset = segment_file.tell()
+            for _, segment in segments:
+                data = encode_segment(segment)
+                segment_file.write(data)
+                records.append(INDEX_RECORD.pack(segment[0][0], segment[-1][0], offset, len(data), len(segment)))
+                offset += len(data)
+            segment_file.flush()
+            os.fsync(segment_file.fileno())
+
+        # The index only points at segments that are already on disk.
+        with open(self.path(device_id, INDEX_EXTENSION), "ab") as index_file:
+            index_file.write(b"".join(records))
+            index_file.flush()
+            os.fsync(index_file.fileno())
+
+    def archive(self, database, cutoff_time, log=None):
+        """Moves each device's readings from before cutoff_time, rounded down to a segment boundary, from the database
+        into cold storage. The database should not have a cold store of its own. Returns the number of readings moved.
+        Raises if a read, write or delete fails, leaving every reading in the database, the archive or both."""
+        cutoff_time = int(cutoff_time // self.segment_secs) * self.segment_secs
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Only one archive job at a time.
+        with open(os.path.join(self.directory, LOCK_FILE_NAME), "w") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+            total = 0
+            for device_id in database.retrieve_device_ids():
+                count = 0
+                after_time = None
+                while True:
+                    readings = database.scan_readings(device_id, after_time, cutoff_time, ARCHIVE_BATCH_SIZE)
+                    if len(readings) == 0:
+                        break
+                    self.append(device_id, readings)
+
+                    # Only what was just written is deleted.
+                    after_time = readings[-1][0]
+                    if not database.delete_readings(device_id, after_time):
+                        raise Exception("Could not delete the archived readings of " + device_id)
+                    count += len(readings)
+                if count > 0 and log is not None:
+                    log("Archived %u readings of %s." % (count, device_id))
+                total += count
+            return total
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""gzip and deflate content encoding for streamed API responses.
+
+Chunks are compressed as they are produced, so a streamed response stays streamed. The compressed bytes
+can also be handed to a callback once the stream is complete, so that a response for a series that has
+not changed can be sent again without being queried, encoded or compressed.
+"""
+
+import zlib
+
+ENCODING_GZIP = "gzip"
+ENCODING_DEFLATE = "deflate"
+ENCODINGS = (ENCODING_GZIP, ENCODING_DEFLATE) # In order of preference
+COMPRESS_LEVEL = 6 # zlib's default, most of the gain for a fraction of the time of level 9
+GZIP_WBITS = 16 + zlib.MAX_WBITS # Adds the gzip header and trailer
+DEFLATE_WBITS = zlib.MAX_WBITS # HTTP's "deflate" is the zlib format, not raw deflate
+
+def compress_stream(chunks, encoding, on_complete=None, max_keep_bytes=1 << 20):
+    """Yields the compressed form of a stream of str or bytes chunks. If on_complete is given, it is called with the whole
+    compressed body once every chunk has been compressed, unless the body grew larger than max_keep_bytes. It is not
+    called if the chunks raise or the stream is closed before the end, so a cut off body is never kept."""
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, GZIP_WBITS if encoding == ENCODING_GZIP else DEFLATE_WBITS)
+    kept = [] if on_complete is not None else None
+    kept_bytes = 0
+    complete = False
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk)
+            if data:
+                if kept is not None:
+                    kept.append(data)
+                    kept_bytes += len(data)
+                    if kept_bytes > max_keep_bytes:
+                        kept = None
+                yield data
+        data = compressor.flush()
+        if kept is not None:
+            kept.append(data)
+        complete = True # Every chunk was read, none of them raised
+        yield data
+    finally:
+        if complete and kept is not None:
+            on_complete(b"".join(kept))
+
+def replay(body):
+    """Yields a previously compressed body, so that it is sent the same way as a freshly compressed one."""
+    yield body
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Suppresses readings that have already been taken in, such as those resent by a scale retrying after a
+network error.
+
+A reading is identified by its device and reading time. For each device, the times of its most recent
+readings are kept in a small ring buffer (with a set for lookups), so most resent readings are dropped
+without a database round trip. The buffer only covers recent readings and each process has its own, so
+the database's unique index on (device, reading time) remains the final word; this filter only saves it
+the work.
+
+Readings may arrive out of order. One is accepted as long as it is no more than the lateness window older
+than the newest reading seen from its device, and rejected as late otherwise. Readings dated more than the
+clock skew ahead of the server's clock are accepted, but don't count as the newest, so that one reading
+from a scale with a bad clock can't make the rest of its readings look late.
+"""
+
+import collections
+import threading
+import time
+
+DEFAULT_WINDOW_SIZE = 64 # Recent reading times remembered per device
+DEFAULT_MAX_LATENESS = 86400.0 # Seconds a reading may trail the device's newest reading
+DEFAULT_MAX_DEVICES = 100000 # Devices remembered, the least recently heard from are forgotten first
+DEFAULT_MAX_CLOCK_SKEW = 300.0 # Seconds a reading may be ahead of the server's clock and still count as the device's newest
+
+class DeviceWindow(object):
+    """The most recent reading times of one device."""
+    __slots__ = ("newest", "times", "members")
+
+    def __init__(self, window_size):
+        self.newest = None
+        self.times = collections.deque(maxlen=window_size)
+        self.members = set()
+
+    def add(self, reading_time, newest_limit):
+        if len(self.times) == self.times.maxlen:
+            self.members.discard(self.times[0])
+        self.times.append(reading_time)
+        self.members.add(reading_time)
+        if reading_time <= newest_limit and (self.newest is None or reading_time > self.newest):
+            self.newest = reading_time
+
+    def remove(self, reading_time):
+        if reading_time in self.members:
+            self.members.discard(reading_time)
+            self.times.remove(reading_time)
+
+class DuplicateFilter(object):
+    """Thread safe, size bounded record of each device's recent reading times."""
+
+    def __init__(self, window_size=DEFAULT_WINDOW_SIZE, max_lateness=DEFAULT_MAX_LATENESS, max_devices=DEFAULT_MAX_DEVICES, max_clock_skew=DEFAULT_MAX_CLOCK_SKEW):
+        self.window_size = window_size
+        self.max_lateness = max_lateness # Zero to accept readings however late they are
+        self.max_devices = max_devices
+        self.max_clock_skew = max_clock_skew
+        self.devices = collections.OrderedDict() # device_id -> DeviceWindow
+        self.lock = threading.Lock()
+
+        # Counters.
+        self.accepted_count = 0
+        self.duplicate_count = 0
+        self.late_count = 0
+
+    def filter(self, readings, late=None):
+        """Returns the (device_id, reading, reading_time) tuples that have not been seen before and are not too late,
+        remembering them so that they will be rejected if they are sent again. The ones that are too late are appended
+        to late, if it is given."""
+        accepted = []
+        newest_limit = time.time() + self.max_clock_skew
+        with self.lock:
+            for item in readings:
+                device_id, _, reading_time = item
+                window = self.devices.get(device_id)
+                if window is None:
+                    window = self.devices[device_id] = DeviceWindow(self.window_size)
+                    while len(self.devices) > self.max_devices:
+                        self.devices.popitem(last=False)
+                else:
+                    self.devices.move_to_end(device_id)
+                    if reading_time in window.members:
+                        self.duplicate_count += 1
+                        continue
+                    if self.max_lateness > 0.0 and window.newest is not None and reading_time < window.newest - self.max_lateness:
+                        self.late_count += 1
+                        if late is not None:
+                            late.append(item)
+                        continue
+                window.add(reading_time, newest_limit)
+                accepted.append(item)
+            self.accepted_count += len(accepted)
+        return accepted
+
+    def forget(self, readings):
+        """Removes readings that were accepted but could not be stored, so that the client's retry isn't rejected."""
+        with self.lock:
+            for device_id, _, reading_time in readings:
+                window = self.devices.get(device_id)
+                if window is not None:
+                    window.remove(reading_time)
+            self.accepted_count -= len(readings)
+
+    def stats(self):
+        """Returns a dictionary of the filter's counters."""
+        with self.lock:
+            return {
+                "devices": len(self.devices),
+                "accepted": self.accepted_count,
+                "duplicates": self.duplicate_count,
+                "late": self.late_count,
+            }
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""Noise filtering and deadband compression of readings as they are taken in.
+
+A keg's weight sits still for hours between pours, but the scale's load cells jitter by a few grams,
+so storing every sample mostly stores noise. Each device's readings first go through a short running
+median, which removes jitter and one-off spikes (someone leaning on the keg) while keeping the sharp
+edge of a pour. A filtered reading is then only stored if it is more than the deadband away from the
+last stored one, or if max_interval seconds have passed since then, so the stored series never goes
+stale by more than that.
+
+Holding the last stored value reproduces every filtered reading to within the deadband. When a reading
+breaks out of the deadband, the reading before it is stored too, so that a chart that draws straight
+lines between points shows a pour as a step rather than a slope from the last stored point, and stays
+within twice the deadband.
+
+State is kept per device and per process. Readings older than the newest one filtered for their device
+skip the filter and are stored as they are. If the readings to store can't be written, the state is
+rolled back, so that the next reading isn't compared against a value that was never stored.
+"""
+
+import collections
+import threading
+
+DEFAULT_MEDIAN_WINDOW = 5 # Readings in the running median, one to turn it off
+DEFAULT_DEADBAND = 20.0 # Grams, zero to store every filtered reading
+DEFAULT_MAX_INTERVAL = 300.0 # Seconds between stored readings when the weight isn't changing
+DEFAULT_MAX_DEVICES = 100000 # Devices remembered, the least recently heard from are forgotten first
+
+def median(values):
+    """Returns the median of a short sequence, the upper middle value if there is an even number of them."""
+    ordered = sorted(values)
+    return ordered[len(ordered) // 2]
+
+class DeviceState(object):
+    """Filter and compression state of one device."""
+    __slots__ = ("window", "anchor", "anchor_time", "held", "last_time")
+
+    def __init__(self, median_window):
+        self.window = collections.deque(maxlen=median_window) # The latest raw readings
+        self.anchor = None # The last stored reading
+        self.anchor_time = None
+        self.held = None # The latest filtered (reading_time, reading) that was not stored
+        self.last_time = None # Time of the newest reading filtered
+
+    def copy(self):
+        """Returns a copy of the state, for rolling back to."""
+        state = DeviceState(self.window.maxlen)
+        state.window.extend(self.window)
+        state.anchor = self.anchor
+        state.anchor_time = self.anchor_time
+        state.held = self.held
+        state.last_time = self.last_time
+        return state
+
+class Checkpoint(object):
+    """What rollback needs to undo one call to process."""
+    __slots__ = ("devices", "received", "stored", "unfiltered")
+
+    def __init__(self):
+        self.devices = {} # device_id -> (DeviceState, copy of it from before, or None if it was new, last_time after)
+        self.received = 0
+        self.stored = 0
+        self.unfiltered = 0
+
+class IngestFilter(object):
+    """Thread safe, size bounded, per-device filter that decides which readings are worth storing."""
+
+    def __init__(self, median_window=DEFAULT_MEDIAN_WINDOW, deadband=DEFAULT_DEADBAND, max_interval=DEFAULT_MAX_INTERVAL, max_devices=DEFAULT_MAX_DEVICES):
+        self.median_window = max(1, median_window)
+        self.deadband = deadband
+        self.max_interval = max_interval
+        self.max_devices = max_devices
+        self.devices = collections.OrderedDict() # device_id -> DeviceState
+        self.lock = threading.Lock()
+
+        # Counters.
+        self.received_count = 0
+        self.stored_count = 0
+        self.unfiltered_count = 0
+
+    def lookup(self, device_id):
+        """Returns the device's state, creating it if necessary. Called with the lock held."""
+        state = self.devices.get(device_id)
+        if state is None:
+            state = self.devices[device_id] = DeviceState(self.median_window)
+            while len(self.devices) > self.max_devices:
+                self.devices.popitem(last=False)
+        else:
+            self.devices.move_to_end(device_id)
+        return state
+
+    def step(self, state, device_id, reading, reading_time, stored):
+        """Filters one reading, in time order, appending whatever should be stored. Called with the lock held."""
+        state.window.append(reading)
+        state.last_time = reading_time
+        filtered = median(state.window) if len(state.window) > 1 else reading
+
+        if state.anchor is not None and self.deadband > 0.0:
+            if abs(filtered - state.anchor) <= self.deadband:
+                if reading_time - state.anchor_time < self.max_interval:
+                    state.held = (reading_time, filtered)
+                    return
+            elif state.held is not None:
+                held_time, held_reading = state.held
+                stored.append((device_id, held_reading, held_time))
+
+        stored.append((device_id, filtered, reading_time))
+        state.anchor = filtered
+        state.anchor_time = reading_time
+        state.held = None
+
+    def process(self, readings, checkpoint=None):
+        """Runs a list of (device_id, reading, reading_time) tuples through the filter and returns the ones to store, with
+        filtered readings in place of the raw ones. If a Checkpoint is given, it is filled in so that rollback can undo this."""
+        stored = []
+        unfiltered = 0
+        with self.lock:
+            saved = {}
+            for item in sorted(readings, key=lambda item: item[2]):
+                device_id, reading, reading_time = item
+                state = self.lookup(device_id)
+                if checkpoint is not None and device_id not in saved:
+                    saved[device_id] = (state, None if state.last_time is None else state.copy())
+                if state.last_time is not None and reading_time <= state.last_time:
+                    stored.append(item)
+                    unfiltered += 1
+                else:
+                    self.step(state, device_id, reading, reading_time, stored)
+            self.received_count += len(readings)
+            self.stored_count += len(stored)
+            self.unfiltered_count += unfiltered
+            if checkpoint is not None:
+                for device_id, (state, before) in saved.items():
+                    checkpoint.devices[device_id] = (state, before, state.last_time)
+                checkpoint.received = len(readings)
+                checkpoint.stored = len(stored)
+                checkpoint.unfiltered = unfiltered
+        return stored
+
+    def rollback(self, checkpoint):
+        """Puts the devices' state back to how it was before the call to process that filled in the checkpoint, for when the
+        readings it returned could not be stored. A device that has filtered more readings since is left as it is."""
+        with self.lock:
+            for device_id, (state, before, last_time) in checkpoint.devices.items():
+                if self.devices.get(device_id) is not state or state.last_time != last_time:
+                    continue
+                if before is None:
+                    del self.devices[device_id]
+                else:
+                    self.devices[device_id] = before
+            self.received_count -= checkpoint.received
+            self.stored_count -= checkpoint.stored
+            self.unfiltered_count -= checkpoint.unfiltered
+
+    def stats(self):
+        """Returns a dictionary of the filter's counters."""
+        with self.lock:
+            return {
+                "devices": len(self.devices),
+                "received": self.received_count,
+                "stored": self.stored_count,
+                "unfiltered": self.unfiltered_count,
+            }
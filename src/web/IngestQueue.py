@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""Write-behind queue for scale readings.
+
+Readings are accepted into a bounded in-process queue and a background thread writes them to the
+database in groups, so a slow database shows up as queue depth instead of request latency.
+
+The client has already been answered by the time its readings are written, so a group that fails to
+write is not dropped but tried again, after a backoff that grows with each failure, before any later
+group. Meanwhile the queue fills up and pushes back on new readings. A group is only given up on when
+the queue is stopping and it has failed max_attempts times; it is then handed to on_drop.
+"""
+
+import collections
+import logging
+import threading
+import time
+import traceback
+
+DEFAULT_MAX_ATTEMPTS = 5 # Tries at writing a group before it is dropped, once the queue is stopping
+RETRY_BACKOFF_SECS = 0.5 # Wait after the first failed write of a group, doubled after each further failure
+MAX_RETRY_BACKOFF_SECS = 30.0
+
+class QueueFullException(Exception):
+    """Exception thrown when the queue cannot accept more readings."""
+
+    def __init__(self, message):
+        self.message = message
+        Exception.__init__(self, message)
+
+class WriteBehindQueue(object):
+    """Bounded queue of readings that is drained by a background writer thread.
+
+    A group is written when batch_size readings are waiting or flush_interval seconds have passed
+    since the oldest waiting reading arrived, whichever comes first."""
+
+    def __init__(self, writer, max_depth=100000, batch_size=1000, flush_interval=1.0, on_drop=None, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.writer = writer # Callable that takes a list of readings and returns True on success
+        self.on_drop = on_drop # Callable that takes a list of readings that were given up on
+        self.max_attempts = max_attempts
+        self.max_depth = max_depth
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = collections.deque()
+        self.oldest_time = None
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.thread = None
+
+        # Counters.
+        self.accepted_count = 0
+        self.rejected_count = 0
+        self.flush_count = 0
+        self.flushed_count = 0
+        self.failed_flush_count = 0
+        self.retrying_count = 0 # Readings in a group that failed and is waiting to be tried again
+        self.dropped_count = 0
+        self.flush_secs_total = 0.0
+        self.flush_secs_max = 0.0
+
+    def log_error(self, log_str):
+        """Writes an error message to the log file."""
+        logger = logging.getLogger()
+        logger.error(log_str)
+
+    def start(self):
+        """Starts the background writer."""
+        self.thread = threading.Thread(target=self.run, name="WriteBehindQueue", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops the background writer after it has flushed everything that is queued."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def put(self, readings):
+        """Queues a list of (device_id, reading, reading_time) tuples. The whole list is accepted or, if it does
+        not fit, rejected with a QueueFullException so the caller can push back on the client."""
+        with self.condition:
+            if self.stopping:
+                raise QueueFullException("Ingest queue is shutting down.")
+            if len(self.pending) + len(readings) > self.max_depth:
+                self.rejected_count += len(readings)
+                raise QueueFullException("Ingest queue is full.")
+            was_empty = self.oldest_time is None
+            if was_empty:
+                self.oldest_time = time.monotonic()
+            self.pending.extend(readings)
+            self.accepted_count += len(readings)
+
+            # Wake the writer for a full group, or so it starts timing the flush interval.
+            if was_empty or len(self.pending) >= self.batch_size:
+                self.condition.notify()
+
+    def depth(self):
+        """Returns the number of readings waiting to be written."""
+        with self.condition:
+            return len(self.pending)
+
+    def take_group(self):
+        """Blocks until a group is due, then removes and returns it. Returns an empty list when stopped and drained."""
+        with self.condition:
+            while True:
+                if len(self.pending) >= self.batch_size or (self.stopping and self.pending):
+                    break
+                if self.stopping:
+                    return []
+                if self.oldest_time is not None:
+                    remaining = self.oldest_time + self.flush_interval - time.monotonic()
+                    if remaining <= 0.0:
+                        break
+                    self.condition.wait(remaining)
+                else:
+                    self.condition.wait()
+
+            count = min(self.batch_size, len(self.pending))
+            group = [ self.pending.popleft() for _ in range(count) ]
+            self.oldest_time = time.monotonic() if self.pending else None
+            return group
+
+    def flush_group(self, group):
+        """Writes one group to the database and updates the counters. Returns True on success."""
+        start = time.monotonic()
+        try:
+            success = self.writer(group)
+        except:
+            self.log_error(traceback.format_exc())
+            success = False
+        elapsed = time.monotonic() - start
+
+        with self.condition:
+            self.flush_count += 1
+            self.flush_secs_total += elapsed
+            self.flush_secs_max = max(self.flush_secs_max, elapsed)
+            if success:
+                self.flushed_count += len(group)
+            else:
+                self.failed_flush_count += 1
+        if not success:
+            self.log_error("Write-behind flush of %u readings failed." % len(group))
+        return success
+
+    def back_off(self, delay):
+        """Waits before a group is tried again. Returns early if the queue is stopped meanwhile."""
+        end_time = time.monotonic() + delay
+        with self.condition:
+            while not self.stopping:
+                remaining = end_time - time.monotonic()
+                if remaining <= 0.0:
+                    break
+                self.condition.wait(remaining)
+
+    def write_group(self, group):
+        """Writes one group, trying again until it succeeds or the queue is stopping and it has failed max_attempts times."""
+        attempts = 0
+        delay = RETRY_BACKOFF_SECS
+        while not self.flush_group(group):
+            attempts += 1
+            with self.condition:
+                give_up = self.stopping and attempts >= self.max_attempts
+                if give_up:
+                    self.retrying_count = 0
+                    self.dropped_count += len(group)
+                else:
+                    self.retrying_count = len(group)
+            if give_up:
+                self.log_error("Dropped %u readings after %u failed writes." % (len(group), attempts))
+                if self.on_drop is not None:
+                    self.on_drop(group)
+                return
+            self.back_off(delay)
+            delay = min(delay * 2.0, MAX_RETRY_BACKOFF_SECS)
+        if attempts > 0:
+            with self.condition:
+                self.retrying_count = 0
+
+    def run(self):
+        """Body of the background writer thread."""
+        while True:
+            group = self.take_group()
+            if not group:
+                break
+            self.write_group(group)
+
+    def stats(self):
+        """Returns a dictionary of the queue's counters."""
+        with self.condition:
+            return {
+                "depth": len(self.pending),
+                "max_depth": self.max_depth,
+                "accepted": self.accepted_count,
+                "rejected": self.rejected_count,
+                "flushes": self.flush_count,
+                "flushed": self.flushed_count,
+                "failed_flushes": self.failed_flush_count,
+                "retrying": self.retrying_count,
+                "dropped": self.dropped_count,
+                "flush_secs_total": self.flush_secs_total,
+                "flush_secs_max": self.flush_secs_max,
+            }
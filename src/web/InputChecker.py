@@ -40,8 +40,7 @@ days_of_week = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturda
 def is_complete_regex_match(expr, test_str):
     """Returns True if the complete string matches the regular expression."""
     try:
-        match_obj = re.match(expr, test_str)
-        return match_obj and match_obj.span()[0] == 0 and match_obj.span()[1] == len(test_str)
+        return expr.fullmatch(test_str) is not None
     except:
         pass
     return False
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""Online estimate of how full a keg is and when it will run out.
+
+Each device has a small filter that is updated in constant time per reading:
+
+* The level is an exponentially smoothed weight. A reading that jumps away from the level is held back
+  until enough following readings agree with it, so momentary spikes (someone leaning on the keg, the
+  scale being bumped) are discarded while real changes (a pour) are accepted.
+* A confirmed jump upwards by more than the swap threshold means a new keg was put on the scale, and
+  the estimator starts over.
+* The depletion rate is an exponentially weighted average of the level's rate of change, with a time
+  constant of about a day, so it reflects how fast the keg is being drunk rather than individual pours.
+
+An estimator has to see all of its device's readings. When one process takes in every reading, the
+estimators are kept in memory and persisted now and then. When several worker processes share the
+ingest, each would only see its own share, so the database copy is the only one: each update reads
+the state, folds the readings in and writes it back only if no other process has written it since,
+which is checked by comparing the time of the last reading folded in. If one has, it starts over.
+"""
+
+import logging
+import math
+import threading
+import time
+
+DEFAULT_TARE_WEIGHT = 4000.0 # Weight of an empty keg, in grams (roughly a 5 gallon Cornelius keg)
+LEVEL_TIME_CONSTANT = 60.0 # Seconds
+RATE_TIME_CONSTANT = 86400.0 # Seconds
+SPIKE_THRESHOLD = 200.0 # Grams; readings further than this from the level must be confirmed
+SPIKE_CONFIRM_COUNT = 3 # Number of consecutive agreeing readings needed to accept a jump
+SWAP_THRESHOLD = 5000.0 # Grams; a confirmed increase larger than this is a keg swap
+STATE_LAST_TIME_INDEX = 2 # Position of last_time in a persisted state
+MAX_SHARED_UPDATE_ATTEMPTS = 5 # Tries at a shared update before giving up, each one after another process got there first
+
+# Keys used in the estimate returned by the API.
+ESTIMATE_READING_TIME_KEY = "reading_time"
+ESTIMATE_LEVEL_KEY = "level"
+ESTIMATE_FILL_PERCENT_KEY = "fill_percent"
+ESTIMATE_RATE_KEY = "depletion_rate" # Grams per day
+ESTIMATE_EMPTY_TIME_KEY = "empty_time"
+
+class DepletionEstimator(object):
+    """The estimator state for a single device."""
+    __slots__ = ("level", "rate", "last_time", "full_level", "candidate", "candidate_count", "dirty")
+
+    def __init__(self):
+        self.level = None # Smoothed weight, in grams
+        self.rate = 0.0 # Consumption, in grams per second
+        self.last_time = None
+        self.full_level = None # Highest level seen since the last keg swap
+        self.candidate = None # A reading that jumped away from the level, waiting to be confirmed
+        self.candidate_count = 0
+        self.dirty = False # Changed since last persisted
+
+    def reset(self, reading, reading_time):
+        """Starts over, for a new keg."""
+        self.level = reading
+        self.rate = 0.0
+        self.last_time = reading_time
+        self.full_level = reading
+        self.candidate = None
+        self.candidate_count = 0
+
+    def update(self, reading, reading_time):
+        """Folds in a single reading. Readings that are not newer than the last one are ignored."""
+        self.dirty = True
+        if self.level is None:
+            self.reset(reading, reading_time)
+            return
+        if reading_time <= self.last_time:
+            return
+
+        # Hold back readings that jump away from the level until they are confirmed.
+        if abs(reading - self.level) > SPIKE_THRESHOLD:
+            if self.candidate is not None and abs(reading - self.candidate) <= SPIKE_THRESHOLD:
+                self.candidate_count += 1
+            else:
+                self.candidate = reading
+                self.candidate_count = 1
+            if self.candidate_count < SPIKE_CONFIRM_COUNT:
+                return
+
+            # Confirmed. A large increase is a new keg, otherwise it is a step change such as a pour.
+            if reading - self.level > SWAP_THRESHOLD:
+                self.reset(reading, reading_time)
+                return
+            new_level = reading
+        else:
+            alpha = 1.0 - math.exp(-(reading_time - self.last_time) / LEVEL_TIME_CONSTANT)
+            new_level = self.level + alpha * (reading - self.level)
+        self.candidate = None
+        self.candidate_count = 0
+
+        # Fold the change in level into the consumption rate.
+        dt = reading_time - self.last_time
+        weight = 1.0 - math.exp(-dt / RATE_TIME_CONSTANT)
+        instant_rate = (self.level - new_level) / dt
+        self.rate = self.rate + weight * (instant_rate - self.rate)
+        self.level = new_level
+        self.last_time = reading_time
+        self.full_level = max(self.full_level, new_level)
+
+    def estimate(self, tare_weight):
+        """Returns the current fill level, depletion rate and predicted empty time as a dictionary."""
+        if self.level is None:
+            return None
+        remaining = max(0.0, self.level - tare_weight)
+        capacity = self.full_level - tare_weight
+        fill_percent = 100.0 * remaining / capacity if capacity > 0.0 else 0.0
+        empty_time = None
+        if self.rate > 0.0:
+            empty_time = self.last_time + remaining / self.rate
+        return {
+            ESTIMATE_READING_TIME_KEY: self.last_time,
+            ESTIMATE_LEVEL_KEY: self.level,
+            ESTIMATE_FILL_PERCENT_KEY: min(100.0, fill_percent),
+            ESTIMATE_RATE_KEY: self.rate * 86400.0,
+            ESTIMATE_EMPTY_TIME_KEY: empty_time
+        }
+
+    def to_list(self):
+        """Returns the state in a compact form for persisting. The time of the last reading is at STATE_LAST_TIME_INDEX."""
+        return [ self.level, self.rate, self.last_time, self.full_level, self.candidate, self.candidate_count ]
+
+    @staticmethod
+    def from_list(state):
+        """Restores an estimator from the output of to_list."""
+        estimator = DepletionEstimator()
+        estimator.level, estimator.rate, estimator.last_time, estimator.full_level, estimator.candidate, estimator.candidate_count = state
+        return estimator
+
+class EstimatorMgr(object):
+    """Keeps an estimator per device in memory and periodically persists the ones that have changed. If shared, the
+    estimators are kept in the database instead, for when several processes take in readings."""
+
+    def __init__(self, database, tare_weight=DEFAULT_TARE_WEIGHT, persist_interval=60.0, shared=False):
+        self.database = database
+        self.tare_weight = tare_weight
+        self.persist_interval = persist_interval
+        self.shared = shared
+        self.estimators = {}
+        self.lock = threading.Lock()
+        self.last_persist = time.monotonic()
+
+    def log_error(self, log_str):
+        """Writes an error message to the log file."""
+        logger = logging.getLogger()
+        logger.error(log_str)
+
+    def load(self, device_id):
+        """Returns the device's persisted estimator, or a new one if it doesn't have one."""
+        state = self.database.retrieve_estimator_state(device_id)
+        return DepletionEstimator() if state is None else DepletionEstimator.from_list(state)
+
+    def lookup(self, device_id):
+        """Returns the device's estimator, loading it from the database the first time. The lock is not held while loading,
+        so that other devices' updates don't wait on the database."""
+        with self.lock:
+            estimator = self.estimators.get(device_id)
+        if estimator is None:
+            loaded = self.load(device_id)
+            with self.lock:
+                estimator = self.estimators.setdefault(device_id, loaded)
+        return estimator
+
+    def update(self, readings):
+        """Folds a list of (device_id, reading, reading_time) tuples into the estimators."""
+        by_device = {}
+        for device_id, reading, reading_time in sorted(readings, key=lambda reading: reading[2]):
+            by_device.setdefault(device_id, []).append((reading, reading_time))
+        if self.shared:
+            for device_id, device_readings in by_device.items():
+                self.update_shared(device_id, device_readings)
+            return
+
+        estimators = { device_id: self.lookup(device_id) for device_id in by_device }
+        with self.lock:
+            for device_id, device_readings in by_device.items():
+                estimator = estimators[device_id]
+                for reading, reading_time in device_readings:
+                    estimator.update(reading, reading_time)
+        if time.monotonic() - self.last_persist >= self.persist_interval:
+            self.persist()
+
+    def update_shared(self, device_id, readings):
+        """Folds a device's (reading, reading_time) pairs, in time order, into its estimator in the database."""
+        for _ in range(MAX_SHARED_UPDATE_ATTEMPTS):
+            estimator = self.load(device_id)
+            last_time = estimator.last_time
+            for reading, reading_time in readings:
+                estimator.update(reading, reading_time)
+            if estimator.last_time == last_time:
+                return # Nothing newer than what is stored
+            result = self.database.swap_estimator_state(device_id, last_time, estimator.to_list())
+            if result is None or result:
+                return # Written, or a database error that has been logged
+        self.log_error("Gave up updating the estimator of %s after %u attempts." % (device_id, MAX_SHARED_UPDATE_ATTEMPTS))
+
+    def estimate(self, device_id):
+        """Returns the device's current estimate, or None if it has no readings."""
+        if self.shared:
+            return self.load(device_id).estimate(self.tare_weight)
+        estimator = self.lookup(device_id)
+        with self.lock:
+            return estimator.estimate(self.tare_weight)
+
+    def estimate_many(self, device_ids):
+        """Returns a dictionary of device_id -> estimate for those of the devices that have one. Estimators that aren't in
+        memory yet are loaded with a single query."""
+        if self.shared:
+            states = self.database.retrieve_estimator_states(device_ids)
+            estimates = {}
+            for device_id, state in (states or {}).items():
+                estimate = DepletionEstimator.from_list(state).estimate(self.tare_weight)
+                if estimate is not None:
+                    estimates[device_id] = estimate
+            return estimates
+
+        with self.lock:
+            missing = [ device_id for device_id in device_ids if device_id not in self.estimators ]
+        if missing:
+            states = self.database.retrieve_estimator_states(missing)
+            if states is not None:
+                with self.lock:
+                    for device_id in missing:
+                        if device_id not in self.estimators:
+                            state = states.get(device_id)
+                            self.estimators[device_id] = DepletionEstimator() if state is None else DepletionEstimator.from_list(state)
+
+        estimates = {}
+        with self.lock:
+            for device_id in device_ids:
+                estimator = self.estimators.get(device_id)
+                if estimator is not None:
+                    estimate = estimator.estimate(self.tare_weight)
+                    if estimate is not None:
+                        estimates[device_id] = estimate
+        return estimates
+
+    def persist(self):
+        """Writes the estimators that have changed since the last time."""
+        with self.lock:
+            self.last_persist = time.monotonic()
+            states = {}
+            for device_id, estimator in self.estimators.items():
+                if estimator.dirty:
+                    states[device_id] = estimator.to_list()
+                    estimator.dirty = False
+        if states and not self.database.update_estimator_states(states):
+            with self.lock:
+                for device_id in states:
+                    self.estimators[device_id].dirty = True
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""Low overhead counters and latency histograms, exposed in the Prometheus text format.
+
+Each metric is split into a fixed number of shards, each with its own lock, and threads are spread across
+them round robin, so threads recording at the same time rarely wait on each other. The shards are only
+summed when the metrics are rendered. The number of shards doesn't grow with the number of threads, which
+the development server starts one of per request. Each server process keeps its own registry, so in
+production mode every worker reports its own figures.
+"""
+
+import bisect
+import inspect
+import itertools
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+SHARD_COUNT = 16
+
+g_thread_slot = threading.local() # The shard index of the calling thread, the same for every metric
+g_next_slot = itertools.count()
+
+# Upper bounds of the latency buckets, in seconds.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(label_names, labels, extra=""):
+    """Formats the {name="value",...} part of a sample."""
+    pairs = [ name + "=\"" + escape_label_value(value) + "\"" for name, value in zip(label_names, labels) ]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def thread_slot():
+    """Returns the calling thread's shard index, assigning the next one the first time."""
+    try:
+        return g_thread_slot.index
+    except AttributeError:
+        g_thread_slot.index = next(g_next_slot) % SHARD_COUNT
+        return g_thread_slot.index
+
+class Shard(object):
+    """Values keyed by a tuple of label values, and the lock that guards them."""
+    __slots__ = ("values", "lock")
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+class Metric(object):
+    """Base class for a metric whose values are kept in a fixed set of shards, keyed by a tuple of label values."""
+
+    def __init__(self, name, description, label_names):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.shards = [ Shard() for _ in range(SHARD_COUNT) ]
+
+    def shard(self):
+        """Returns the calling thread's shard."""
+        return self.shards[thread_slot()]
+
+    def snapshot_shards(self):
+        """Returns copies of the values in all of the shards."""
+        snapshots = []
+        for shard in self.shards:
+            with shard.lock:
+                snapshots.append({ labels: (list(value) if isinstance(value, list) else value) for labels, value in shard.values.items() })
+        return snapshots
+
+class Counter(Metric):
+    """A monotonically increasing count."""
+    metric_type = "counter"
+
+    def inc(self, labels=(), amount=1):
+        shard = self.shard()
+        with shard.lock:
+            shard.values[labels] = shard.values.get(labels, 0) + amount
+
+    def samples(self):
+        totals = {}
+        for shard in self.snapshot_shards():
+            for labels, value in shard.items():
+                totals[labels] = totals.get(labels, 0) + value
+        return [ (self.name, format_labels(self.label_names, labels), value) for labels, value in sorted(totals.items()) ]
+
+class Histogram(Metric):
+    """A distribution of observed values, such as latencies, in fixed buckets."""
+    metric_type = "histogram"
+
+    def __init__(self, name, description, label_names, buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, description, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        shard = self.shard()
+        with shard.lock:
+            cell = shard.values.get(labels)
+            if cell is None:
+                cell = shard.values[labels] = [0] * (len(self.buckets) + 1) + [0.0] # A count per bucket, the overflow count, then the sum
+            cell[index] += 1
+            cell[-1] += value
+
+    def totals(self):
+        """Returns a dictionary of labels -> the summed [bucket counts..., overflow count, sum] across all threads."""
+        totals = {}
+        for shard in self.snapshot_shards():
+            for labels, cell in shard.items():
+                total = totals.get(labels)
+                if total is None:
+                    totals[labels] = list(cell)
+                else:
+                    for index, value in enumerate(cell):
+                        total[index] += value
+        return totals
+
+    def quantile(self, labels, q):
+        """Estimates a quantile by interpolating within its bucket, the same way Prometheus' histogram_quantile does."""
+        cell = self.totals().get(labels)
+        if cell is None:
+            return None
+        counts = cell[:-1]
+        total = sum(counts)
+        if total == 0:
+            return None
+        rank = q * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            if cumulative + count >= rank and count > 0:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def samples(self):
+        samples = []
+        for labels, cell in sorted(self.totals().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), cell[:-1]):
+                cumulative += count
+                samples.append((self.name + "_bucket", format_labels(self.label_names, labels, "le=\"" + format_value(bound) + "\""), cumulative))
+            samples.append((self.name + "_sum", format_labels(self.label_names, labels), cell[-1]))
+            samples.append((self.name + "_count", format_labels(self.label_names, labels), cumulative))
+        return samples
+
+class Collected(object):
+    """Values read from another object, such as a queue's counters, when the metrics are rendered."""
+
+    def __init__(self, name, description, metric_type, label_names, collect):
+        self.name = name
+        self.description = description
+        self.metric_type = metric_type
+        self.label_names = label_names
+        self.collect = collect # Returns a list of (labels, value) pairs
+
+    def samples(self):
+        return [ (self.name, format_labels(self.label_names, labels), value) for labels, value in self.collect() ]
+
+class Registry(object):
+    """The set of metrics for this process."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, description, label_names=()):
+        metric = Counter(name, description, label_names)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, description, label_names=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, description, label_names, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def collected(self, name, description, metric_type, collect, label_names=()):
+        metric = Collected(name, description, metric_type, label_names, collect)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Returns all of the metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP " + metric.name + " " + metric.description)
+            lines.append("# TYPE " + metric.name + " " + metric.metric_type)
+            for name, labels, value in metric.samples():
+                lines.append(name + labels + " " + format_value(value))
+        return "\n".join(lines) + "\n"
+
+def timed_generator(generator, histogram, labels, elapsed=0.0):
+    """Passes through the generator's items, recording only the time spent producing them (not the time the consumer
+    spends between items) once it is exhausted or closed."""
+    try:
+        while True:
+            start_time = time.perf_counter()
+            try:
+                item = next(generator)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start_time
+            yield item
+    finally:
+        generator.close()
+        histogram.observe(labels, elapsed)
+
+class TimedProxy(object):
+    """Stands in for an object, such as the database, and times every call to its public methods."""
+
+    def __init__(self, target, histogram):
+        self._target = target
+        self._histogram = histogram
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        histogram = self._histogram
+        labels = (name,)
+        def timed(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                result = attr(*args, **kwargs)
+            except:
+                histogram.observe(labels, time.perf_counter() - start_time)
+                raise
+            elapsed = time.perf_counter() - start_time
+            if inspect.isgenerator(result):
+                # Methods such as iter_readings do their work as they are consumed.
+                return timed_generator(result, histogram, labels, elapsed)
+            histogram.observe(labels, elapsed)
+            return result
+
+        # Remember the wrapper so later lookups don't come through here.
+        self.__dict__[name] = timed
+        return timed
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""Runs bcrypt on a pool of worker processes.
+
+bcrypt is deliberately slow, and running it on the request thread holds the worker (and the GIL) for
+hundreds of milliseconds per login. Here it runs on a bounded process pool instead. When too many hashes
+are already in flight, new requests are rejected immediately rather than queueing behind them. A hash
+stays in flight until the pool has finished it, even if the request waiting on it timed out.
+"""
+
+import bcrypt
+import concurrent.futures
+import multiprocessing
+import threading
+import time
+
+class HasherBusyException(Exception):
+    """Exception thrown when the hashing pool is saturated."""
+
+    def __init__(self, message):
+        self.message = message
+        Exception.__init__(self, message)
+
+def hash_password(password):
+    """Worker function. Returns the salted hash of the password and the time at which the work started."""
+    start_time = time.time()
+    return bcrypt.hashpw(password, bcrypt.gensalt()), start_time
+
+def check_password(password, hashed_password):
+    """Worker function. Returns whether the password matches the hash and the time at which the work started."""
+    start_time = time.time()
+    return bcrypt.checkpw(password, hashed_password), start_time
+
+class PasswordHasher(object):
+    """Hashes and checks passwords, on a process pool if num_workers is non-zero, otherwise inline."""
+
+    def __init__(self, num_workers=2, max_pending=8, timeout=30.0, observer=None):
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.observer = observer # Optionally called with the operation name, queue seconds and run seconds of each call
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.pool = None
+        if num_workers > 0:
+            # Spawn, rather than fork, since the parent is a threaded server with open database connections.
+            context = multiprocessing.get_context("spawn")
+            self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, mp_context=context)
+
+        # Counters.
+        self.lock = threading.Lock()
+        self.call_count = 0
+        self.rejected_count = 0
+        self.queue_secs_total = 0.0
+        self.queue_secs_max = 0.0
+        self.run_secs_total = 0.0
+        self.run_secs_max = 0.0
+
+    def shutdown(self):
+        """Stops the worker processes."""
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+    def run(self, func, *args):
+        """Runs one of the worker functions, subject to the concurrency cap, and records how long it waited and ran."""
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected_count += 1
+            raise HasherBusyException("Too many password operations in progress.")
+
+        submit_time = time.time()
+        if self.pool is None:
+            try:
+                result, start_time = func(*args)
+            finally:
+                self.slots.release()
+        else:
+            # The slot is held until the work is done, not just until the caller stops waiting for it, so that work the
+            # caller gave up on still counts against the cap.
+            try:
+                future = self.pool.submit(func, *args)
+            except:
+                self.slots.release()
+                raise
+            future.add_done_callback(lambda future: self.slots.release())
+            try:
+                result, start_time = future.result(timeout=self.timeout)
+            except concurrent.futures.TimeoutError:
+                future.cancel() # Only works if it hasn't started yet
+                raise
+        end_time = time.time()
+
+        queue_secs = max(0.0, start_time - submit_time)
+        run_secs = max(0.0, end_time - start_time)
+        with self.lock:
+            self.call_count += 1
+            self.queue_secs_total += queue_secs
+            self.queue_secs_max = max(self.queue_secs_max, queue_secs)
+            self.run_secs_total += run_secs
+            self.run_secs_max = max(self.run_secs_max, run_secs)
+        if self.observer is not None:
+            self.observer(func.__name__, queue_secs, run_secs)
+        return result
+
+    def hash_password(self, password):
+        """Returns the salted bcrypt hash of the password."""
+        if isinstance(password, str):
+            password = password.encode('utf-8')
+        return self.run(hash_password, password)
+
+    def check_password(self, password, hashed_password):
+        """Returns True if the password matches the bcrypt hash."""
+        if isinstance(password, str):
+            password = password.encode('utf-8')
+        if isinstance(hashed_password, str):
+            hashed_password = hashed_password.encode('utf-8')
+        return self.run(check_password, password, hashed_password)
+
+    def stats(self):
+        """Returns a dictionary of the hasher's counters."""
+        with self.lock:
+            return {
+                "workers": self.num_workers,
+                "calls": self.call_count,
+                "rejected": self.rejected_count,
+                "queue_secs_total": self.queue_secs_total,
+                "queue_secs_max": self.queue_secs_max,
+                "run_secs_total": self.run_secs_total,
+                "run_secs_max": self.run_secs_max,
+            }
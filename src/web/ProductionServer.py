@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""Runs the web app under gunicorn with several pre-forked worker processes.
+
+The app object is created by each worker after the fork (see load), so every worker has its own
+database connections, caches and background threads; nothing that holds a socket is shared across
+processes. Send SIGHUP to the master process to gracefully reload the workers.
+
+A device's readings may reach any worker, so state that is only right if one process sees all of them
+can't be kept per worker. With more than one worker, main in app.py keeps the time-to-empty estimators
+in the database and turns the ingest noise filter off. What stays per worker is listed in the README.
+"""
+
+import gunicorn.app.base
+
+class ProductionServer(gunicorn.app.base.BaseApplication):
+    """Embeds gunicorn so that production mode is launched the same way as the dev server."""
+
+    def __init__(self, flask_app, app_factory, app_shutdown, options):
+        self.flask_app = flask_app
+        self.app_factory = app_factory # Called in each worker, after the fork, to create the app
+        self.app_shutdown = app_shutdown # Called in each worker as it exits
+        self.options = options
+        super(ProductionServer, self).__init__()
+
+    def load_config(self):
+        """Applies the options that gunicorn understands."""
+        for key, value in self.options.items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key.lower(), value)
+
+        app_shutdown = self.app_shutdown
+        def worker_exit(server, worker):
+            app_shutdown()
+        self.cfg.set('worker_exit', worker_exit)
+
+    def load(self):
+        """Called in each worker process."""
+        self.app_factory()
+        return self.flask_app
+
+def make_options(port, workers, threads, keep_alive, timeout, graceful_timeout):
+    """Returns the gunicorn settings for the given command line options."""
+    return {
+        'bind': '0.0.0.0:%u' % port,
+        'workers': workers,
+        'worker_class': 'gthread', # Threaded workers, since the sync worker doesn't support keep-alive
+        'threads': threads,
+        'keepalive': keep_alive,
+        'timeout': timeout,
+        'graceful_timeout': graceful_timeout,
+        'preload_app': False, # Each worker builds its own app, and database connection, after the fork
+    }
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""In-process publish/subscribe of new readings, for clients that wait for changes instead of polling.
+
+A subscription is a small object holding the devices it watches, the latest unseen reading for each, and
+an event that is set when one arrives. Subscriptions are indexed by device, so publishing a batch of
+readings costs a dictionary lookup per device and only wakes the subscribers watching those devices.
+An idle subscriber costs no work at all until one of its devices publishes.
+
+Only readings ingested by this process are published. In production mode each worker has its own
+pub/sub, so a reading taken in through another worker is only seen when the database is checked: by a
+long-poll client when it asks again after its wait times out, and by an event stream each time it sends
+a keepalive.
+
+Each waiting client holds a server thread, so the number of subscriptions can be capped, leaving the
+rest of the threads for everything else. Subscribing beyond the cap fails at once. Waiting clients cost
+no CPU, but each one is a thread, so this serves tens of clients per worker, not thousands.
+"""
+
+import json
+import threading
+
+READING_KEY = "reading"
+READING_TIME_KEY = "reading_time"
+DEVICE_ID_KEY = "device_id"
+
+def encode_event(device_id, reading):
+    """Formats a reading as a server-sent event. The event ID is the reading time, which is also what a client passes as since."""
+    data = { DEVICE_ID_KEY: device_id, READING_KEY: reading[READING_KEY], READING_TIME_KEY: reading[READING_TIME_KEY] }
+    return "id: " + repr(float(reading[READING_TIME_KEY])) + "\nevent: reading\ndata: " + json.dumps(data) + "\n\n"
+
+class PubSubFullException(Exception):
+    """Exception thrown when there are already as many subscriptions as allowed."""
+
+    def __init__(self, message):
+        self.message = message
+        Exception.__init__(self, message)
+
+class Subscription(object):
+    """The state of one waiting client."""
+    __slots__ = ("device_ids", "pending", "event")
+
+    def __init__(self, device_ids):
+        self.device_ids = device_ids
+        self.pending = {} # device_id -> the latest reading not yet handed to the client
+        self.event = threading.Event()
+
+class PubSub(object):
+    """Fans new readings out to the subscriptions watching their devices."""
+
+    def __init__(self, max_subscriptions=0):
+        self.lock = threading.Lock()
+        self.max_subscriptions = max_subscriptions # Zero for no limit
+        self.subscriptions = {} # device_id -> set of Subscriptions
+        self.subscription_count = 0
+        self.publish_count = 0
+        self.delivery_count = 0
+        self.rejected_count = 0
+
+    def subscribe(self, device_ids):
+        """Starts watching the given devices. Subscribe before checking the database, so nothing published in between is missed."""
+        subscription = Subscription(device_ids)
+        with self.lock:
+            if self.max_subscriptions > 0 and self.subscription_count >= self.max_subscriptions:
+                self.rejected_count += 1
+                raise PubSubFullException("Too many clients are waiting for readings.")
+            for device_id in device_ids:
+                self.subscriptions.setdefault(device_id, set()).add(subscription)
+            self.subscription_count += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Stops watching. Devices with no subscribers left are forgotten."""
+        with self.lock:
+            for device_id in subscription.device_ids:
+                subscribers = self.subscriptions.get(device_id)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.subscriptions[device_id]
+            self.subscription_count -= 1
+
+    def publish(self, readings):
+        """Notifies the subscribers of each device in a list of (device_id, reading, reading_time) tuples of its latest reading."""
+        if not self.subscriptions:
+            return # Nobody is waiting, which is the common case
+        latest = {}
+        for device_id, reading, reading_time in readings:
+            current = latest.get(device_id)
+            if current is None or reading_time >= current[READING_TIME_KEY]:
+                latest[device_id] = { READING_TIME_KEY: reading_time, READING_KEY: reading }
+
+        with self.lock:
+            self.publish_count += 1
+            for device_id, reading in latest.items():
+                subscribers = self.subscriptions.get(device_id)
+                if subscribers is None:
+                    continue
+                for subscription in subscribers:
+                    pending = subscription.pending.get(device_id)
+                    if pending is None or reading[READING_TIME_KEY] >= pending[READING_TIME_KEY]:
+                        subscription.pending[device_id] = reading
+                    subscription.event.set()
+                    self.delivery_count += 1
+
+    def wait(self, subscription, timeout):
+        """Waits up to timeout seconds for new readings. Returns a dictionary of device_id -> latest reading, empty if the wait timed out."""
+        subscription.event.wait(timeout)
+        with self.lock:
+            pending = subscription.pending
+            subscription.pending = {}
+            subscription.event.clear()
+        return pending
+
+    def stats(self):
+        """Returns a dictionary of the pub/sub's counters."""
+        with self.lock:
+            return {
+                "subscriptions": self.subscription_count,
+                "devices": len(self.subscriptions),
+                "publishes": self.publish_count,
+                "deliveries": self.delivery_count,
+                "rejected": self.rejected_count,
+            }
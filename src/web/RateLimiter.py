@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Token bucket rate limiting, per endpoint and per caller.
+
+Each endpoint with a budget has a refill rate (requests per second) and a burst size. Each caller of
+such an endpoint has a bucket that starts full, loses a token per request and refills at the rate, up
+to the burst size. A request that finds its bucket empty is turned away, along with how long until a
+token will be there.
+
+A bucket that has been left alone for burst / rate seconds is full again, which is no different from
+not having a bucket at all, so buckets idle for longer than that are dropped. Beyond that, the number
+of buckets is capped and the least recently used ones are dropped first, which can only ever let a
+caller through early.
+
+Buckets are kept per process.
+"""
+
+import collections
+import threading
+import time
+
+DEFAULT_MAX_BUCKETS = 100000
+
+class RateLimiter(object):
+    """Thread safe, size bounded set of token buckets."""
+
+    def __init__(self, budgets, max_buckets=DEFAULT_MAX_BUCKETS):
+        self.budgets = budgets # endpoint -> (rate, burst)
+        self.max_buckets = max_buckets
+        self.idle_secs = max([ burst / rate for rate, burst in budgets.values() ] + [ 0.0 ])
+        self.buckets = collections.OrderedDict() # (endpoint, key) -> [tokens, updated], least recently used first
+        self.lock = threading.Lock()
+
+        # Counters.
+        self.admitted_count = collections.Counter() # endpoint -> requests let through
+        self.rejected_count = collections.Counter() # endpoint -> requests turned away
+
+    def evict(self, now):
+        """Drops the buckets that are full again, and the least recently used ones beyond the cap. Called with the lock held."""
+        while len(self.buckets) > 0:
+            _, bucket = next(iter(self.buckets.items()))
+            if len(self.buckets) <= self.max_buckets and now - bucket[1] < self.idle_secs:
+                break
+            self.buckets.popitem(last=False)
+
+    def admit(self, endpoint, key):
+        """Takes a token from the caller's bucket for the endpoint. Returns zero if the request may go ahead, or the number
+        of seconds until it could. Endpoints without a budget are not limited."""
+        budget = self.budgets.get(endpoint)
+        if budget is None:
+            return 0.0
+        rate, burst = budget
+
+        now = time.monotonic()
+        with self.lock:
+            bucket_key = (endpoint, key)
+            bucket = self.buckets.get(bucket_key)
+            if bucket is None:
+                bucket = self.buckets[bucket_key] = [ float(burst), now ]
+                self.evict(now)
+            else:
+                bucket[0] = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+                self.buckets.move_to_end(bucket_key)
+
+            if bucket[0] >= 1.0:
+                bucket[0] -= 1.0
+                self.admitted_count[endpoint] += 1
+                return 0.0
+            self.rejected_count[endpoint] += 1
+            return (1.0 - bucket[0]) / rate
+
+    def stats(self):
+        """Returns a dictionary of the limiter's counters."""
+        with self.lock:
+            return {
+                "buckets": len(self.buckets),
+                "admitted": dict(self.admitted_count),
+                "rejected": dict(self.rejected_count),
+            }
+
+def scale_budgets(budgets, factor):
+    """Returns the budgets with their rates and bursts multiplied by factor. A factor of zero turns rate limiting off."""
+    if factor <= 0.0:
+        return {}
+    return { endpoint: (rate * factor, max(1, int(round(burst * factor)))) for endpoint, (rate, burst) in budgets.items() }
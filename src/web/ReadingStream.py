@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""Streams series of readings as JSON, with optional cursor based pagination.
+
+In the default row format, readings are encoded as the database cursor yields them, so memory use does
+not depend on the length of the series. The columnar format sends parallel arrays instead, one per
+field, so key names are not repeated for every reading; with delta encoding, each time after the first
+is sent as the difference from the previous one, which is short for evenly spaced readings. Columns
+are built in memory before they are encoded, so callers should limit them to a page.
+
+A continuation cursor records the time of the last reading returned and how many readings at that
+exact time were returned, so that a page boundary can fall between readings that share a timestamp.
+
+A database error part way through a series is raised, not treated as its end, so the response is cut off
+rather than ending as a well formed but short list.
+"""
+
+import base64
+import itertools
+import json
+
+READING_TIME_KEY = "reading_time"
+READING_KEY = "reading"
+READINGS_KEY = "readings"
+CURSOR_KEY = "cursor"
+TIMES_KEY = "t"
+WEIGHTS_KEY = "w"
+DELTA_KEY = "delta" # True if the times after the first are differences from the previous time
+COLUMN_NAMES = { READING_TIME_KEY: TIMES_KEY, READING_KEY: WEIGHTS_KEY } # Other fields, such as a rollup's min and max, keep their names
+
+FORMAT_ROWS = "rows"
+FORMAT_COLUMNS = "columns"
+FORMAT_DELTA = "delta" # Columns, with delta encoded times
+FORMATS = (FORMAT_ROWS, FORMAT_COLUMNS, FORMAT_DELTA)
+CHUNK_SIZE = 256 # Number of readings encoded into each chunk of the response
+
+def encode_cursor(reading_time, skip):
+    """Returns an opaque continuation cursor."""
+    return base64.urlsafe_b64encode(json.dumps([reading_time, skip]).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Decodes a continuation cursor into the time to resume from and the number of readings at that time to skip.
+    Raises ValueError if the cursor is malformed."""
+    try:
+        reading_time, skip = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        reading_time = float(reading_time)
+        skip = int(skip)
+    except Exception:
+        raise ValueError("Malformed cursor.")
+    if skip < 0:
+        raise ValueError("Malformed cursor.")
+    return reading_time, skip
+
+def prefetch(readings):
+    """Reads the first reading straight away, so that a query that fails outright raises here rather than after the
+    response has started. Returns an iterator over all of the readings."""
+    iterator = iter(readings)
+    try:
+        first = next(iterator)
+    except StopIteration:
+        return iter(())
+    return itertools.chain((first,), iterator)
+
+def skip_readings(readings, skip_time, skip):
+    """Drops the first 'skip' readings taken at skip_time, which were returned on the previous page."""
+    for reading in readings:
+        if skip > 0 and reading[READING_TIME_KEY] == skip_time:
+            skip -= 1
+            continue
+        yield reading
+
+def encode_chunks(readings, limit=None):
+    """Yields comma separated JSON chunks for up to 'limit' readings. Returns (through StopIteration) the last reading encoded,
+    the number of readings at that reading's time that were encoded, and whether there were more readings after the limit."""
+    chunk = []
+    count = 0
+    last_time = None
+    run_length = 0
+    first = True
+    iterator = iter(readings)
+    for reading in iterator:
+        if limit is not None and count >= limit:
+            if chunk:
+                yield ("" if first else ", ") + ", ".join(chunk)
+            return last_time, run_length, True
+        chunk.append(json.dumps(reading, ensure_ascii=False))
+        count += 1
+        if reading[READING_TIME_KEY] == last_time:
+            run_length += 1
+        else:
+            last_time = reading[READING_TIME_KEY]
+            run_length = 1
+        if len(chunk) >= CHUNK_SIZE:
+            yield ("" if first else ", ") + ", ".join(chunk)
+            chunk = []
+            first = False
+    if chunk:
+        yield ("" if first else ", ") + ", ".join(chunk)
+    return last_time, run_length, False
+
+def stream_list(readings):
+    """Yields a JSON list of all of the readings."""
+    yield "["
+    yield from encode_chunks(readings)
+    yield "]"
+
+def next_cursor(last_time, run_length, more, limit, skip_time, skip):
+    """Returns the cursor for the page after one that ended with run_length readings at last_time, or None if it was the last page."""
+    if not more:
+        return None
+
+    # If the whole page was readings at the cursor's own timestamp, the ones skipped to get here still need skipping.
+    if last_time == skip_time and run_length == limit:
+        run_length += skip
+    return encode_cursor(last_time, run_length)
+
+def stream_page(readings, limit, skip_time=None, skip=0):
+    """Yields a JSON object holding one page of readings and the cursor for the next page (null if this is the last page).
+    skip_time and skip come from the cursor that requested this page."""
+    yield "{\"" + READINGS_KEY + "\": ["
+    last_time, run_length, more = yield from encode_chunks(skip_readings(readings, skip_time, skip), limit)
+    cursor = next_cursor(last_time, run_length, more, limit, skip_time, skip)
+    yield "], \"" + CURSOR_KEY + "\": " + json.dumps(cursor) + "}"
+
+def collect_columns(readings, limit=None):
+    """Reads up to 'limit' readings into parallel lists. Returns a dictionary of column name -> list, the time of the last
+    reading, the number of readings at that time, and whether there were more readings after the limit."""
+    keys = []
+    columns = []
+    appenders = []
+    count = 0
+    last_time = None
+    run_length = 0
+    more = False
+    for reading in readings:
+        if limit is not None and count >= limit:
+            more = True
+            break
+        if count == 0:
+            keys = list(reading.keys())
+            columns = [ [] for _ in keys ]
+            appenders = [ (key, column.append) for key, column in zip(keys, columns) ]
+        for key, append in appenders:
+            append(reading[key])
+        count += 1
+        reading_time = reading[READING_TIME_KEY]
+        if reading_time == last_time:
+            run_length += 1
+        else:
+            last_time = reading_time
+            run_length = 1
+
+    if count == 0:
+        return { TIMES_KEY: [], WEIGHTS_KEY: [] }, None, 0, False
+    named = {}
+    for key, column in zip(keys, columns):
+        named[COLUMN_NAMES.get(key, key)] = column
+    return named, last_time, run_length, more
+
+def delta_encode(times):
+    """Returns the first time followed by the difference between each time and the one before it."""
+    if not times:
+        return []
+    return [ times[0] ] + [ later - earlier for earlier, later in zip(times, times[1:]) ]
+
+def encode_columns(columns, delta):
+    if delta:
+        columns[TIMES_KEY] = delta_encode(columns[TIMES_KEY])
+        columns[DELTA_KEY] = True
+    return json.dumps(columns, ensure_ascii=False)
+
+def stream_columns(readings, delta=False):
+    """Yields all of the readings as a JSON object of parallel arrays. The whole series is held in memory."""
+    columns, _, _, _ = collect_columns(readings)
+    yield encode_columns(columns, delta)
+
+def stream_columns_page(readings, limit, skip_time=None, skip=0, delta=False):
+    """Like stream_page, but with the page's readings as parallel arrays alongside the cursor."""
+    columns, last_time, run_length, more = collect_columns(skip_readings(readings, skip_time, skip), limit)
+    columns[CURSOR_KEY] = next_cursor(last_time, run_length, more, limit, skip_time, skip)
+    yield encode_columns(columns, delta)
+
+def stream(readings, response_format=FORMAT_ROWS, limit=None, skip_time=None, skip=0):
+    """Yields the readings in the given format, all of them or, if there is a limit, one page."""
+    if response_format == FORMAT_ROWS:
+        if limit is None:
+            return stream_list(readings)
+        return stream_page(readings, limit, skip_time, skip)
+    delta = response_format == FORMAT_DELTA
+    if limit is None:
+        return stream_columns(readings, delta)
+    return stream_columns_page(readings, limit, skip_time, skip, delta)
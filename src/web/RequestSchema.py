@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""Declarative validation of API request parameters.
+
+Each endpoint describes its parameters once, as a list of Field objects. The list is compiled, when the
+module is loaded, into a single pass validator that checks presence, validates and converts every field,
+so the handlers receive typed values and never touch the raw request. UUID, float and timestamp fields
+take fast paths that avoid the generic regular expression helpers.
+
+The same schema validates the items of a bulk upload, where each item is either a dictionary or a list
+of values in field order.
+"""
+
+import math
+import re
+from urllib.parse import unquote_plus
+import InputChecker
+
+TYPE_UUID = "uuid"
+TYPE_UUID_LIST = "uuid_list" # A list of UUIDs, or a comma separated string of them
+TYPE_EMAIL = "email"
+TYPE_TEXT = "text" # Any string
+TYPE_NAME = "name" # A string that passes InputChecker.is_valid_decoded_str
+TYPE_FLOAT = "float"
+TYPE_TIMESTAMP = "timestamp" # Seconds since the epoch, as a number or a numeric string
+TYPE_POSITIVE_INTEGER = "positive_integer"
+TYPE_LIST = "list"
+
+UUID_LENGTH = 36
+UUID_RE = re.compile("[a-fA-F0-9]{8}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{12}")
+AUTHENTICATION_MISSING = "missing" # Field.authentication value for a field whose absence, but not its content, is an authentication error
+MAX_TIMESTAMP = 32503680000.0 # The year 3000, anything later is a unit mistake (milliseconds, for example)
+
+class ValidationException(Exception):
+    """Exception thrown when a request does not match its schema."""
+
+    def __init__(self, message, authentication=False):
+        self.message = message
+        self.authentication = authentication # True if the failure should be reported as an authentication error
+        Exception.__init__(self, message)
+
+class Field(object):
+    """Describes one request parameter."""
+
+    def __init__(self, name, field_type, required=True, missing=None, invalid=None, authentication=False, unquote=False):
+        self.name = name
+        self.field_type = field_type
+        self.required = required
+        self.missing = missing or (name + " not specified.")
+        self.invalid = invalid or (name + " is invalid.")
+        self.authentication = authentication # True, AUTHENTICATION_MISSING or False
+        self.unquote = unquote # URL decode the value before checking it
+
+def convert_uuid(value):
+    if type(value) is str and len(value) == UUID_LENGTH and UUID_RE.fullmatch(value) is not None:
+        return value
+    raise ValueError()
+
+def convert_uuid_list(value):
+    if type(value) is str:
+        value = value.split(",")
+    if type(value) is not list or len(value) == 0:
+        raise ValueError()
+    return [ convert_uuid(item) for item in value ]
+
+def convert_email(value):
+    if type(value) is str and InputChecker.email_addr.fullmatch(value) is not None:
+        return value
+    raise ValueError()
+
+def convert_text(value):
+    if type(value) is str:
+        return value
+    raise ValueError()
+
+def convert_name(value):
+    if type(value) is str and InputChecker.is_valid_decoded_str(value):
+        return value
+    raise ValueError()
+
+def convert_float(value):
+    # JSON numbers arrive as floats or ints, query string values as strings. Booleans are not numbers here.
+    value_type = type(value)
+    if value_type is float:
+        result = value
+    elif value_type is int or value_type is str:
+        result = float(value)
+    else:
+        raise ValueError()
+    if not math.isfinite(result):
+        raise ValueError()
+    return result
+
+def convert_timestamp(value):
+    result = convert_float(value)
+    if result < 0.0 or result > MAX_TIMESTAMP:
+        raise ValueError()
+    return result
+
+def convert_positive_integer(value):
+    if type(value) is int:
+        result = value
+    elif type(value) is str and value.isdigit():
+        result = int(value)
+    else:
+        raise ValueError()
+    if result <= 0:
+        raise ValueError()
+    return result
+
+def convert_list(value):
+    if type(value) is list:
+        return value
+    raise ValueError()
+
+CONVERTERS = {
+    TYPE_UUID: convert_uuid,
+    TYPE_UUID_LIST: convert_uuid_list,
+    TYPE_EMAIL: convert_email,
+    TYPE_TEXT: convert_text,
+    TYPE_NAME: convert_name,
+    TYPE_FLOAT: convert_float,
+    TYPE_TIMESTAMP: convert_timestamp,
+    TYPE_POSITIVE_INTEGER: convert_positive_integer,
+    TYPE_LIST: convert_list,
+}
+
+MISSING = object()
+
+def unquoted(convert):
+    """Wraps a converter so that it URL decodes strings first."""
+    def convert_unquoted(value):
+        if type(value) is str:
+            value = unquote_plus(value)
+        return convert(value)
+    return convert_unquoted
+
+class Schema(object):
+    """A compiled list of fields."""
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.names = [ field.name for field in fields ]
+        self.steps = []
+        for field in fields:
+            convert = CONVERTERS[field.field_type]
+            if field.unquote:
+                convert = unquoted(convert)
+            missing_authentication = field.authentication is True or field.authentication == AUTHENTICATION_MISSING
+            invalid_authentication = field.authentication is True
+            self.steps.append((field.name, convert, field.required, field.missing, field.invalid, missing_authentication, invalid_authentication))
+        self.item_steps = [ (convert, invalid) for _, convert, _, _, invalid, _, _ in self.steps ]
+        self.item_length = len(self.steps)
+        self.shape_error = "Not a [" + ", ".join(self.names) + "] list."
+
+    def validate(self, values):
+        """Returns a dictionary of the converted values. Optional fields that were not given are left out.
+        Raises ValidationException for the first missing or invalid field."""
+        if not isinstance(values, dict):
+            values = {}
+        result = {}
+        for name, convert, required, missing, invalid, missing_authentication, invalid_authentication in self.steps:
+            value = values.get(name, MISSING)
+            if value is MISSING:
+                if required:
+                    raise ValidationException(missing, missing_authentication)
+                continue
+            try:
+                result[name] = convert(value)
+            except (TypeError, ValueError, OverflowError):
+                raise ValidationException(invalid, invalid_authentication)
+        return result
+
+    def validate_item(self, item):
+        """Validates one item of a bulk upload, a dictionary or a list of values in field order.
+        Returns a tuple of the converted values and None, or None and an error message."""
+        if isinstance(item, dict):
+            values = []
+            for name, _, _, missing, _, _, _ in self.steps:
+                value = item.get(name, MISSING)
+                if value is MISSING:
+                    return None, missing
+                values.append(value)
+        elif isinstance(item, (list, tuple)) and len(item) == self.item_length:
+            values = item
+        else:
+            return None, self.shape_error
+
+        result = []
+        index = 0
+        try:
+            for convert, _ in self.item_steps:
+                result.append(convert(values[index]))
+                index += 1
+        except (TypeError, ValueError, OverflowError):
+            return None, self.item_steps[index][1]
+        return tuple(result), None
+
+    def validate_items(self, items):
+        """Validates every item of a bulk upload. Returns a list of (tuple, error) pairs, as for validate_item."""
+        validate_item = self.validate_item
+        return [ validate_item(item) for item in items ]
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""Multi-resolution rollups of scale readings.
+
+For each device, min/max/sum/count and the most recent reading are kept for every 1 minute, 1 hour and
+1 day window. They are updated as readings are ingested, so a chart of any time span can be drawn from a
+bounded number of points instead of from every raw reading.
+"""
+
+import pymongo
+
+RESOLUTION_RAW = "raw"
+RESOLUTION_AUTO = "auto"
+RESOLUTIONS = { "1m": 60, "1h": 3600, "1d": 86400 } # Name -> window size, in seconds
+MAX_CHART_POINTS = 1000 # The auto resolution picks the finest resolution that stays under this many points
+
+# Keys used in the rollup documents.
+ROLLUP_DEVICE_ID_KEY = "device_id"
+ROLLUP_RESOLUTION_KEY = "res"
+ROLLUP_START_KEY = "start"
+ROLLUP_MIN_KEY = "min"
+ROLLUP_MAX_KEY = "max"
+ROLLUP_SUM_KEY = "sum"
+ROLLUP_COUNT_KEY = "count"
+ROLLUP_LAST_KEY = "last" # Embedded {t, w} document, so that $max keeps the latest reading
+ROLLUP_LAST_TIME_KEY = "t"
+ROLLUP_LAST_WEIGHT_KEY = "w"
+
+# Keys used in the points handed back to the caller.
+READING_KEY = "reading"
+READING_TIME_KEY = "reading_time"
+POINT_MIN_KEY = "min"
+POINT_MAX_KEY = "max"
+POINT_LAST_KEY = "last"
+POINT_COUNT_KEY = "count"
+
+def window_start(reading_time, window_secs):
+    """Returns the start of the window that contains the given time."""
+    return int(reading_time // window_secs) * window_secs
+
+def aggregate(readings):
+    """Combines a list of (device_id, reading, reading_time) tuples into one partial rollup per device, resolution and window.
+    Returns a dictionary of (device_id, window_secs, start) -> [min, max, sum, count, last_time, last]."""
+    partials = {}
+    for device_id, reading, reading_time in readings:
+        for window_secs in RESOLUTIONS.values():
+            key = (device_id, window_secs, window_start(reading_time, window_secs))
+            partial = partials.get(key)
+            if partial is None:
+                partials[key] = [ reading, reading, reading, 1, reading_time, reading ]
+            else:
+                if reading < partial[0]:
+                    partial[0] = reading
+                if reading > partial[1]:
+                    partial[1] = reading
+                partial[2] += reading
+                partial[3] += 1
+                if reading_time >= partial[4]:
+                    partial[4] = reading_time
+                    partial[5] = reading
+    return partials
+
+def summarize(readings):
+    """Combines a list of (device_id, reading, reading_time) tuples into a partial summary per device.
+    Returns a dictionary of device_id -> [count, last_time, last]."""
+    summaries = {}
+    for device_id, reading, reading_time in readings:
+        summary = summaries.get(device_id)
+        if summary is None:
+            summaries[device_id] = [ 1, reading_time, reading ]
+        else:
+            summary[0] += 1
+            if reading_time >= summary[1]:
+                summary[1] = reading_time
+                summary[2] = reading
+    return summaries
+
+def make_point(start, min_reading, max_reading, sum_reading, count, last_reading):
+    """Formats one rollup window for the API. The window's mean is used as the reading."""
+    return {
+        READING_TIME_KEY: start,
+        READING_KEY: sum_reading / count,
+        POINT_MIN_KEY: min_reading,
+        POINT_MAX_KEY: max_reading,
+        POINT_LAST_KEY: last_reading,
+        POINT_COUNT_KEY: count
+    }
+
+def parse_resolution(resolution):
+    """Converts a resolution name to a window size, in seconds. Returns None for raw and auto, raises ValueError if unknown."""
+    if resolution == RESOLUTION_RAW or resolution == RESOLUTION_AUTO:
+        return None
+    if resolution in RESOLUTIONS:
+        return RESOLUTIONS[resolution]
+    raise ValueError("Unknown resolution: " + str(resolution))
+
+def choose_resolution(first_time, last_time):
+    """Returns the finest window size that covers [first_time, last_time] in at most MAX_CHART_POINTS points."""
+    span = max(0.0, last_time - first_time)
+    for window_secs in sorted(RESOLUTIONS.values()):
+        if span / window_secs <= MAX_CHART_POINTS:
+            return window_secs
+    return max(RESOLUTIONS.values())
+
+class RollupStore(object):
+    """MongoDB storage for rollups, one document per device, resolution and window."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def create_indexes(self):
+        """Creates the index that identifies a rollup window. Updates and range queries are both served by it."""
+        self.collection.create_index([(ROLLUP_DEVICE_ID_KEY, pymongo.ASCENDING), (ROLLUP_RESOLUTION_KEY, pymongo.ASCENDING), (ROLLUP_START_KEY, pymongo.ASCENDING)], unique=True)
+
+    def update(self, readings):
+        """Folds a list of (device_id, reading, reading_time) tuples into the rollups, in one unordered bulk write."""
+        requests = []
+        for (device_id, window_secs, start), partial in aggregate(readings).items():
+            min_reading, max_reading, sum_reading, count, last_time, last_reading = partial
+            query = { ROLLUP_DEVICE_ID_KEY: device_id, ROLLUP_RESOLUTION_KEY: window_secs, ROLLUP_START_KEY: start }
+            update = {
+                "$min": { ROLLUP_MIN_KEY: min_reading },
+                "$max": { ROLLUP_MAX_KEY: max_reading, ROLLUP_LAST_KEY: { ROLLUP_LAST_TIME_KEY: last_time, ROLLUP_LAST_WEIGHT_KEY: last_reading } },
+                "$inc": { ROLLUP_SUM_KEY: sum_reading, ROLLUP_COUNT_KEY: count }
+            }
+            requests.append(pymongo.UpdateOne(query, update, upsert=True))
+        if len(requests) == 0:
+            return True
+        result = self.collection.bulk_write(requests, ordered=False)
+        return result.acknowledged
+
+    def iter_points(self, device_id, window_secs, start_time=None, end_time=None):
+        """Yields the rollup points for the device at the given resolution, in time order."""
+        query = { ROLLUP_DEVICE_ID_KEY: device_id, ROLLUP_RESOLUTION_KEY: window_secs }
+        start_range = {}
+        if start_time is not None:
+            start_range["$gte"] = window_start(start_time, window_secs)
+        if end_time is not None:
+            start_range["$lte"] = end_time
+        if start_range:
+            query[ROLLUP_START_KEY] = start_range
+
+        cursor = self.collection.find(query).sort(ROLLUP_START_KEY, pymongo.ASCENDING)
+        for rollup in cursor:
+            last = rollup[ROLLUP_LAST_KEY]
+            yield make_point(rollup[ROLLUP_START_KEY], rollup[ROLLUP_MIN_KEY], rollup[ROLLUP_MAX_KEY], rollup[ROLLUP_SUM_KEY], rollup[ROLLUP_COUNT_KEY], last[ROLLUP_LAST_WEIGHT_KEY])
+
+    def retrieve_first_time(self, device_id):
+        """Returns the start of the device's earliest daily rollup, or None if the device has no readings."""
+        query = { ROLLUP_DEVICE_ID_KEY: device_id, ROLLUP_RESOLUTION_KEY: max(RESOLUTIONS.values()) }
+        rollup = self.collection.find_one(query, sort=[(ROLLUP_START_KEY, pymongo.ASCENDING)])
+        if rollup is None:
+            return None
+        return rollup[ROLLUP_START_KEY]
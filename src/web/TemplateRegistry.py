@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Renders the mako page templates once, instead of on every request.
+
+The site's pages only depend on inputs that are fixed at startup (such as the root URL), so each one is
+rendered when it is registered and served as cached bytes with an ETag. A repeat visitor gets a 304 and
+nothing is rendered at all. In dev mode the template source is checked on each request and the page is
+rendered again when it changes.
+"""
+
+import flask
+import hashlib
+import os
+import threading
+from mako.template import Template
+
+STATIC_PAGE_MAX_AGE = 300 # Seconds a browser may use a static page before revalidating it
+
+class RegisteredTemplate(object):
+    """A page's template file and its rendered bytes."""
+
+    def __init__(self, file_name, static_args):
+        self.file_name = file_name
+        self.static_args = static_args # Render arguments
+        self.mtime = None
+        self.body = None
+        self.etag = None
+
+class TemplateRegistry(object):
+    """Holds the rendered pages of the site."""
+
+    def __init__(self, html_dir, module_dir, dev_mode=False):
+        self.html_dir = html_dir
+        self.module_dir = module_dir
+        self.dev_mode = dev_mode
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, static_args):
+        """Compiles the named template and renders it with static_args."""
+        registered = RegisteredTemplate(os.path.join(self.html_dir, name), static_args)
+        self.compile(registered)
+        self.templates[name] = registered
+
+    def compile(self, registered):
+        """(Re)compiles a template and renders it."""
+        mtime = os.path.getmtime(registered.file_name)
+        template = Template(filename=registered.file_name, module_directory=self.module_dir)
+        body = template.render(**registered.static_args).encode('utf-8')
+        registered.body = body
+        registered.etag = hashlib.sha1(body).hexdigest()
+        registered.mtime = mtime
+
+    def lookup(self, name):
+        """Returns the registered template, recompiling it first if in dev mode and the source has changed."""
+        registered = self.templates[name]
+        if self.dev_mode and os.path.getmtime(registered.file_name) != registered.mtime:
+            with self.lock:
+                if os.path.getmtime(registered.file_name) != registered.mtime:
+                    self.compile(registered)
+        return registered
+
+    def static_response(self, name, code=200):
+        """Returns a flask response for a page, or a 304 if the client already has it."""
+        registered = self.lookup(name)
+        if code == 200 and registered.etag in flask.request.if_none_match:
+            response = flask.Response(status=304)
+        else:
+            response = flask.Response(registered.body, status=code, mimetype='text/html')
+        response.set_etag(registered.etag)
+        if self.dev_mode:
+            response.cache_control.no_cache = True
+        else:
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_PAGE_MAX_AGE
+        return response
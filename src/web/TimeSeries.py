@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""Bucketed time-series storage for scale readings.
+
+Rather than storing one document per reading, readings are packed into one document per device per
+time window. Each bucket holds parallel arrays of timestamps and weights, so a day of 1 Hz data is
+24 small documents instead of 86,400, and a time range query only touches the buckets that overlap it.
+
+A device has at most one reading at any given time. Appends only match a bucket that doesn't already hold
+the reading's time, so a resent reading falls through to the upsert, which the unique bucket index then
+rejects with a duplicate key error instead of storing it twice.
+"""
+
+import pymongo
+
+DEFAULT_BUCKET_SECS = 3600
+
+# Keys used in the bucket documents.
+BUCKET_DEVICE_ID_KEY = "device_id"
+BUCKET_START_KEY = "start"
+BUCKET_COUNT_KEY = "count"
+BUCKET_FIRST_TIME_KEY = "first"
+BUCKET_LAST_TIME_KEY = "last"
+BUCKET_TIMES_KEY = "t"
+BUCKET_WEIGHTS_KEY = "w"
+
+# Keys used in the readings handed back to the caller.
+READING_KEY = "reading"
+READING_TIME_KEY = "reading_time"
+
+DUPLICATE_KEY_ERROR = 11000
+
+def bucket_start(reading_time, bucket_secs):
+    """Returns the start of the time window that contains the given time."""
+    return int(reading_time // bucket_secs) * bucket_secs
+
+class BucketedReadingStore(object):
+    """Stores readings in per-device, per-time-window bucket documents."""
+
+    def __init__(self, collection, bucket_secs=DEFAULT_BUCKET_SECS):
+        self.collection = collection
+        self.bucket_secs = bucket_secs
+
+    def create_indexes(self):
+        """Creates the index that identifies a bucket. Appends and range queries are both served by it."""
+        self.collection.create_index([(BUCKET_DEVICE_ID_KEY, pymongo.ASCENDING), (BUCKET_START_KEY, pymongo.ASCENDING)], unique=True)
+
+    def bucket_filter(self, device_id, reading_time):
+        """Returns the query that selects the bucket holding the given reading."""
+        return { BUCKET_DEVICE_ID_KEY: device_id, BUCKET_START_KEY: bucket_start(reading_time, self.bucket_secs) }
+
+    def bucket_update(self, times, weights):
+        """Returns the update that appends the given readings to a bucket, creating it if necessary."""
+        return {
+            "$push": { BUCKET_TIMES_KEY: { "$each": times }, BUCKET_WEIGHTS_KEY: { "$each": weights } },
+            "$inc": { BUCKET_COUNT_KEY: len(times) },
+            "$min": { BUCKET_FIRST_TIME_KEY: min(times) },
+            "$max": { BUCKET_LAST_TIME_KEY: max(times) }
+        }
+
+    def append(self, device_id, reading, reading_time):
+        """Appends a single reading. This is one upsert, regardless of how many readings are already stored.
+        Returns True if the reading was stored, or False if the device already has a reading at that time."""
+        query = self.bucket_filter(device_id, reading_time)
+        query[BUCKET_TIMES_KEY] = { "$ne": reading_time }
+        update = self.bucket_update([reading_time], [reading])
+        try:
+            self.collection.update_one(query, update, upsert=True)
+            return True
+        except pymongo.errors.DuplicateKeyError:
+            # Either the bucket already holds this time, or another writer created the bucket first. It exists
+            # either way, so try once more without the upsert.
+            return self.collection.update_one(query, update).modified_count > 0
+
+    def append_many(self, readings):
+        """Appends a list of (device_id, reading, reading_time) tuples. Readings that land in the same bucket
+        are combined into a single update and all of the updates are sent in one unordered bulk write.
+        Returns the readings that were stored, leaving out any at a time the device already has a reading for."""
+        buckets = {}
+        for device_id, reading, reading_time in readings:
+            key = (device_id, bucket_start(reading_time, self.bucket_secs))
+            if key not in buckets:
+                buckets[key] = {} # reading_time -> reading
+            buckets[key].setdefault(reading_time, reading) # The first of several readings at the same time wins
+        if len(buckets) == 0:
+            return []
+
+        keys = list(buckets.keys())
+        requests = []
+        for key in keys:
+            by_time = buckets[key]
+            times = list(by_time.keys())
+            query = { BUCKET_DEVICE_ID_KEY: key[0], BUCKET_START_KEY: key[1], BUCKET_TIMES_KEY: { "$nin": times } }
+            requests.append(pymongo.UpdateOne(query, self.bucket_update(times, list(by_time.values())), upsert=True))
+        conflicts = []
+        try:
+            self.collection.bulk_write(requests, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            for error in e.details["writeErrors"]:
+                if error["code"] != DUPLICATE_KEY_ERROR:
+                    raise
+                conflicts.append(error["index"])
+
+        # A group that conflicted holds at least one time the bucket already has. Its readings are appended one
+        # at a time, so that the rest of them still get stored.
+        stored = []
+        conflicted = set(conflicts)
+        for index, key in enumerate(keys):
+            device_id, by_time = key[0], buckets[key]
+            if index in conflicted:
+                for reading_time, reading in by_time.items():
+                    if self.append(device_id, reading, reading_time):
+                        stored.append((device_id, reading, reading_time))
+            else:
+                stored.extend((device_id, reading, reading_time) for reading_time, reading in by_time.items())
+        return stored
+
+    def iter_readings(self, device_id, start_time=None, end_time=None):
+        """Yields the readings for the device, in time order, optionally restricted to [start_time, end_time].
+        Only the buckets that overlap the requested range are read from the database."""
+        query = { BUCKET_DEVICE_ID_KEY: device_id }
+        bucket_range = {}
+        if start_time is not None:
+            bucket_range["$gte"] = bucket_start(start_time, self.bucket_secs)
+        if end_time is not None:
+            bucket_range["$lte"] = end_time
+        if bucket_range:
+            query[BUCKET_START_KEY] = bucket_range
+
+        projection = { BUCKET_TIMES_KEY: 1, BUCKET_WEIGHTS_KEY: 1 }
+        cursor = self.collection.find(query, projection).sort(BUCKET_START_KEY, pymongo.ASCENDING)
+        for bucket in cursor:
+
+            # Readings are appended in arrival order, which is almost always time order; sorting an
+            # already sorted list is linear.
+            pairs = sorted(zip(bucket[BUCKET_TIMES_KEY], bucket[BUCKET_WEIGHTS_KEY]), key=lambda pair: pair[0])
+            for reading_time, reading in pairs:
+                if start_time is not None and reading_time < start_time:
+                    continue
+                if end_time is not None and reading_time > end_time:
+                    break
+                yield { READING_TIME_KEY: reading_time, READING_KEY: reading }
+
+    def retrieve_latest(self, device_id):
+        """Returns the device's most recent reading, or None if it has none. Only the newest bucket is read."""
+        projection = { BUCKET_LAST_TIME_KEY: 1, BUCKET_TIMES_KEY: 1, BUCKET_WEIGHTS_KEY: 1 }
+        bucket = self.collection.find_one({ BUCKET_DEVICE_ID_KEY: device_id }, projection, sort=[(BUCKET_START_KEY, pymongo.DESCENDING)])
+        if bucket is None:
+            return None
+        last_time = bucket[BUCKET_LAST_TIME_KEY]
+        times = bucket[BUCKET_TIMES_KEY]
+        index = len(times) - 1 - times[::-1].index(last_time) # The last reading appended at that time
+        return { READING_TIME_KEY: last_time, READING_KEY: bucket[BUCKET_WEIGHTS_KEY][index] }
+
+    def delete_through(self, device_id, end_time):
+        """Deletes the device's buckets whose readings are all at or before end_time. A bucket that also holds later readings
+        is kept whole. Returns the number of buckets deleted."""
+        query = { BUCKET_DEVICE_ID_KEY: device_id, BUCKET_LAST_TIME_KEY: { "$lte": end_time } }
+        return self.collection.delete_many(query).deleted_count
+
+    def retrieve_readings(self, device_id, start_time=None, end_time=None):
+        """Returns the readings for the device as a list, in time order."""
+        return list(self.iter_readings(device_id, start_time, end_time))
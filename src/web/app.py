@@ -1,22 +1,41 @@
 #! /usr/bin/env python
 
 import argparse
-import bcrypt
+import atexit
+import BinaryFormat
+import Cache
+import ColdStorage
+import Compression
+import datetime
+import DuplicateFilter
 import flask
+import hashlib
+import inspect
 import json
+import KegEstimator
 import logging
 import mako
+import math
+import Metrics
 import os
+import PasswordHasher
+import PubSub
 import pymongo
+import RateLimiter
+import ReadingStream
+import RequestSchema
+import Rollups
 import sqlite3
 import sys
+import TemplateRegistry
+import threading
 import time
 import traceback
 import uuid
-import InputChecker
+import IngestFilter
+import IngestQueue
+import TimeSeries
 
-from urllib.parse import unquote_plus
-from mako.template import Template
 
 # Global variables
 g_app = None
@@ -27,12 +46,60 @@ ERROR_LOG = 'error.log'
 HTML_DIR = 'html'
 
 MIN_PASSWORD_LEN = 8
+DATABASE_MONGO = 'mongo'
+DATABASE_SQLITE = 'sqlite'
+DEFAULT_MONGO_URL = 'mongodb://127.0.0.1/?uuidRepresentation=pythonLegacy'
+DEFAULT_MONGO_DB_NAME = 'devicestatusdb'
+DEFAULT_SQLITE_FILE = 'devicestatus.sqlite'
+SQLITE_IDLE_CONNECTIONS = 8 # Connections kept open between requests for the next request to reuse, any more are closed
+SESSION_CACHE_VERSION_ID = "session_cache_version" # ID of the document in the sessions collection that stamps the session cache version
+PARAM_SESSION_CACHE_VERSION = "version"
+DEFAULT_SESSION_CACHE_SYNC_SECS = 1.0 # How often workers check the session cache version stamp, unless told otherwise
+MAX_BATCH_READINGS = 10000
+MAX_PAGE_READINGS = 100000
+DEVICE_OWNER_CACHE_SIZE = 100000
+DEVICE_OWNER_CACHE_TTL = 3600 # Seconds, a device's owner doesn't change once it is registered
+RESPONSE_CACHE_SIZE = 256 # Compressed device_status responses kept for unchanged series
+RESPONSE_CACHE_TTL = 300 # Seconds
+MAX_CACHED_RESPONSE_BYTES = 1 << 20 # Larger responses are not cached
+MAX_SQL_PARAMETERS = 500 # IN lists are split into chunks of this many, below SQLite's limit on bound parameters
+MAX_WATCH_DEVICES = 100 # Devices a single client can wait on
+MAX_WATCH_SECS = 30 # Longest a long-poll waits before answering with no changes
+MAX_EVENT_STREAM_SECS = 300 # Event streams are closed after this long, the client reconnects with its last event ID
+EVENT_KEEPALIVE_SECS = 15 # Comment lines sent on idle event streams so proxies don't close them, the database is checked as often
+LAST_EVENT_ID_HEADER = 'Last-Event-ID' # Sent by an event stream client that reconnects
+WATCH_RETRY_SECS = 5 # Retry-After sent to long-poll and event stream clients when the worker has no room for them
+API_METHODS = frozenset([ 'login', 'create_login', 'login_status', 'logout', 'device_status', 'device_estimate', 'device_summaries', 'register_device',
+    'update_device_status', 'update_device_status_batch', 'device_watch', 'device_events' ]) # Everything else is counted as 'other' in the metrics
+RATE_LIMITS = { # Requests per second and burst size, per device for uploads and per session for reads
+    'update_device_status': (2.0, 20),
+    'update_device_status_batch': (1.0, 10),
+    'login_status': (5.0, 20),
+    'device_status': (10.0, 30),
+    'device_estimate': (10.0, 30),
+    'device_summaries': (2.0, 10),
+    'device_watch': (2.0, 10),
+    'device_events': (0.5, 5) }
+ADDRESS_RATE_LIMIT_FACTOR = 10 # Budgets per client address are this many devices' or sessions' worth, for scales and phones behind one router
+LATE_READING_MESSAGE = "Reading time is too far behind the device's newest reading."
 DATABASE_ID_KEY = "_id"
 
 # Constants used with the API
 PARAM_DEVICE_ID = 'device_id'
 PARAM_READING = 'reading'
 PARAM_READING_TIME = 'reading_time'
+PARAM_READINGS = 'readings' # List of readings in a batch update
+PARAM_RESOLUTION = 'resolution' # raw, auto, 1m, 1h, or 1d
+PARAM_SINCE = 'since' # Start of a time range, inclusive
+PARAM_UNTIL = 'until' # End of a time range, inclusive
+PARAM_LIMIT = 'limit' # Maximum number of readings in a page
+PARAM_CURSOR = 'cursor' # Continuation cursor from the previous page
+PARAM_FORMAT = 'format' # rows (a list of objects), columns (parallel arrays), or delta (columns with delta encoded times)
+PARAM_DEVICE_IDS = 'device_ids' # Devices to watch, comma separated
+PARAM_TIMEOUT = 'timeout' # Seconds to wait for a change
+PARAM_DEVICES_STATUS = 'devices' # Latest reading per device in a watch response
+PARAM_CODE = 'code' # Per-item status code in a batch response
+PARAM_MESSAGE = 'message' # Per-item error message in a batch response
 PARAM_USERNAME = "username" # Login name for a user
 PARAM_REALNAME = "realname" # User's real name
 PARAM_PASSWORD = "password" # User's password
@@ -40,9 +107,51 @@ PARAM_PASSWORD1 = "password1" # User's password when creating an account
 PARAM_PASSWORD2 = "password2" # User's confirmation password when creating an account
 PARAM_SESSION_TOKEN = "session_token"
 PARAM_SESSION_EXPIRY = "session_expiry"
+PARAM_SESSION_EXPIRES_AT = "expires_at" # Session expiry as a date, for the TTL index
 PARAM_HASH_KEY = "hash" # Password hash
+PARAM_STATE = "state" # Persisted estimator state
+PARAM_COUNT = "count" # Number of readings stored for a device, in its summary
+PARAM_LAST = "last" # Embedded {t, w} document holding a device's latest reading, in its summary
 PARAM_DEVICES = "devices"
 
+# Request parameters for each API endpoint, compiled once into validators.
+Field = RequestSchema.Field
+SESSION_TOKEN_FIELD = Field(PARAM_SESSION_TOKEN, RequestSchema.TYPE_UUID, missing="Session token not specified.", invalid="Session token is invalid.", authentication=True)
+DEVICE_ID_FIELD = Field(PARAM_DEVICE_ID, RequestSchema.TYPE_UUID, missing="Device ID not specified.", invalid="Device ID is invalid.", authentication=True)
+LOGIN_SCHEMA = RequestSchema.Schema([
+    Field(PARAM_USERNAME, RequestSchema.TYPE_EMAIL, missing="Username not specified.", invalid="Invalid email address.", authentication=True, unquote=True),
+    Field(PARAM_PASSWORD, RequestSchema.TYPE_TEXT, missing="Password not specified.", authentication=True, unquote=True)])
+CREATE_LOGIN_SCHEMA = RequestSchema.Schema([ # A missing field is an authentication error, as for a login, but a malformed one is not
+    Field(PARAM_USERNAME, RequestSchema.TYPE_EMAIL, missing="Username not specified.", invalid="Invalid email address.", authentication=RequestSchema.AUTHENTICATION_MISSING, unquote=True),
+    Field(PARAM_REALNAME, RequestSchema.TYPE_NAME, missing="Real name not specified.", invalid="Invalid name.", authentication=RequestSchema.AUTHENTICATION_MISSING, unquote=True),
+    Field(PARAM_PASSWORD1, RequestSchema.TYPE_TEXT, missing="Password not specified.", authentication=RequestSchema.AUTHENTICATION_MISSING, unquote=True),
+    Field(PARAM_PASSWORD2, RequestSchema.TYPE_TEXT, missing="Password confirmation not specified.", authentication=RequestSchema.AUTHENTICATION_MISSING, unquote=True)])
+SESSION_SCHEMA = RequestSchema.Schema([ SESSION_TOKEN_FIELD ])
+DEVICE_SCHEMA = RequestSchema.Schema([ SESSION_TOKEN_FIELD, DEVICE_ID_FIELD ])
+DEVICE_STATUS_SCHEMA = RequestSchema.Schema([
+    SESSION_TOKEN_FIELD,
+    DEVICE_ID_FIELD,
+    Field(PARAM_RESOLUTION, RequestSchema.TYPE_TEXT, required=False, invalid="Resolution is invalid."),
+    Field(PARAM_SINCE, RequestSchema.TYPE_TIMESTAMP, required=False, invalid="Time range is invalid."),
+    Field(PARAM_UNTIL, RequestSchema.TYPE_TIMESTAMP, required=False, invalid="Time range is invalid."),
+    Field(PARAM_LIMIT, RequestSchema.TYPE_POSITIVE_INTEGER, required=False, invalid="Limit is invalid."),
+    Field(PARAM_CURSOR, RequestSchema.TYPE_TEXT, required=False, invalid="Cursor is invalid."),
+    Field(PARAM_FORMAT, RequestSchema.TYPE_TEXT, required=False, invalid="Format is invalid.")])
+DEVICE_WATCH_SCHEMA = RequestSchema.Schema([
+    SESSION_TOKEN_FIELD,
+    Field(PARAM_DEVICE_IDS, RequestSchema.TYPE_UUID_LIST, missing="Device IDs not specified.", invalid="Device IDs are invalid.", authentication=True),
+    Field(PARAM_SINCE, RequestSchema.TYPE_TIMESTAMP, required=False, invalid="Since is invalid."),
+    Field(PARAM_TIMEOUT, RequestSchema.TYPE_POSITIVE_INTEGER, required=False, invalid="Timeout is invalid.")])
+READING_FIELDS = [
+    Field(PARAM_DEVICE_ID, RequestSchema.TYPE_UUID, invalid="Device ID is invalid."),
+    Field(PARAM_READING, RequestSchema.TYPE_FLOAT, missing="Reading not specified.", invalid="Reading is invalid."),
+    Field(PARAM_READING_TIME, RequestSchema.TYPE_TIMESTAMP, missing="Reading time not specified.", invalid="Reading time is invalid.")]
+UPDATE_DEVICE_STATUS_SCHEMA = RequestSchema.Schema([ SESSION_TOKEN_FIELD, DEVICE_ID_FIELD ] + READING_FIELDS[1:])
+BATCH_READING_SCHEMA = RequestSchema.Schema(READING_FIELDS) # Each item of a batch update
+UPDATE_DEVICE_STATUS_BATCH_SCHEMA = RequestSchema.Schema([
+    SESSION_TOKEN_FIELD,
+    Field(PARAM_READINGS, RequestSchema.TYPE_LIST, missing="Readings not specified.", invalid="Readings must be a list.")])
+
 class ApiException(Exception):
     """Exception thrown by a REST API."""
 
@@ -72,6 +181,33 @@ class ApiNotLoggedInException(ApiException):
     def __init__(self):
         ApiException.__init__(self, 403, "Not logged in")
 
+class ApiForbiddenException(ApiException):
+    """Exception thrown by a REST API when the user is logged in, but not allowed to do what was asked."""
+
+    def __init__(self, message):
+        ApiException.__init__(self, 403, message)
+
+class ApiNotModifiedException(ApiException):
+    """Exception thrown by a REST API when the client's cached copy of the response is still current."""
+
+    def __init__(self, etag):
+        self.etag = etag
+        ApiException.__init__(self, 304, "Not modified")
+
+class ApiTooManyRequestsException(ApiException):
+    """Exception thrown by a REST API when the server is too busy to accept the request."""
+
+    def __init__(self, message, retry_after=1):
+        self.retry_after = retry_after
+        ApiException.__init__(self, 429, message)
+
+class ApiServiceUnavailableException(ApiException):
+    """Exception thrown by a REST API when the server can't take on the request right now, but will soon."""
+
+    def __init__(self, message, retry_after=1):
+        self.retry_after = retry_after
+        ApiException.__init__(self, 503, message)
+
 class DatabaseException(Exception):
     """Exception thrown by a REST API when the user is not logged in."""
 
@@ -82,18 +218,49 @@ class DatabaseException(Exception):
         self.message = message
         Exception.__init__(self, message)
 
+class DuplicateUserException(DatabaseException):
+    """Exception thrown when creating a user that already exists."""
+
+    def __init__(self):
+        DatabaseException.__init__(self, "The user already exists.")
+
 class Database(object):
     """Base class for a database. Encapsulates common functionality."""
     db_file = ""
+    reaps_expired_sessions = False # True if the database deletes expired sessions on its own
 
     def __init__(self):
         super(Database, self).__init__()
+        self.duplicate_lock = threading.Lock()
+        self.duplicate_count = 0 # Readings not stored because the device already had a reading at that time
+        self.cold_store = None # Where readings that were archived out of the database are read from, if anywhere
+
+    def merge_cold_readings(self, device_id, start_time, end_time, readings):
+        """Merges the device's archived readings in the range into readings from the database."""
+        if self.cold_store is None:
+            return readings
+        return ColdStorage.merge(self.cold_store.iter_readings(device_id, start_time, end_time), readings)
+
+    def release(self):
+        """Called when a request is finished with the database. Databases that hold a connection per thread give it back here."""
+        pass
+
+    def count_duplicates(self, count):
+        """Adds to the number of readings that were not stored because they were already there."""
+        if count > 0:
+            with self.duplicate_lock:
+                self.duplicate_count += count
 
     def log_error(self, log_str):
         """Writes an error message to the log file."""
         logger = logging.getLogger()
         logger.error(log_str)
 
+    def log_info(self, log_str):
+        """Writes an informational message to the log file."""
+        logger = logging.getLogger()
+        logger.info(log_str)
+
     def is_quoted(self, log_str):
         """Determines if the provided string starts and ends with a double quote."""
         if len(log_str) < 2:
@@ -131,18 +298,21 @@ def update_collection(collection, doc):
 
 class AppMongoDatabase(Database):
     """Mongo DB implementation of the application database."""
+    reaps_expired_sessions = True # Through the TTL index on the sessions collection
 
-    def __init__(self):
+    def __init__(self, url=DEFAULT_MONGO_URL, database_name=DEFAULT_MONGO_DB_NAME):
         Database.__init__(self)
+        self.url = url
+        self.database_name = database_name
 
     def connect(self):
         """Connects/creates the database"""
         try:
             # Connect.
-            self.conn = pymongo.MongoClient('mongodb://127.0.0.1/?uuidRepresentation=pythonLegacy')
+            self.conn = pymongo.MongoClient(self.url)
 
             # Database.
-            self.database = self.conn['devicestatusdb']
+            self.database = self.conn[self.database_name]
             if self.database is None:
                 raise DatabaseException("Could not connect to MongoDB.")
 
@@ -150,9 +320,50 @@ class AppMongoDatabase(Database):
             self.users_collection = self.database['users']
             self.status_collection = self.database['status']
             self.sessions_collection = self.database['sessions']
+
+            # Readings are packed into per-device, per-time-window buckets in the status collection.
+            self.reading_store = TimeSeries.BucketedReadingStore(self.status_collection)
+
+            # Min/max/mean/last of the readings at several resolutions, maintained as readings arrive.
+            self.rollups_collection = self.database['rollups']
+            self.rollup_store = Rollups.RollupStore(self.rollups_collection)
+
+            # Periodic snapshots of the per-device time-to-empty estimators.
+            self.estimators_collection = self.database['estimators']
+
+            # Count and latest reading per device, updated after each write so it can serve as a cache validator.
+            self.summaries_collection = self.database['summaries']
+
+            # The owner of each device, so checking ownership doesn't mean loading the whole user document.
+            self.devices_collection = self.database['devices']
+
+            self.create_indexes()
         except pymongo.errors.ConnectionFailure as e:
             raise DatabaseException("Could not connect to MongoDB: %s" % e)
 
+    def create_indexes(self):
+        """Makes sure every lookup the app performs is served by an index. Creating an index that already exists is a no-op."""
+        start_time = time.time()
+        self.users_collection.create_index(PARAM_USERNAME, unique=True)
+        self.sessions_collection.create_index(PARAM_SESSION_TOKEN, unique=True)
+        self.sessions_collection.create_index(PARAM_SESSION_EXPIRES_AT, expireAfterSeconds=0) # MongoDB deletes sessions once they expire
+        self.reading_store.create_indexes() # Unique on (device_id, bucket start), which also serves range queries
+        self.rollup_store.create_indexes()
+        self.estimators_collection.create_index(PARAM_DEVICE_ID, unique=True)
+        self.summaries_collection.create_index(PARAM_DEVICE_ID, unique=True)
+        self.devices_collection.create_index(PARAM_DEVICE_ID, unique=True)
+        self.devices_collection.create_index(PARAM_USERNAME)
+        self.log_info("Created MongoDB indexes in %.3f seconds." % (time.time() - start_time))
+
+    def ping(self):
+        """Returns True if the database is reachable."""
+        try:
+            self.conn.admin.command('ping')
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+        return False
+
     #
     # User management methods
     #
@@ -175,16 +386,1064 @@ class AppMongoDatabase(Database):
         try:
             post = { PARAM_USERNAME: username, PARAM_REALNAME: realname, PARAM_HASH_KEY: passhash, PARAM_DEVICES: [] }
             return insert_into_collection(self.users_collection, post)
+        except pymongo.errors.DuplicateKeyError:
+            raise DuplicateUserException()
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def retrieve_user(self, username):
+        """Retrieve method for a user. Returns the password hash and real name, or None, None if the user does not exist."""
+        if username is None:
+            raise Exception("Unexpected empty object: username")
+        if len(username) == 0:
+            raise Exception("username too short")
+
+        try:
+            user = self.users_collection.find_one({ PARAM_USERNAME: username })
+            if user is not None:
+                return user[PARAM_HASH_KEY], user[PARAM_REALNAME]
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None, None
+
+    #
+    # Device management methods
+    #
+
+    def create_device(self, device_id, username):
+        """Registers a device to a user, unless it already has an owner. Returns the device's owner, or None on error."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+        if username is None:
+            raise Exception("Unexpected empty object: username")
+
+        try:
+            result = self.devices_collection.update_one({ PARAM_DEVICE_ID: device_id }, { "$setOnInsert": { PARAM_USERNAME: username } }, upsert=True)
+            if result.upserted_id is None:
+                return self.retrieve_device_owner(device_id)
+
+            # Keep the list in the user document in step.
+            self.users_collection.update_one({ PARAM_USERNAME: username }, { "$addToSet": { PARAM_DEVICES: device_id } })
+            return username
+        except pymongo.errors.DuplicateKeyError:
+            return self.retrieve_device_owner(device_id) # Registered by another request at the same moment
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def retrieve_device_owner(self, device_id):
+        """Retrieve method for the username of a device's owner. Returns None if the device isn't registered."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+
+        try:
+            device_data = self.devices_collection.find_one({ PARAM_DEVICE_ID: device_id })
+            if device_data is not None:
+                return device_data[PARAM_USERNAME]
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    #
+    # Session management methods
+    #
+
+    def create_session_token(self, username, session_token, expiry):
+        """Create method for a session token."""
+        if username is None:
+            raise Exception("Unexpected empty object: username")
+        if session_token is None:
+            raise Exception("Unexpected empty object: session_token")
+        if expiry is None:
+            raise Exception("Unexpected empty object: expiry")
+
+        try:
+            expires_at = datetime.datetime.fromtimestamp(expiry, datetime.timezone.utc)
+            post = { PARAM_USERNAME: username, PARAM_SESSION_TOKEN: session_token, PARAM_SESSION_EXPIRY: expiry, PARAM_SESSION_EXPIRES_AT: expires_at }
+            return insert_into_collection(self.sessions_collection, post)
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def retrieve_session_token(self, session_token):
+        """Retrieve method for session data. Returns the username and expiry, or None, None if the token is unknown."""
+        if session_token is None:
+            raise Exception("Unexpected empty object: session_token")
+
+        try:
+            session_data = self.sessions_collection.find_one({ PARAM_SESSION_TOKEN: session_token })
+            if session_data is not None:
+                return session_data[PARAM_USERNAME], session_data[PARAM_SESSION_EXPIRY]
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None, None
+
+    def delete_session_token(self, session_token):
+        """Delete method for a session token."""
+        if session_token is None:
+            raise Exception("Unexpected empty object: session_token")
+
+        try:
+            result = self.sessions_collection.delete_one({ PARAM_SESSION_TOKEN: session_token })
+            return result.deleted_count > 0
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def retrieve_session_cache_version(self):
+        """Returns the version stamp that processes use to tell each other to drop their session caches."""
+        try:
+            version_data = self.sessions_collection.find_one({ DATABASE_ID_KEY: SESSION_CACHE_VERSION_ID })
+            if version_data is not None:
+                return version_data[PARAM_SESSION_CACHE_VERSION]
+            return 0
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def increment_session_cache_version(self):
+        """Bumps the session cache version stamp, invalidating the session caches of every process."""
+        try:
+            query = { DATABASE_ID_KEY: SESSION_CACHE_VERSION_ID }
+            result = self.sessions_collection.update_one(query, { "$inc": { PARAM_SESSION_CACHE_VERSION: 1 } }, upsert=True)
+            return result.acknowledged
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    #
+    # Reading management methods
+    #
+
+    def create_reading(self, device_id, reading, reading_time):
+        """Create method for a scale reading."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+        if reading is None:
+            raise Exception("Unexpected empty object: reading")
+        if reading_time is None:
+            raise Exception("Unexpected empty object: reading_time")
+
+        try:
+            reading = float(reading)
+            reading_time = float(reading_time)
+            if not self.reading_store.append(device_id, reading, reading_time):
+                self.count_duplicates(1)
+                return True # Already stored, and already counted in the rollups and summary
+            if not self.rollup_store.update([(device_id, reading, reading_time)]):
+                return False
+            return self.update_summaries([(device_id, reading, reading_time)])
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def create_readings(self, readings):
+        """Create method for a list of (device_id, reading, reading_time) tuples, written in a single bulk operation.
+        Readings at a time the device already has a reading for are skipped."""
+        if readings is None:
+            raise Exception("Unexpected empty object: readings")
+
+        try:
+            stored = self.reading_store.append_many(readings)
+            self.count_duplicates(len(readings) - len(stored))
+            if len(stored) == 0:
+                return True
+            if not self.rollup_store.update(stored):
+                return False
+            return self.update_summaries(stored)
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def retrieve_readings(self, device_id, start_time=None, end_time=None):
+        """Retrieve method for the readings from a device, optionally restricted to a time range."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+
+        try:
+            readings = self.reading_store.iter_readings(device_id, start_time, end_time)
+            return list(self.merge_cold_readings(device_id, start_time, end_time, readings))
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return []
+
+    def iter_readings(self, device_id, start_time=None, end_time=None):
+        """Like retrieve_readings, but yields the readings as the database returns them. Errors are logged and raised."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+
+        try:
+            readings = self.reading_store.iter_readings(device_id, start_time, end_time)
+            yield from self.merge_cold_readings(device_id, start_time, end_time, readings)
+        except Exception: # Not GeneratorExit, the client may stop reading early
+            # Raised again, so that a response that has already started is cut off rather than looking complete.
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+            raise
+
+    def scan_readings(self, device_id, after_time, end_time, limit):
+        """Returns up to limit of the device's oldest readings after after_time (None for the first) and before end_time, as a
+        list of (reading_time, reading) tuples in time order. Unlike iter_readings, errors are raised rather than logged,
+        so that a failed read can't be mistaken for the end of the readings."""
+        readings = []
+        for reading in self.reading_store.iter_readings(device_id, after_time, end_time):
+            reading_time = reading[TimeSeries.READING_TIME_KEY]
+            if after_time is not None and reading_time <= after_time:
+                continue
+            if reading_time >= end_time or len(readings) >= limit:
+                break
+            readings.append((reading_time, reading[TimeSeries.READING_KEY]))
+        return readings
+
+    def delete_readings(self, device_id, end_time):
+        """Delete method for the readings from a device that were taken at or before end_time. Readings that share a bucket
+        with later ones are kept. The rollups and the summary are left as they are."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+        if end_time is None:
+            raise Exception("Unexpected empty object: end_time")
+
+        try:
+            self.reading_store.delete_through(device_id, end_time)
+            return True
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
         return False
 
+    def retrieve_device_ids(self):
+        """Retrieve method for the IDs of every device that has readings."""
+        try:
+            return self.summaries_collection.distinct(PARAM_DEVICE_ID)
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return []
+
+    def retrieve_rollups(self, device_id, window_secs, start_time=None, end_time=None):
+        """Retrieve method for a device's rollups at the given resolution, optionally restricted to a time range."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+
+        try:
+            return list(self.rollup_store.iter_points(device_id, window_secs, start_time, end_time))
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return []
+
+    def iter_rollups(self, device_id, window_secs, start_time=None, end_time=None):
+        """Like retrieve_rollups, but yields the points as the database returns them. Errors are logged and raised."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+
+        try:
+            yield from self.rollup_store.iter_points(device_id, window_secs, start_time, end_time)
+        except Exception: # Not GeneratorExit, the client may stop reading early
+            # Raised again, so that a response that has already started is cut off rather than looking complete.
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+            raise
+
+    def retrieve_first_reading_time(self, device_id):
+        """Returns approximately (to the day) when the device's first reading was taken, or None if there are no readings."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+
+        try:
+            return self.rollup_store.retrieve_first_time(device_id)
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def update_summaries(self, readings):
+        """Folds a list of (device_id, reading, reading_time) tuples into the device summaries. Written after the readings
+        themselves, so a summary never claims readings that can't be read yet."""
+        requests = []
+        for device_id, (count, last_time, last_reading) in Rollups.summarize(readings).items():
+            update = {
+                "$inc": { PARAM_COUNT: count },
+                "$max": { PARAM_LAST: { Rollups.ROLLUP_LAST_TIME_KEY: last_time, Rollups.ROLLUP_LAST_WEIGHT_KEY: last_reading } }
+            }
+            requests.append(pymongo.UpdateOne({ PARAM_DEVICE_ID: device_id }, update, upsert=True))
+        if len(requests) == 0:
+            return True
+        return self.summaries_collection.bulk_write(requests, ordered=False).acknowledged
+
+    def retrieve_device_summary(self, device_id):
+        """Returns a dictionary of the number of readings stored for the device and its latest reading, or None if there is no summary.
+        Devices whose readings predate the summaries get one with their next reading."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+
+        try:
+            summary = self.summaries_collection.find_one({ PARAM_DEVICE_ID: device_id })
+            if summary is not None:
+                last = summary[PARAM_LAST]
+                return { PARAM_COUNT: summary[PARAM_COUNT], PARAM_READING_TIME: last[Rollups.ROLLUP_LAST_TIME_KEY], PARAM_READING: last[Rollups.ROLLUP_LAST_WEIGHT_KEY] }
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def retrieve_user_device_summaries(self, username):
+        """Returns a dictionary of device_id -> summary (as from retrieve_device_summary) for every device the user owns, with None
+        for devices that have no readings. One aggregation joins the user's devices to their summaries."""
+        if username is None:
+            raise Exception("Unexpected empty object: username")
+
+        try:
+            pipeline = [
+                { "$match": { PARAM_USERNAME: username } },
+                { "$lookup": { "from": self.summaries_collection.name, "localField": PARAM_DEVICE_ID, "foreignField": PARAM_DEVICE_ID, "as": "summary" } },
+                { "$project": { DATABASE_ID_KEY: 0, PARAM_DEVICE_ID: 1, "summary." + PARAM_COUNT: 1, "summary." + PARAM_LAST: 1 } }
+            ]
+            summaries = {}
+            for device_data in self.devices_collection.aggregate(pipeline):
+                summary = None
+                if device_data["summary"]:
+                    found = device_data["summary"][0]
+                    last = found[PARAM_LAST]
+                    summary = { PARAM_COUNT: found[PARAM_COUNT], PARAM_READING_TIME: last[Rollups.ROLLUP_LAST_TIME_KEY], PARAM_READING: last[Rollups.ROLLUP_LAST_WEIGHT_KEY] }
+                summaries[device_data[PARAM_DEVICE_ID]] = summary
+            return summaries
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def retrieve_latest_reading(self, device_id):
+        """Returns the device's most recent reading, or None if there are no readings."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+
+        summary = self.retrieve_device_summary(device_id)
+        if summary is not None:
+            return { PARAM_READING_TIME: summary[PARAM_READING_TIME], PARAM_READING: summary[PARAM_READING] }
+        try:
+            return self.reading_store.retrieve_latest(device_id)
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    #
+    # Estimator methods
+    #
+
+    def retrieve_estimator_state(self, device_id):
+        """Retrieve method for a device's persisted estimator state. Returns None if there isn't one."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+
+        try:
+            estimator_data = self.estimators_collection.find_one({ PARAM_DEVICE_ID: device_id })
+            if estimator_data is not None:
+                return estimator_data[PARAM_STATE]
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def retrieve_estimator_states(self, device_ids):
+        """Retrieve method for the persisted estimator states of a list of devices, in one query. Returns a dictionary of
+        device_id -> state, leaving out devices that don't have one, or None on error."""
+        if device_ids is None:
+            raise Exception("Unexpected empty object: device_ids")
+
+        try:
+            cursor = self.estimators_collection.find({ PARAM_DEVICE_ID: { "$in": list(device_ids) } })
+            return { estimator_data[PARAM_DEVICE_ID]: estimator_data[PARAM_STATE] for estimator_data in cursor }
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def update_estimator_states(self, states):
+        """Update method for a dictionary of device ID -> estimator state, written in one bulk operation."""
+        if states is None:
+            raise Exception("Unexpected empty object: states")
+
+        try:
+            requests = []
+            for device_id, state in states.items():
+                doc = { PARAM_DEVICE_ID: device_id, PARAM_STATE: state }
+                requests.append(pymongo.ReplaceOne({ PARAM_DEVICE_ID: device_id }, doc, upsert=True))
+            result = self.estimators_collection.bulk_write(requests, ordered=False)
+            return result.acknowledged
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def swap_estimator_state(self, device_id, last_time, state):
+        """Replaces a device's estimator state, but only if the time of the last reading in the stored state is last_time
+        (None if there shouldn't be a stored state yet). Returns True if it was replaced, False if it had been changed,
+        or None on error."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+        if state is None:
+            raise Exception("Unexpected empty object: state")
+
+        try:
+            if last_time is None:
+                self.estimators_collection.insert_one({ PARAM_DEVICE_ID: device_id, PARAM_STATE: state })
+                return True
+            query = { PARAM_DEVICE_ID: device_id, PARAM_STATE + "." + str(KegEstimator.STATE_LAST_TIME_INDEX): last_time }
+            result = self.estimators_collection.update_one(query, { "$set": { PARAM_STATE: state } })
+            return result.matched_count > 0
+        except pymongo.errors.DuplicateKeyError:
+            return False
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+class AppSqliteDatabase(Database):
+    """SQLite implementation of the application database, for single-keg sites that don't want to run a mongod."""
+
+    def __init__(self, db_file):
+        Database.__init__(self)
+        self.db_file = db_file
+        self.local = threading.local() # The connection the thread is using, a connection is only used by one thread at a time
+        self.idle_lock = threading.Lock()
+        self.idle = [] # Open connections that no thread is using
+
+        # Table names.
+        self.users_table = self.quote_identifier("users")
+        self.sessions_table = self.quote_identifier("sessions")
+        self.readings_table = self.quote_identifier("readings")
+        self.settings_table = self.quote_identifier("settings")
+        self.rollups_table = self.quote_identifier("rollups")
+        self.estimators_table = self.quote_identifier("estimators")
+        self.summaries_table = self.quote_identifier("summaries")
+        self.devices_table = self.quote_identifier("devices")
+
+        # The statements are built once so that sqlite3's per-connection statement cache always hits.
+        self.insert_user_sql = "INSERT INTO " + self.users_table + " (username, realname, hash) VALUES (?, ?, ?)"
+        self.select_user_sql = "SELECT hash, realname FROM " + self.users_table + " WHERE username = ?"
+        self.insert_device_sql = "INSERT OR IGNORE INTO " + self.devices_table + " (device_id, username) VALUES (?, ?)"
+        self.select_device_owner_sql = "SELECT username FROM " + self.devices_table + " WHERE device_id = ?"
+        self.insert_session_sql = "INSERT OR REPLACE INTO " + self.sessions_table + " (session_token, username, session_expiry) VALUES (?, ?, ?)"
+        self.select_session_sql = "SELECT username, session_expiry FROM " + self.sessions_table + " WHERE session_token = ?"
+        self.delete_session_sql = "DELETE FROM " + self.sessions_table + " WHERE session_token = ?"
+        self.select_setting_sql = "SELECT value FROM " + self.settings_table + " WHERE name = ?"
+        self.increment_setting_sql = "INSERT INTO " + self.settings_table + " (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1"
+        self.insert_reading_sql = "INSERT OR IGNORE INTO " + self.readings_table + " (device_id, reading_time, reading) VALUES (?, ?, ?)"
+        self.select_readings_sql = "SELECT reading_time, reading FROM " + self.readings_table + " WHERE device_id = ? AND reading_time >= ? AND reading_time <= ? ORDER BY reading_time"
+        self.upsert_rollup_sql = "INSERT INTO " + self.rollups_table + " (device_id, resolution, start, min_reading, max_reading, sum_reading, count, last_time, last_reading) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)" \
+            " ON CONFLICT(device_id, resolution, start) DO UPDATE SET min_reading = min(min_reading, excluded.min_reading), max_reading = max(max_reading, excluded.max_reading)," \
+            " sum_reading = sum_reading + excluded.sum_reading, count = count + excluded.count," \
+            " last_reading = CASE WHEN excluded.last_time >= last_time THEN excluded.last_reading ELSE last_reading END, last_time = max(last_time, excluded.last_time)"
+        self.select_rollups_sql = "SELECT start, min_reading, max_reading, sum_reading, count, last_reading FROM " + self.rollups_table + " WHERE device_id = ? AND resolution = ? AND start >= ? AND start <= ? ORDER BY start"
+        self.scan_readings_sql = "SELECT reading_time, reading FROM " + self.readings_table + " WHERE device_id = ? AND reading_time > ? AND reading_time < ? ORDER BY reading_time LIMIT ?"
+        self.delete_readings_sql = "DELETE FROM " + self.readings_table + " WHERE device_id = ? AND reading_time <= ?"
+        self.select_device_ids_sql = "SELECT device_id FROM " + self.summaries_table
+        self.select_latest_reading_sql = "SELECT reading_time, reading FROM " + self.readings_table + " WHERE device_id = ? ORDER BY reading_time DESC LIMIT 1"
+        self.select_first_rollup_sql = "SELECT MIN(start) FROM " + self.rollups_table + " WHERE device_id = ? AND resolution = ?"
+        self.upsert_summary_sql = "INSERT INTO " + self.summaries_table + " (device_id, count, reading_time, reading) VALUES (?, ?, ?, ?)" \
+            " ON CONFLICT(device_id) DO UPDATE SET count = count + excluded.count," \
+            " reading = CASE WHEN excluded.reading_time >= reading_time THEN excluded.reading ELSE reading END, reading_time = max(reading_time, excluded.reading_time)"
+        self.select_summary_sql = "SELECT count, reading_time, reading FROM " + self.summaries_table + " WHERE device_id = ?"
+        self.select_user_summaries_sql = "SELECT d.device_id, s.count, s.reading_time, s.reading FROM " + self.devices_table + " d" \
+            " LEFT JOIN " + self.summaries_table + " s ON s.device_id = d.device_id WHERE d.username = ?"
+        self.select_estimator_sql = "SELECT state FROM " + self.estimators_table + " WHERE device_id = ?"
+        self.select_estimators_sql = "SELECT device_id, state FROM " + self.estimators_table + " WHERE device_id IN (%s)"
+        self.upsert_estimator_sql = "INSERT OR REPLACE INTO " + self.estimators_table + " (device_id, state) VALUES (?, ?)"
+        self.insert_estimator_sql = "INSERT OR IGNORE INTO " + self.estimators_table + " (device_id, state) VALUES (?, ?)"
+        self.swap_estimator_sql = "UPDATE " + self.estimators_table + " SET state = ? WHERE device_id = ? AND json_extract(state, '$[%u]') = ?" % KegEstimator.STATE_LAST_TIME_INDEX
+
+    def connection(self):
+        """Returns this thread's connection. A thread that doesn't have one takes an idle one, or opens a new one if there are
+        none. Request threads hand theirs back in release, other threads keep theirs."""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            with self.idle_lock:
+                if len(self.idle) > 0:
+                    conn = self.idle.pop()
+            if conn is None:
+                # Connections move between threads, but are never used by two at once.
+                conn = sqlite3.connect(self.db_file, timeout=30.0, cached_statements=256, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def release(self):
+        """Takes this thread's connection back, so that the development server, which starts a thread per request, doesn't
+        leave a connection open for every request it has served. Up to SQLITE_IDLE_CONNECTIONS are kept for reuse."""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            return
+        self.local.conn = None
+        if conn.in_transaction:
+            conn.rollback()
+        with self.idle_lock:
+            if len(self.idle) < SQLITE_IDLE_CONNECTIONS:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def connect(self):
+        """Connects/creates the database"""
+        try:
+            conn = self.connection()
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS " + self.users_table + " (username TEXT PRIMARY KEY, realname TEXT NOT NULL, hash BLOB NOT NULL)")
+                conn.execute("CREATE TABLE IF NOT EXISTS " + self.sessions_table + " (session_token TEXT PRIMARY KEY, username TEXT NOT NULL, session_expiry INTEGER NOT NULL)")
+                conn.execute("CREATE TABLE IF NOT EXISTS " + self.settings_table + " (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+                conn.execute("CREATE TABLE IF NOT EXISTS " + self.rollups_table + " (device_id TEXT NOT NULL, resolution INTEGER NOT NULL, start INTEGER NOT NULL," \
+                    " min_reading REAL NOT NULL, max_reading REAL NOT NULL, sum_reading REAL NOT NULL, count INTEGER NOT NULL, last_time REAL NOT NULL, last_reading REAL NOT NULL," \
+                    " PRIMARY KEY (device_id, resolution, start)) WITHOUT ROWID")
+                conn.execute("CREATE TABLE IF NOT EXISTS " + self.estimators_table + " (device_id TEXT PRIMARY KEY, state TEXT NOT NULL)")
+                conn.execute("CREATE TABLE IF NOT EXISTS " + self.summaries_table + " (device_id TEXT PRIMARY KEY, count INTEGER NOT NULL, reading_time REAL NOT NULL, reading REAL NOT NULL) WITHOUT ROWID")
+                conn.execute("CREATE TABLE IF NOT EXISTS " + self.devices_table + " (device_id TEXT PRIMARY KEY, username TEXT NOT NULL) WITHOUT ROWID")
+                conn.execute("CREATE INDEX IF NOT EXISTS devices_username ON " + self.devices_table + " (username)")
+                self.create_readings_table(conn)
+        except sqlite3.Error as e:
+            raise DatabaseException("Could not open the SQLite database: %s" % e)
+
+    def create_readings_table(self, conn):
+        """Creates the readings table, keyed on (device_id, reading_time) so that a device has at most one reading at any given
+        time. The key also serves the readings query. Databases from before the key are migrated, keeping the first of any duplicates."""
+        create_sql = "CREATE TABLE IF NOT EXISTS " + self.readings_table + " (device_id TEXT NOT NULL, reading_time REAL NOT NULL, reading REAL NOT NULL," \
+            " PRIMARY KEY (device_id, reading_time)) WITHOUT ROWID"
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'readings'").fetchone()
+        if row is None or "PRIMARY KEY" in row[0]:
+            conn.execute(create_sql)
+            return
+
+        start_time = time.time()
+        old_table = self.quote_identifier("readings_unkeyed")
+        conn.execute("DROP INDEX IF EXISTS readings_device_time")
+        conn.execute("ALTER TABLE " + self.readings_table + " RENAME TO " + old_table)
+        conn.execute(create_sql)
+        conn.execute("INSERT OR IGNORE INTO " + self.readings_table + " (device_id, reading_time, reading) SELECT device_id, reading_time, reading FROM " + old_table + " ORDER BY rowid")
+        conn.execute("DROP TABLE " + old_table)
+
+        # The summaries counted the duplicates. The rollups are left as they are.
+        conn.execute("UPDATE " + self.summaries_table + " SET count = (SELECT COUNT(*) FROM " + self.readings_table + " WHERE device_id = " + self.summaries_table + ".device_id)")
+        self.log_info("Added a key to the readings table in %.3f seconds." % (time.time() - start_time))
+
+    def ping(self):
+        """Returns True if the database is reachable."""
+        try:
+            self.connection().execute("SELECT 1").fetchone()
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+        return False
+
+    #
+    # User management methods
+    #
+
+    def create_user(self, username, realname, passhash):
+        """Create method for a user."""
+        if username is None:
+            raise Exception("Unexpected empty object: username")
+        if realname is None:
+            raise Exception("Unexpected empty object: realname")
+        if passhash is None:
+            raise Exception("Unexpected empty object: passhash")
+        if len(username) == 0:
+            raise Exception("username too short")
+        if len(realname) == 0:
+            raise Exception("realname too short")
+        if len(passhash) == 0:
+            raise Exception("hash too short")
+
+        try:
+            conn = self.connection()
+            with conn:
+                conn.execute(self.insert_user_sql, (username, realname, passhash))
+            return True
+        except sqlite3.IntegrityError:
+            raise DuplicateUserException()
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def retrieve_user(self, username):
+        """Retrieve method for a user. Returns the password hash and real name, or None, None if the user does not exist."""
+        if username is None:
+            raise Exception("Unexpected empty object: username")
+        if len(username) == 0:
+            raise Exception("username too short")
+
+        try:
+            row = self.connection().execute(self.select_user_sql, (username,)).fetchone()
+            if row is not None:
+                return row[0], row[1]
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None, None
+
+    #
+    # Device management methods
+    #
+
+    def create_device(self, device_id, username):
+        """Registers a device to a user, unless it already has an owner. Returns the device's owner, or None on error."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+        if username is None:
+            raise Exception("Unexpected empty object: username")
+
+        try:
+            conn = self.connection()
+            with conn:
+                conn.execute(self.insert_device_sql, (device_id, username))
+                row = conn.execute(self.select_device_owner_sql, (device_id,)).fetchone()
+            if row is not None:
+                return row[0]
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def retrieve_device_owner(self, device_id):
+        """Retrieve method for the username of a device's owner. Returns None if the device isn't registered."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+
+        try:
+            row = self.connection().execute(self.select_device_owner_sql, (device_id,)).fetchone()
+            if row is not None:
+                return row[0]
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    #
+    # Session management methods
+    #
+
+    def create_session_token(self, username, session_token, expiry):
+        """Create method for a session token."""
+        if username is None:
+            raise Exception("Unexpected empty object: username")
+        if session_token is None:
+            raise Exception("Unexpected empty object: session_token")
+        if expiry is None:
+            raise Exception("Unexpected empty object: expiry")
+
+        try:
+            conn = self.connection()
+            with conn:
+                conn.execute(self.insert_session_sql, (session_token, username, expiry))
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def retrieve_session_token(self, session_token):
+        """Retrieve method for session data. Returns the username and expiry, or None, None if the token is unknown."""
+        if session_token is None:
+            raise Exception("Unexpected empty object: session_token")
+
+        try:
+            row = self.connection().execute(self.select_session_sql, (session_token,)).fetchone()
+            if row is not None:
+                return row[0], row[1]
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None, None
+
+    def delete_session_token(self, session_token):
+        """Delete method for a session token."""
+        if session_token is None:
+            raise Exception("Unexpected empty object: session_token")
+
+        try:
+            conn = self.connection()
+            with conn:
+                cursor = conn.execute(self.delete_session_sql, (session_token,))
+            return cursor.rowcount > 0
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def retrieve_session_cache_version(self):
+        """Returns the version stamp that processes use to tell each other to drop their session caches."""
+        try:
+            row = self.connection().execute(self.select_setting_sql, (SESSION_CACHE_VERSION_ID,)).fetchone()
+            if row is not None:
+                return row[0]
+            return 0
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def increment_session_cache_version(self):
+        """Bumps the session cache version stamp, invalidating the session caches of every process."""
+        try:
+            conn = self.connection()
+            with conn:
+                conn.execute(self.increment_setting_sql, (SESSION_CACHE_VERSION_ID,))
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    #
+    # Reading management methods
+    #
+
+    def create_reading(self, device_id, reading, reading_time):
+        """Create method for a scale reading."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+        if reading is None:
+            raise Exception("Unexpected empty object: reading")
+        if reading_time is None:
+            raise Exception("Unexpected empty object: reading_time")
+
+        try:
+            reading = float(reading)
+            reading_time = float(reading_time)
+            conn = self.connection()
+            with conn:
+                if conn.execute(self.insert_reading_sql, (device_id, reading_time, reading)).rowcount == 0:
+                    self.count_duplicates(1)
+                    return True # Already stored, and already counted in the rollups and summary
+                self.update_rollups(conn, [(device_id, reading, reading_time)])
+                conn.execute(self.upsert_summary_sql, (device_id, 1, reading_time, reading))
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def create_readings(self, readings):
+        """Create method for a list of (device_id, reading, reading_time) tuples, written in a single transaction.
+        Readings at a time the device already has a reading for are skipped."""
+        if readings is None:
+            raise Exception("Unexpected empty object: readings")
+
+        try:
+            conn = self.connection()
+            with conn:
+                # One statement per reading, rather than executemany, to learn which ones were ignored.
+                stored = []
+                for device_id, reading, reading_time in readings:
+                    if conn.execute(self.insert_reading_sql, (device_id, reading_time, reading)).rowcount > 0:
+                        stored.append((device_id, reading, reading_time))
+                self.count_duplicates(len(readings) - len(stored))
+                self.update_rollups(conn, stored)
+                conn.executemany(self.upsert_summary_sql, [ (device_id, *summary) for device_id, summary in Rollups.summarize(stored).items() ])
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def retrieve_readings(self, device_id, start_time=None, end_time=None):
+        """Retrieve method for the readings from a device, optionally restricted to a time range."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+        if start_time is None:
+            start_time = float("-inf")
+        if end_time is None:
+            end_time = float("inf")
+
+        try:
+            cursor = self.connection().execute(self.select_readings_sql, (device_id, start_time, end_time))
+            readings = [ { PARAM_READING_TIME: row[0], PARAM_READING: row[1] } for row in cursor ]
+            if self.cold_store is None:
+                return readings
+            return list(self.merge_cold_readings(device_id, start_time, end_time, readings))
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return []
+
+    def iter_readings(self, device_id, start_time=None, end_time=None):
+        """Like retrieve_readings, but yields the readings as the database returns them. Errors are logged and raised."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+        if start_time is None:
+            start_time = float("-inf")
+        if end_time is None:
+            end_time = float("inf")
+
+        try:
+            cursor = self.connection().execute(self.select_readings_sql, (device_id, start_time, end_time))
+            readings = ({ PARAM_READING_TIME: row[0], PARAM_READING: row[1] } for row in cursor)
+            yield from self.merge_cold_readings(device_id, start_time, end_time, readings)
+        except Exception: # Not GeneratorExit, the client may stop reading early
+            # Raised again, so that a response that has already started is cut off rather than looking complete.
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+            raise
+
+    def scan_readings(self, device_id, after_time, end_time, limit):
+        """Returns up to limit of the device's oldest readings after after_time (None for the first) and before end_time, as a
+        list of (reading_time, reading) tuples in time order. Unlike iter_readings, errors are raised rather than logged,
+        so that a failed read can't be mistaken for the end of the readings."""
+        if after_time is None:
+            after_time = float("-inf")
+        cursor = self.connection().execute(self.scan_readings_sql, (device_id, after_time, end_time, limit))
+        return cursor.fetchall()
+
+    def delete_readings(self, device_id, end_time):
+        """Delete method for the readings from a device that were taken at or before end_time. The rollups and the summary are left as they are."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+        if end_time is None:
+            raise Exception("Unexpected empty object: end_time")
+
+        try:
+            conn = self.connection()
+            with conn:
+                conn.execute(self.delete_readings_sql, (device_id, end_time))
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def retrieve_device_ids(self):
+        """Retrieve method for the IDs of every device that has readings."""
+        try:
+            return [ row[0] for row in self.connection().execute(self.select_device_ids_sql) ]
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return []
+
+    def update_rollups(self, conn, readings):
+        """Folds a list of (device_id, reading, reading_time) tuples into the rollups. Called inside the transaction that stores the readings."""
+        rows = []
+        for (device_id, window_secs, start), partial in Rollups.aggregate(readings).items():
+            rows.append((device_id, window_secs, start, *partial))
+        conn.executemany(self.upsert_rollup_sql, rows)
+
+    def retrieve_rollups(self, device_id, window_secs, start_time=None, end_time=None):
+        """Retrieve method for a device's rollups at the given resolution, optionally restricted to a time range."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+        start_time = float("-inf") if start_time is None else Rollups.window_start(start_time, window_secs)
+        if end_time is None:
+            end_time = float("inf")
+
+        try:
+            cursor = self.connection().execute(self.select_rollups_sql, (device_id, window_secs, start_time, end_time))
+            return [ Rollups.make_point(*row) for row in cursor ]
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return []
+
+    def iter_rollups(self, device_id, window_secs, start_time=None, end_time=None):
+        """Like retrieve_rollups, but yields the points as the database returns them. Errors are logged and raised."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+        start_time = float("-inf") if start_time is None else Rollups.window_start(start_time, window_secs)
+        if end_time is None:
+            end_time = float("inf")
+
+        try:
+            cursor = self.connection().execute(self.select_rollups_sql, (device_id, window_secs, start_time, end_time))
+            for row in cursor:
+                yield Rollups.make_point(*row)
+        except Exception: # Not GeneratorExit, the client may stop reading early
+            # Raised again, so that a response that has already started is cut off rather than looking complete.
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+            raise
+
+    def retrieve_first_reading_time(self, device_id):
+        """Returns approximately (to the day) when the device's first reading was taken, or None if there are no readings."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+
+        try:
+            row = self.connection().execute(self.select_first_rollup_sql, (device_id, max(Rollups.RESOLUTIONS.values()))).fetchone()
+            if row is not None:
+                return row[0]
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def retrieve_device_summary(self, device_id):
+        """Returns a dictionary of the number of readings stored for the device and its latest reading, or None if there is no summary.
+        Devices whose readings predate the summaries get one with their next reading."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+
+        try:
+            row = self.connection().execute(self.select_summary_sql, (device_id,)).fetchone()
+            if row is not None:
+                return { PARAM_COUNT: row[0], PARAM_READING_TIME: row[1], PARAM_READING: row[2] }
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def retrieve_user_device_summaries(self, username):
+        """Returns a dictionary of device_id -> summary (as from retrieve_device_summary) for every device the user owns, with None
+        for devices that have no readings. One query joins the user's devices to their summaries."""
+        if username is None:
+            raise Exception("Unexpected empty object: username")
+
+        try:
+            summaries = {}
+            for device_id, count, reading_time, reading in self.connection().execute(self.select_user_summaries_sql, (username,)):
+                summaries[device_id] = None if count is None else { PARAM_COUNT: count, PARAM_READING_TIME: reading_time, PARAM_READING: reading }
+            return summaries
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def retrieve_latest_reading(self, device_id):
+        """Returns the device's most recent reading, or None if there are no readings."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+
+        summary = self.retrieve_device_summary(device_id)
+        if summary is not None:
+            return { PARAM_READING_TIME: summary[PARAM_READING_TIME], PARAM_READING: summary[PARAM_READING] }
+        try:
+            row = self.connection().execute(self.select_latest_reading_sql, (device_id,)).fetchone()
+            if row is not None:
+                return { PARAM_READING_TIME: row[0], PARAM_READING: row[1] }
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    #
+    # Estimator methods
+    #
+
+    def retrieve_estimator_state(self, device_id):
+        """Retrieve method for a device's persisted estimator state. Returns None if there isn't one."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+
+        try:
+            row = self.connection().execute(self.select_estimator_sql, (device_id,)).fetchone()
+            if row is not None:
+                return json.loads(row[0])
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def retrieve_estimator_states(self, device_ids):
+        """Retrieve method for the persisted estimator states of a list of devices. Returns a dictionary of
+        device_id -> state, leaving out devices that don't have one, or None on error."""
+        if device_ids is None:
+            raise Exception("Unexpected empty object: device_ids")
+
+        try:
+            device_ids = list(device_ids)
+            conn = self.connection()
+            states = {}
+            for start in range(0, len(device_ids), MAX_SQL_PARAMETERS):
+                chunk = device_ids[start:start + MAX_SQL_PARAMETERS]
+                for device_id, state in conn.execute(self.select_estimators_sql % ",".join("?" * len(chunk)), chunk):
+                    states[device_id] = json.loads(state)
+            return states
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def update_estimator_states(self, states):
+        """Update method for a dictionary of device ID -> estimator state, written in one transaction."""
+        if states is None:
+            raise Exception("Unexpected empty object: states")
+
+        try:
+            conn = self.connection()
+            with conn:
+                conn.executemany(self.upsert_estimator_sql, [ (device_id, json.dumps(state)) for device_id, state in states.items() ])
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def swap_estimator_state(self, device_id, last_time, state):
+        """Replaces a device's estimator state, but only if the time of the last reading in the stored state is last_time
+        (None if there shouldn't be a stored state yet). Returns True if it was replaced, False if it had been changed,
+        or None on error."""
+        if device_id is None:
+            raise Exception("Unexpected empty object: device_id")
+        if state is None:
+            raise Exception("Unexpected empty object: state")
+
+        try:
+            conn = self.connection()
+            with conn:
+                if last_time is None:
+                    cursor = conn.execute(self.insert_estimator_sql, (device_id, json.dumps(state)))
+                else:
+                    cursor = conn.execute(self.swap_estimator_sql, (json.dumps(state), device_id, last_time))
+            return cursor.rowcount > 0
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+def create_database(database_type, db_file, cold_dir=None):
+    """Instantiates and connects the selected database backend. If a cold storage directory is given, readings archived
+    there are merged into the readings returned from the database."""
+    if database_type == DATABASE_SQLITE:
+        database = AppSqliteDatabase(db_file)
+    elif database_type == DATABASE_MONGO:
+        database = AppMongoDatabase()
+    else:
+        raise DatabaseException("Unknown database type: " + database_type)
+    if cold_dir is not None:
+        database.cold_store = ColdStorage.ColdStore(cold_dir)
+    database.connect()
+    return database
+
 class UserMgr(object):
     """Encapsulates user authentication and management."""
 
-    def __init__(self, database):
+    def __init__(self, database, hasher, session_cache_size=10000, session_cache_ttl=300.0, session_cache_sync_interval=0.0):
         self.database = database
+        self.hasher = hasher # Runs bcrypt off of the request thread
+
+        # Recently validated sessions, so that most session checks don't need the database.
+        self.session_cache = Cache.TtlLruCache(session_cache_size, session_cache_ttl)
+
+        # The owners of recently used devices, so that most ownership checks don't need the database either.
+        self.device_owner_cache = Cache.TtlLruCache(DEVICE_OWNER_CACHE_SIZE, DEVICE_OWNER_CACHE_TTL)
+
+        # When more than one process serves the API, a logout in one process has to evict the session from
+        # the others' caches. If enabled, the version stamp in the database is checked at this interval.
+        self.session_cache_sync_interval = session_cache_sync_interval
+        self.session_cache_version = None
+        self.session_cache_checked = 0.0
 
     def authenticate_user(self, email, password):
         """Validates a user against the credentials in the database."""
@@ -201,11 +1460,7 @@ class UserMgr(object):
             raise Exception("The user (" + email + ") could not be found.")
 
         # Validate the provided password against the hash from the database.
-        if isinstance(password, str):
-            password = password.encode()
-        if isinstance(db_hash1, str):
-            db_hash1 = db_hash1.encode()
-        return bcrypt.checkpw(password, db_hash1)
+        return self.hasher.check_password(password, db_hash1)
 
     def create_user(self, email, realname, password1, password2):
         """Adds a user to the database."""
@@ -220,14 +1475,10 @@ class UserMgr(object):
         if password1 != password2:
             raise Exception("The passwords do not match.")
 
-        # Make sure this user doesn't already exist.
-        _, db_hash1 = self.database.retrieve_user(email)
-        if db_hash1 is not None:
-            raise Exception("The user already exists.")
-
         # Generate the salted hash of the password.
-        salt = bcrypt.gensalt()
-        computed_hash = bcrypt.hashpw(password1.encode('utf-8'), salt)
+        computed_hash = self.hasher.hash_password(password1)
+
+        # Add the user. The unique index on the username rejects duplicates, so there's no need to look first.
         if not self.database.create_user(email, realname, computed_hash):
             raise Exception("An internal error was encountered when creating the user.")
 
@@ -242,34 +1493,217 @@ class UserMgr(object):
         return None, None
     
     def delete_session(self, session_token):
-        return self.database.delete_session_token(session_token)
+        # The cache entry is dropped after the database row, so that a lookup racing with this one either reads the row
+        # before it's deleted, and isn't allowed to cache it, or finds it gone.
+        result = self.database.delete_session_token(session_token)
+        self.session_cache.invalidate(session_token)
+        if self.session_cache_sync_interval > 0.0:
+            self.database.increment_session_cache_version()
+        return result
+
+    def sync_session_cache(self):
+        """Drops the session cache if another process has bumped the version stamp since we last looked."""
+        now = time.monotonic()
+        if now - self.session_cache_checked < self.session_cache_sync_interval:
+            return
+        self.session_cache_checked = now
+
+        version = self.database.retrieve_session_cache_version()
+        if version is None:
+            self.session_cache.clear()
+        elif version != self.session_cache_version:
+            if self.session_cache_version is not None:
+                self.session_cache.clear()
+            self.session_cache_version = version
+
+    def session_user(self, session_token):
+        """Returns the username the session belongs to, or None if the session is unknown or has expired."""
+        if self.session_cache_sync_interval > 0.0:
+            self.sync_session_cache()
+
+        # Check the cache first. The stored expiry still applies to cached sessions.
+        now = time.time()
+        cached = self.session_cache.get(session_token)
+        if cached is not None:
+            username, expiry = cached
+            if now < expiry:
+                return username
+            self.session_cache.invalidate(session_token)
 
-    def validate_session(self, session_token):
-        _, expiry = self.database.retrieve_session_token(session_token)
+        # Logouts that happen while the database is being read keep the session out of the cache.
+        generation = self.session_cache.generation()
+        username, expiry = self.database.retrieve_session_token(session_token)
         if expiry is not None:
 
             # Is the token still valid.
-            now = time.time()
             if now < expiry:
-                return True
+                self.session_cache.put(session_token, (username, expiry), expiry - now, generation)
+                return username
 
-            # Token is expired, so delete it.
-            self.database.delete_session_token(session_token)
-        return False
+            # Token is expired, so delete it, unless the database will do that on its own.
+            if not self.database.reaps_expired_sessions:
+                self.database.delete_session_token(session_token)
+        return None
+
+    def validate_session(self, session_token):
+        return self.session_user(session_token) is not None
+
+    def device_owner(self, device_id):
+        """Returns the username of the device's owner, or None if the device isn't registered. Unregistered devices aren't cached."""
+        owner = self.device_owner_cache.get(device_id)
+        if owner is None:
+            owner = self.database.retrieve_device_owner(device_id)
+            if owner is not None:
+                self.device_owner_cache.put(device_id, owner)
+        return owner
+
+    def register_device(self, username, device_id):
+        """Registers the device to the user, unless it already has an owner. Returns the device's owner."""
+        owner = self.database.create_device(device_id, username)
+        if owner is None:
+            raise Exception("An internal error was encountered when registering the device.")
+        self.device_owner_cache.put(device_id, owner)
+        return owner
+
+    def session_cache_stats(self):
+        """Returns the session cache's hit/miss counters."""
+        return self.session_cache.stats()
+
+def make_device_status_etag(device_id, summary, query):
+    """Returns an ETag for a device_status response, from the device's summary and everything else that shapes the response."""
+    key = repr((device_id, summary[PARAM_COUNT], summary[PARAM_READING_TIME], query)).encode('utf-8')
+    return hashlib.blake2b(key, digest_size=12).hexdigest()
 
 class App(object):
     """Web app logic is stored here to keep it compartmentalized from the framework logic."""
 
-    def __init__(self, root_url, root_dir):
-        self.database = AppMongoDatabase()
-        self.database.connect()
+    def __init__(self, root_url, root_dir, write_behind=False, write_behind_depth=100000, write_behind_batch=1000, write_behind_interval=1.0,
+                 session_cache_sync_interval=0.0, hash_workers=2, hash_max_pending=8, dev_mode=False, database_type=DATABASE_MONGO, db_file=DEFAULT_SQLITE_FILE,
+                 tare_weight=KegEstimator.DEFAULT_TARE_WEIGHT, duplicate_window=DuplicateFilter.DEFAULT_WINDOW_SIZE, max_lateness=DuplicateFilter.DEFAULT_MAX_LATENESS,
+                 median_window=IngestFilter.DEFAULT_MEDIAN_WINDOW, deadband=IngestFilter.DEFAULT_DEADBAND, max_store_interval=IngestFilter.DEFAULT_MAX_INTERVAL,
+                 cold_dir=None, rate_limit_scale=1.0, max_watchers=0, workers=0):
+        self.metrics = Metrics.Registry()
+        self.api_latency = self.metrics.histogram("keg_api_request_seconds", "Time to answer an API request, including streaming the response.", ("method", "verb"))
+        self.api_requests = self.metrics.counter("keg_api_requests_total", "API requests, by response code.", ("method", "verb", "code"))
+        self.api_errors = self.metrics.counter("keg_api_errors_total", "API requests that failed with an unexpected exception.", ("method", "verb"))
+        self.db_latency = self.metrics.histogram("keg_db_call_seconds", "Time spent in each database method.", ("call",))
+        self.password_latency = self.metrics.histogram("keg_password_seconds", "Time bcrypt operations spent waiting for a worker and running.", ("operation", "phase"))
+        self.database = Metrics.TimedProxy(create_database(database_type, db_file, cold_dir), self.db_latency)
         self.root_url = root_url
         self.root_dir = root_dir
-        self.user_mgr = UserMgr(self.database)
+        self.hasher = PasswordHasher.PasswordHasher(hash_workers, hash_max_pending, observer=self.observe_password_operation)
+        self.user_mgr = UserMgr(self.database, self.hasher, session_cache_sync_interval=session_cache_sync_interval)
+        # With more than one worker process taking in readings, the estimators are kept in the database, so that each one
+        # sees all of its device's readings.
+        self.estimator_mgr = KegEstimator.EstimatorMgr(self.database, tare_weight, shared=workers > 1)
+        self.pubsub = PubSub.PubSub(max_watchers)
+        self.duplicate_filter = DuplicateFilter.DuplicateFilter(duplicate_window, max_lateness)
+        self.ingest_filter = IngestFilter.IngestFilter(median_window, deadband, max_store_interval)
+        self.response_cache = Cache.TtlLruCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+        self.rate_limiter = RateLimiter.RateLimiter(RateLimiter.scale_budgets(RATE_LIMITS, rate_limit_scale))
+        self.address_rate_limiter = RateLimiter.RateLimiter(RateLimiter.scale_budgets(RATE_LIMITS, rate_limit_scale * ADDRESS_RATE_LIMIT_FACTOR))
         self.tempfile_dir = os.path.join(self.root_dir, 'tempfile')
         self.tempmod_dir = os.path.join(self.root_dir, 'tempmod3')
+
+        # Render the pages now, rather than on each request. They only depend on the root URL.
+        self.templates = TemplateRegistry.TemplateRegistry(os.path.join(self.root_dir, HTML_DIR), self.tempmod_dir, dev_mode)
+        self.templates.register('index.html', { 'root_url': self.root_url })
+        self.templates.register('404.html', { 'root_url': self.root_url })
+
+        # In write-behind mode, readings are queued and written to the database in groups by a background thread.
+        self.ingest_queue = None
+        if write_behind:
+            # Readings that are given up on are forgotten by the duplicate filter, so that a resend is stored rather than skipped.
+            self.ingest_queue = IngestQueue.WriteBehindQueue(self.database.create_readings, write_behind_depth, write_behind_batch, write_behind_interval,
+                on_drop=self.duplicate_filter.forget)
+            self.ingest_queue.start()
+        self.register_stats_metrics()
         super(App, self).__init__()
 
+    def register_stats_metrics(self):
+        """Exposes the counters that the queue, session cache and password hasher already keep."""
+        hasher_stats = lambda: self.hasher.stats()
+        self.metrics.collected("keg_password_operations_total", "bcrypt operations, by outcome.", "counter",
+            lambda: [ (("completed",), hasher_stats()["calls"]), (("rejected",), hasher_stats()["rejected"]) ], ("outcome",))
+
+        pubsub_stats = lambda: self.pubsub.stats()
+        self.metrics.collected("keg_watch_subscriptions", "Clients waiting for new readings.", "gauge", lambda: [ ((), pubsub_stats()["subscriptions"]) ])
+        self.metrics.collected("keg_watch_deliveries_total", "New readings handed to waiting clients.", "counter", lambda: [ ((), pubsub_stats()["deliveries"]) ])
+        self.metrics.collected("keg_watch_rejected_total", "Clients turned away with a 503 because too many were already waiting.", "counter", lambda: [ ((), pubsub_stats()["rejected"]) ])
+
+        duplicate_stats = lambda: self.duplicate_filter.stats()
+        database = self.database
+        self.metrics.collected("keg_ingest_readings_total", "Readings sent by scales, by what became of them.", "counter",
+            lambda: [ (("accepted",), duplicate_stats()["accepted"]), (("duplicate",), duplicate_stats()["duplicates"]),
+                (("late",), duplicate_stats()["late"]), (("duplicate_in_database",), database.duplicate_count) ], ("outcome",))
+
+        filter_stats = lambda: self.ingest_filter.stats()
+        self.metrics.collected("keg_ingest_filter_readings_total", "Accepted readings that were stored, or left out because the weight hadn't changed.", "counter",
+            lambda: [ (("stored",), filter_stats()["stored"]), (("compressed",), filter_stats()["received"] - filter_stats()["stored"]) ], ("outcome",))
+
+        response_cache = self.response_cache
+        self.metrics.collected("keg_response_cache_events_total", "Compressed response cache lookups, by result.", "counter",
+            lambda: [ ((key,), value) for key, value in response_cache.stats().items() if key in ("hits", "misses") ], ("result",))
+
+        cache = self.user_mgr.session_cache
+        self.metrics.collected("keg_session_cache_entries", "Sessions in the session cache.", "gauge", lambda: [ ((), cache.stats()["size"]) ])
+        self.metrics.collected("keg_session_cache_events_total", "Session cache lookups and removals, by kind.", "counter",
+            lambda: [ ((key,), value) for key, value in cache.stats().items() if key in ("hits", "misses", "evictions", "invalidations") ], ("event",))
+
+        rate_limiters = { "address": self.address_rate_limiter, "caller": self.rate_limiter }
+        self.metrics.collected("keg_rate_limit_buckets", "Rate limit buckets, by what they are keyed on.", "gauge",
+            lambda: [ ((key,), limiter.stats()["buckets"]) for key, limiter in rate_limiters.items() ], ("key",))
+        self.metrics.collected("keg_rate_limit_rejected_total", "Requests turned away with a 429 by the rate limiter, by API method and what the bucket is keyed on.", "counter",
+            lambda: [ ((method, key), value) for key, limiter in rate_limiters.items() for method, value in limiter.stats()["rejected"].items() ], ("method", "key"))
+
+        owner_cache = self.user_mgr.device_owner_cache
+        self.metrics.collected("keg_device_owner_cache_events_total", "Device owner cache lookups, by result.", "counter",
+            lambda: [ ((key,), value) for key, value in owner_cache.stats().items() if key in ("hits", "misses") ], ("result",))
+
+        if self.ingest_queue is not None:
+            queue = self.ingest_queue
+            self.metrics.collected("keg_ingest_queue_depth", "Readings waiting in the write-behind queue.", "gauge", lambda: [ ((), queue.stats()["depth"]) ])
+            self.metrics.collected("keg_ingest_queue_retrying", "Readings in a write-behind group that failed and is waiting to be tried again.", "gauge", lambda: [ ((), queue.stats()["retrying"]) ])
+            self.metrics.collected("keg_ingest_queue_readings_total", "Readings handled by the write-behind queue, by outcome.", "counter",
+                lambda: [ ((key,), value) for key, value in queue.stats().items() if key in ("accepted", "rejected", "flushed", "dropped") ], ("outcome",))
+
+    def observe_password_operation(self, operation, queue_secs, run_secs):
+        """Called by the password hasher after each operation."""
+        self.password_latency.observe((operation, "queue"), queue_secs)
+        self.password_latency.observe((operation, "run"), run_secs)
+
+    def record_api_call(self, method, verb, code, secs, failed=False):
+        """Records the outcome and latency of an API request."""
+        if method not in API_METHODS:
+            method = "other"
+        self.api_latency.observe((method, verb), secs)
+        self.api_requests.inc((method, verb, code))
+        if failed:
+            self.api_errors.inc((method, verb))
+
+    def time_stream(self, response, method, verb, code, start_time):
+        """Passes a streamed response through, recording the request once the last chunk has been sent. An error part way
+        through is raised, so that the server cuts the response off."""
+        failed = False
+        try:
+            yield from response
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.record_api_call(method, verb, code, time.perf_counter() - start_time, failed)
+
+    def render_metrics(self):
+        """Returns the metrics in the Prometheus text format."""
+        return self.metrics.render()
+
+    def shutdown(self):
+        """Called when the server is exiting. Writes anything still waiting in the ingest queue and the estimator state."""
+        if self.ingest_queue is not None:
+            self.ingest_queue.stop()
+        self.estimator_mgr.persist()
+        self.hasher.shutdown()
+
     def log_error(self, log_str):
         """Writes an error message to the log file."""
         logger = logging.getLogger()
@@ -278,9 +1712,7 @@ class App(object):
     def error404(self):
         """Renders the 404 page."""
         try:
-            html_file = os.path.join(self.root_dir, HTML_DIR, '404.html')
-            my_template = Template(filename=html_file, module_directory=self.tempmod_dir)
-            return my_template.render(root_url=self.root_url)
+            return self.templates.static_response('404.html', 404)
         except Exception as e:
             self.log_error(e)
         except:
@@ -290,30 +1722,104 @@ class App(object):
     def index(self):
         """Renders the index page."""
         try:
-            html_file = os.path.join(self.root_dir, HTML_DIR, 'index.html')
-            my_template = Template(filename=html_file, module_directory=self.tempmod_dir)
-            return my_template.render(root_url=self.root_url)
+            return self.templates.static_response('index.html')
         except:
             pass
         return ""
 
-    def handle_api_login(self, values):
-        # Required parameters.
-        if PARAM_USERNAME not in values:
-            raise ApiAuthenticationException("Username not specified.")
-        if PARAM_PASSWORD not in values:
-            raise ApiAuthenticationException("Password not specified.")
+    def store_readings(self, readings, late=None):
+        """Writes a list of (device_id, reading, reading_time) tuples, either directly or through the write-behind queue.
+        Readings that were already taken in, such as those resent by a scale retrying a request, succeed without being written again.
+        Readings that are too far behind their device's newest one are not written, and are appended to late, if it is given.
+        Noise is filtered out and only the readings where the weight changed are written."""
+        readings = self.duplicate_filter.filter(readings, late)
+        if len(readings) == 0:
+            return True
+        checkpoint = IngestFilter.Checkpoint()
+        stored = self.ingest_filter.process(readings, checkpoint)
+
+        if len(stored) == 0:
+            result = True
+        elif self.ingest_queue is not None:
+            try:
+                self.ingest_queue.put(stored)
+            except IngestQueue.QueueFullException as e:
+                self.duplicate_filter.forget(readings)
+                self.ingest_filter.rollback(checkpoint)
+                raise ApiTooManyRequestsException(e.message)
+            result = True
+        elif len(stored) == 1:
+            result = self.database.create_reading(*stored[0])
+        else:
+            result = self.database.create_readings(stored)
+
+        # Keep the time-to-empty estimates current, from every reading, and wake anyone waiting on these devices.
+        if result:
+            self.estimator_mgr.update(readings)
+            self.pubsub.publish(stored)
+        else:
+            self.duplicate_filter.forget(readings)
+            self.ingest_filter.rollback(checkpoint)
+        return result
+
+    def session_user(self, session_token):
+        """Returns the username the session belongs to, or raises ApiNotLoggedInException."""
+        username = self.user_mgr.session_user(session_token)
+        if username is None:
+            raise ApiNotLoggedInException()
+        return username
+
+    def owns_device(self, username, device_id, claim=False):
+        """Returns True if the user owns the device. With claim set, a device that nobody owns yet is registered to the user,
+        which is how a scale's first upload registers it."""
+        owner = self.user_mgr.device_owner(device_id)
+        if owner is None and claim:
+            owner = self.user_mgr.register_device(username, device_id)
+        return owner == username
+
+    def check_device_owner(self, session_token, device_id, claim=False):
+        """Raises an exception unless the session's user owns the device."""
+        if not self.owns_device(self.session_user(session_token), device_id, claim):
+            raise ApiForbiddenException("Not authorized for this device.")
+
+    def check_rate_limit(self, method, remote_addr):
+        """Raises ApiTooManyRequestsException if the client address has used up its budget for the method. Called before the
+        request body is parsed, when nothing the client says about itself has been checked, so the address is all there is
+        to go on. Callers that turn out to be a valid device or session also go through rate_limit."""
+        wait_secs = self.address_rate_limiter.admit(method, remote_addr or "")
+        if wait_secs > 0.0:
+            raise ApiTooManyRequestsException("Rate limit exceeded.", int(math.ceil(wait_secs)))
+
+    def rate_limit(self, method, key):
+        """Raises ApiTooManyRequestsException if the device or session has used up its budget for the method. Only called
+        once the key has been validated, so that a client can't get more budget by making up device IDs or tokens."""
+        wait_secs = self.rate_limiter.admit(method, key)
+        if wait_secs > 0.0:
+            raise ApiTooManyRequestsException("Rate limit exceeded.", int(math.ceil(wait_secs)))
+
+    def validate(self, schema, values):
+        """Checks the request parameters against the endpoint's schema and returns the converted values."""
+        try:
+            return schema.validate(values)
+        except RequestSchema.ValidationException as e:
+            if e.authentication:
+                raise ApiAuthenticationException(e.message)
+            raise ApiMalformedRequestException(e.message)
 
+    def handle_api_login(self, values):
         # Decode and validate the required parameters.
-        email = unquote_plus(values[PARAM_USERNAME])
-        if not InputChecker.is_email_address(email):
-            raise ApiAuthenticationException("Invalid email address.")
-        password = unquote_plus(values[PARAM_PASSWORD])
+        values = self.validate(LOGIN_SCHEMA, values)
+        email = values[PARAM_USERNAME]
+        password = values[PARAM_PASSWORD]
 
         # Validate the credentials.
         try:
             if not self.user_mgr.authenticate_user(email, password):
                 raise ApiAuthenticationException("Authentication failed.")
+        except PasswordHasher.HasherBusyException as e:
+            raise ApiTooManyRequestsException(e.message)
+        except ApiException:
+            raise
         except Exception as e:
             raise ApiAuthenticationException(str(e))
 
@@ -333,30 +1839,19 @@ class App(object):
         return True, json_result
 
     def handle_api_create_login(self, values):
-        # Required parameters.
-        if PARAM_USERNAME not in values:
-            raise ApiAuthenticationException("Username not specified.")
-        if PARAM_REALNAME not in values:
-            raise ApiAuthenticationException("Real name not specified.")
-        if PARAM_PASSWORD1 not in values:
-            raise ApiAuthenticationException("Password not specified.")
-        if PARAM_PASSWORD2 not in values:
-            raise ApiAuthenticationException("Password confirmation not specified.")
-
         # Decode and validate the required parameters.
-        email = unquote_plus(values[PARAM_USERNAME])
-        if not InputChecker.is_email_address(email):
-            raise ApiMalformedRequestException("Invalid email address.")
-        realname = unquote_plus(values[PARAM_REALNAME])
-        if not InputChecker.is_valid_decoded_str(realname):
-            raise ApiMalformedRequestException("Invalid name.")
-        password1 = unquote_plus(values[PARAM_PASSWORD1])
-        password2 = unquote_plus(values[PARAM_PASSWORD2])
+        values = self.validate(CREATE_LOGIN_SCHEMA, values)
+        email = values[PARAM_USERNAME]
+        realname = values[PARAM_REALNAME]
+        password1 = values[PARAM_PASSWORD1]
+        password2 = values[PARAM_PASSWORD2]
 
         # Add the user to the database, should fail if the user already exists.
         try:
             if not self.user_mgr.create_user(email, realname, password1, password2):
                 raise Exception("User creation failed.")
+        except PasswordHasher.HasherBusyException as e:
+            raise ApiTooManyRequestsException(e.message)
         except:
             raise Exception("User creation failed.")
 
@@ -376,92 +1871,334 @@ class App(object):
         return True, json_result
 
     def handle_api_login_status(self, values):
-        # Required parameters.
-        if PARAM_SESSION_TOKEN not in values:
-            raise ApiAuthenticationException("Session token not specified.")
-        
         # Validate the required parameters.
-        session_token = values[PARAM_SESSION_TOKEN]
-        if not InputChecker.is_uuid(session_token):
-            raise ApiAuthenticationException("Session token is invalid.")
+        session_token = self.validate(SESSION_SCHEMA, values)[PARAM_SESSION_TOKEN]
 
         valid_session = self.user_mgr.validate_session(session_token)
+        if valid_session:
+            self.rate_limit('login_status', session_token)
         return valid_session, ""
 
     def handle_api_logout(self, values):
-        # Required parameters.
-        if PARAM_SESSION_TOKEN not in values:
-            raise ApiAuthenticationException("Session token not specified.")
-
         # Validate the required parameters.
-        session_token = values[PARAM_SESSION_TOKEN]
-        if not InputChecker.is_uuid(session_token):
-            raise ApiAuthenticationException("Session token is invalid.")
+        session_token = self.validate(SESSION_SCHEMA, values)[PARAM_SESSION_TOKEN]
 
         self.user_mgr.delete_session(session_token)
         return True, ""
 
     def handle_api_device_status(self, values):
-        # Required parameters.
-        if PARAM_SESSION_TOKEN not in values:
-            raise ApiAuthenticationException("Session token not specified.")
-        if PARAM_DEVICE_ID not in values:
-            raise ApiAuthenticationException("Device ID not specified.")
+        # Validate the parameters.
+        values = self.validate(DEVICE_STATUS_SCHEMA, values)
+        session_token = values[PARAM_SESSION_TOKEN]
+        device_id = values[PARAM_DEVICE_ID]
+        self.check_device_owner(session_token, device_id)
+        self.rate_limit('device_status', session_token)
 
+        # Optional parameters.
+        resolution = values.get(PARAM_RESOLUTION, Rollups.RESOLUTION_RAW)
+        try:
+            window_secs = Rollups.parse_resolution(resolution)
+        except ValueError:
+            raise ApiMalformedRequestException("Resolution is invalid.")
+        since = values.get(PARAM_SINCE)
+        until = values.get(PARAM_UNTIL)
+        response_format = values.get(PARAM_FORMAT, ReadingStream.FORMAT_ROWS)
+        if response_format not in ReadingStream.FORMATS:
+            raise ApiMalformedRequestException("Format is invalid.")
+        limit = None
+        if PARAM_LIMIT in values:
+            limit = min(values[PARAM_LIMIT], MAX_PAGE_READINGS)
+
+        # A cursor continues from where the previous page stopped.
+        skip_time = None
+        skip = 0
+        if PARAM_CURSOR in values:
+            try:
+                skip_time, skip = ReadingStream.decode_cursor(values[PARAM_CURSOR])
+            except ValueError:
+                raise ApiMalformedRequestException("Cursor is invalid.")
+            since = skip_time
+            if limit is None:
+                limit = MAX_PAGE_READINGS
+
+        # Columns are built in memory before they are sent, so they are always sent a page at a time.
+        if limit is None and response_format != ReadingStream.FORMAT_ROWS:
+            limit = MAX_PAGE_READINGS
+
+        # Pick a resolution that keeps the series chart-sized.
+        if resolution == Rollups.RESOLUTION_AUTO:
+            first_time = self.database.retrieve_first_reading_time(device_id)
+            if first_time is None:
+                first_time = time.time()
+            window_secs = Rollups.choose_resolution(since if since is not None else first_time, until if until is not None else time.time())
+
+        # Compress the response if the client accepts it.
+        headers = { 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding' }
+        encoding = None
+        if flask.has_request_context():
+            encoding = flask.request.accept_encodings.best_match(Compression.ENCODINGS)
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+
+        # The ETag changes whenever a reading is stored for the device, so an unchanged series is answered without reading it.
+        # The summary is read before the readings, so the response can't be older than its ETag.
+        etag = None
+        summary = self.database.retrieve_device_summary(device_id)
+        if summary is not None:
+            etag = make_device_status_etag(device_id, summary, (resolution, window_secs, since, until, limit, skip_time, skip, response_format, encoding))
+            if flask.has_request_context() and etag in flask.request.if_none_match:
+                raise ApiNotModifiedException(etag)
+            headers['ETag'] = '"' + etag + '"'
+
+            # An unchanged series that was compressed before is sent again as is.
+            if encoding is not None:
+                body = self.response_cache.get(etag)
+                if body is not None:
+                    return True, Compression.replay(body), headers
+
+        # Query the database. Rows are encoded as the database cursor yields them, rather than all at once. The first one is
+        # read now, so that a query that fails outright is answered with a 500 before any of the response is sent.
+        if window_secs is None:
+            readings = self.database.iter_readings(device_id, since, until)
+        else:
+            readings = self.database.iter_rollups(device_id, window_secs, since, until)
+        readings = ReadingStream.prefetch(readings)
+        response = ReadingStream.stream(readings, response_format, limit, skip_time, skip)
+        if encoding is not None:
+            # The body is only cached if the whole series was read and compressed.
+            on_complete = None
+            if etag is not None:
+                on_complete = lambda body: self.response_cache.put(etag, body)
+            response = Compression.compress_stream(response, encoding, on_complete, MAX_CACHED_RESPONSE_BYTES)
+        return True, response, headers
+
+    def handle_api_device_estimate(self, values):
         # Validate the required parameters.
-        session_token = values[PARAM_SESSION_TOKEN]
-        if not InputChecker.is_uuid(session_token):
-            raise ApiAuthenticationException("Session token is invalid.")
+        values = self.validate(DEVICE_SCHEMA, values)
         device_id = values[PARAM_DEVICE_ID]
-        if not InputChecker.is_uuid(device_id):
-            raise ApiAuthenticationException("Device ID is invalid.")
+        self.check_device_owner(values[PARAM_SESSION_TOKEN], device_id)
+        self.rate_limit('device_estimate', values[PARAM_SESSION_TOKEN])
+
+        # The estimate is maintained as readings arrive, so this doesn't touch the readings at all.
+        estimate = self.estimator_mgr.estimate(device_id)
+        if estimate is None:
+            return False, ""
+        json_result = json.dumps(estimate, ensure_ascii=False)
+        return True, json_result
 
-        # Query the database.
-        readings = self.database.retrieve_readings(device_id)
-        json_result = json.dumps(readings, ensure_ascii=False)
+    def handle_api_device_summaries(self, values):
+        """The latest reading and estimate for every device the user owns, for the inventory view. The cost doesn't depend
+        on how many devices there are: one query for the readings, and at most one for estimators that aren't in memory yet."""
+        session_token = self.validate(SESSION_SCHEMA, values)[PARAM_SESSION_TOKEN]
+        username = self.session_user(session_token)
+        self.rate_limit('device_summaries', session_token)
+
+        summaries = self.database.retrieve_user_device_summaries(username)
+        if summaries is None:
+            raise Exception("Database error.")
+        estimates = self.estimator_mgr.estimate_many(list(summaries.keys()))
+
+        devices = {}
+        for device_id, summary in summaries.items():
+            device = {}
+            for key in (PARAM_READING_TIME, PARAM_READING):
+                device[key] = None if summary is None else summary[key]
+            estimate = estimates.get(device_id)
+            for key in (KegEstimator.ESTIMATE_FILL_PERCENT_KEY, KegEstimator.ESTIMATE_RATE_KEY, KegEstimator.ESTIMATE_EMPTY_TIME_KEY):
+                device[key] = None if estimate is None else estimate[key]
+            devices[device_id] = device
+        json_result = json.dumps({ PARAM_DEVICES_STATUS: devices }, ensure_ascii=False)
         return True, json_result
 
-    def handle_api_register_device(self, values):
-        # Required parameters.
-        if PARAM_SESSION_TOKEN not in values:
-            raise ApiAuthenticationException("Session token not specified.")
+    def parse_watch_request(self, method, values):
+        """Validates a device_watch or device_events request. Returns the devices and the since time."""
+        values = self.validate(DEVICE_WATCH_SCHEMA, values)
+        username = self.session_user(values[PARAM_SESSION_TOKEN])
+        device_ids = values[PARAM_DEVICE_IDS]
+        if len(device_ids) > MAX_WATCH_DEVICES:
+            raise ApiMalformedRequestException("Too many devices.")
+        for device_id in device_ids:
+            if not self.owns_device(username, device_id):
+                raise ApiForbiddenException("Not authorized for this device.")
+        self.rate_limit(method, values[PARAM_SESSION_TOKEN])
+        return device_ids, values.get(PARAM_SINCE), min(values.get(PARAM_TIMEOUT, MAX_WATCH_SECS), MAX_WATCH_SECS)
+
+    def subscribe(self, device_ids):
+        """Subscribes to new readings for the devices, or raises ApiServiceUnavailableException if this worker already has
+        as many waiting clients as it allows, so that waiting clients can't take every request thread."""
+        try:
+            return self.pubsub.subscribe(device_ids)
+        except PubSub.PubSubFullException as e:
+            raise ApiServiceUnavailableException(e.message, WATCH_RETRY_SECS)
+
+    def retrieve_latest_readings(self, device_ids, since):
+        """Returns a dictionary of device_id -> latest reading, for the devices with a reading newer than since."""
+        latest = {}
+        for device_id in device_ids:
+            reading = self.database.retrieve_latest_reading(device_id)
+            if reading is not None and (since is None or reading[PARAM_READING_TIME] > since):
+                latest[device_id] = reading
+        return latest
+
+    def handle_api_device_watch(self, values):
+        """Long-poll. Answers at once if any of the devices has a reading newer than since (or if since is not given), otherwise
+        waits for one to arrive or for the timeout. The response's since is passed back on the next request."""
+        device_ids, since, timeout = self.parse_watch_request('device_watch', values)
+
+        # Subscribe first, so a reading that arrives while the database is being checked isn't missed.
+        subscription = self.subscribe(device_ids)
+        try:
+            updates = self.retrieve_latest_readings(device_ids, since)
+            if not updates and since is not None:
+                updates = self.pubsub.wait(subscription, timeout)
+        finally:
+            self.pubsub.unsubscribe(subscription)
+
+        for reading in updates.values():
+            if since is None or reading[PARAM_READING_TIME] > since:
+                since = reading[PARAM_READING_TIME]
+        json_result = json.dumps({ PARAM_DEVICES_STATUS: updates, PARAM_SINCE: since }, ensure_ascii=False)
+        return True, json_result
+
+    def stream_events(self, device_ids, subscription, since, initial):
+        """Yields server-sent events for the initial readings and then for each new reading, until the stream's time is up.
+        Readings published by other workers don't reach this worker's subscriptions, so whenever a wait times out the
+        devices' latest readings are checked in the database as well."""
+        sent = {} # device_id -> time of the latest reading sent
+        def events(updates):
+            for device_id, reading in updates.items():
+                last_time = sent.get(device_id, since)
+                if last_time is None or reading[PARAM_READING_TIME] > last_time:
+                    sent[device_id] = reading[PARAM_READING_TIME]
+                    yield PubSub.encode_event(device_id, reading)
+
+        try:
+            yield from events(initial)
+            end_time = time.monotonic() + MAX_EVENT_STREAM_SECS
+            while True:
+                remaining = end_time - time.monotonic()
+                if remaining <= 0.0:
+                    break
+                updates = self.pubsub.wait(subscription, min(EVENT_KEEPALIVE_SECS, remaining))
+                if not updates:
+                    updates = self.retrieve_latest_readings(device_ids, None)
+                sent_any = False
+                for event in events(updates):
+                    sent_any = True
+                    yield event
+                if not sent_any:
+                    yield ": keepalive\n\n"
+        finally:
+            self.pubsub.unsubscribe(subscription)
+
+    def handle_api_device_events(self, values):
+        """Server-sent event stream of new readings for the given devices, starting with any newer than since. A client that
+        reconnects sends the ID of the last event it received, which is a reading time, and resumes from there."""
+        device_ids, since, _ = self.parse_watch_request('device_events', values)
+        if flask.has_request_context() and LAST_EVENT_ID_HEADER in flask.request.headers:
+            try:
+                since = RequestSchema.convert_timestamp(flask.request.headers[LAST_EVENT_ID_HEADER])
+            except ValueError:
+                raise ApiMalformedRequestException("Last event ID is invalid.")
+        subscription = self.subscribe(device_ids)
+        try:
+            initial = self.retrieve_latest_readings(device_ids, since)
+        except:
+            self.pubsub.unsubscribe(subscription)
+            raise
+        headers = { 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no' }
+        events = flask.stream_with_context(self.stream_events(device_ids, subscription, since, initial)) # Keeps the request open until the stream ends
+        return True, flask.Response(events, mimetype='text/event-stream', headers=headers)
 
+    def handle_api_register_device(self, values):
         # Validate the required parameters.
-        session_token = values[PARAM_SESSION_TOKEN]
-        if not InputChecker.is_uuid(session_token):
-            raise ApiAuthenticationException("Session token is invalid.")
+        values = self.validate(DEVICE_SCHEMA, values)
+        username = self.session_user(values[PARAM_SESSION_TOKEN])
+        device_id = values[PARAM_DEVICE_ID]
 
-        # Update the database.
+        # Update the database. Registering a device the user already owns succeeds.
+        if self.user_mgr.register_device(username, device_id) != username:
+            raise ApiForbiddenException("The device is registered to another user.")
         return True, ""
 
     def handle_api_update_device_status(self, values):
-        # Required parameters.
-        if PARAM_SESSION_TOKEN not in values:
-            raise ApiAuthenticationException("Session token not specified.")
-        if PARAM_DEVICE_ID not in values:
-            raise ApiAuthenticationException("Device ID not specified.")
-
-        # Validate the required parameters.
+        # Validate the parameters.
+        values = self.validate(UPDATE_DEVICE_STATUS_SCHEMA, values)
         session_token = values[PARAM_SESSION_TOKEN]
-        if not InputChecker.is_uuid(session_token):
-            raise ApiAuthenticationException("Session token is invalid.")
         device_id = values[PARAM_DEVICE_ID]
-        if not InputChecker.is_uuid(device_id):
-            raise ApiAuthenticationException("Device ID is invalid.")
-
         reading = values[PARAM_READING]
         reading_time = values[PARAM_READING_TIME]
+        self.check_device_owner(session_token, device_id, claim=True)
+        self.rate_limit('update_device_status', device_id)
 
         # Update the database.
-        self.database.create_reading(device_id, reading, reading_time)
+        late = []
+        if not self.store_readings([(device_id, reading, reading_time)], late):
+            raise Exception("Database error.")
+        if len(late) > 0:
+            raise ApiMalformedRequestException(LATE_READING_MESSAGE)
         return True, ""
 
+    def handle_api_update_device_status_batch(self, values):
+        # Validate the required parameters.
+        values = self.validate(UPDATE_DEVICE_STATUS_BATCH_SCHEMA, values)
+        username = self.session_user(values[PARAM_SESSION_TOKEN])
+        items = values[PARAM_READINGS]
+        if len(items) > MAX_BATCH_READINGS:
+            raise ApiMalformedRequestException("Too many readings in a single request.")
+
+        # Validate every reading in one pass, remembering which ones are good. Ownership is checked once per device.
+        statuses = []
+        accepted_statuses = [] # The statuses of the readings that are stored, in the same order
+        readings = []
+        owned = {}
+        for reading, error in BATCH_READING_SCHEMA.validate_items(items):
+            if reading is None:
+                statuses.append({ PARAM_CODE: 400, PARAM_MESSAGE: error })
+                continue
+            device_id = reading[0]
+            if device_id not in owned:
+                owned[device_id] = self.owns_device(username, device_id, claim=True)
+                if owned[device_id]:
+                    self.rate_limit('update_device_status_batch', device_id)
+            if owned[device_id]:
+                statuses.append({ PARAM_CODE: 200 })
+                accepted_statuses.append(statuses[-1])
+                readings.append(reading)
+            else:
+                statuses.append({ PARAM_CODE: 403, PARAM_MESSAGE: "Not authorized for this device." })
+
+        # Update the database with all of the good readings at once.
+        late = []
+        if len(readings) > 0 and not self.store_readings(readings, late):
+            for status in statuses:
+                if status[PARAM_CODE] == 200:
+                    status[PARAM_CODE] = 500
+                    status[PARAM_MESSAGE] = "Database error."
+        if len(late) > 0:
+            late = set(late)
+            for status, reading in zip(accepted_statuses, readings):
+                if reading in late:
+                    status[PARAM_CODE] = 400
+                    status[PARAM_MESSAGE] = LATE_READING_MESSAGE
+
+        json_result = json.dumps(statuses, ensure_ascii=False)
+        return True, json_result
+
     def handle_api_1_0_get_request(self, request, values):
         """Called to parse a version 1.0 API GET request."""
         if request == 'login_status':
             return self.handle_api_login_status(values)
         if request == 'device_status':
             return self.handle_api_device_status(values)
+        if request == 'device_estimate':
+            return self.handle_api_device_estimate(values)
+        if request == 'device_summaries':
+            return self.handle_api_device_summaries(values)
+        if request == 'device_watch':
+            return self.handle_api_device_watch(values)
+        if request == 'device_events':
+            return self.handle_api_device_events(values)
         return False, ""
 
     def handle_api_1_0_post_request(self, request, values):
@@ -476,12 +2213,47 @@ class App(object):
             return self.handle_api_register_device(values)
         if request == 'update_device_status':
             return self.handle_api_update_device_status(values)
+        if request == 'update_device_status_batch':
+            return self.handle_api_update_device_status_batch(values)
         return False, ""
 
     def handle_api_1_0_delete_request(self, request, values):
         """Called to parse a version 1.0 API DELETE request."""
         return False, ""
 
+    def api_binary(self, request, data):
+        """Handles API requests whose body is in the compact binary format. Only readings can be uploaded this way."""
+        request = request.lower()
+        if request != 'update_device_status' and request != 'update_device_status_batch':
+            return False, ""
+
+        try:
+            session_token, readings = BinaryFormat.decode(data)
+        except BinaryFormat.BinaryFormatException as e:
+            raise ApiMalformedRequestException(e.message)
+        if len(readings) > MAX_BATCH_READINGS:
+            raise ApiMalformedRequestException("Too many readings in a single request.")
+
+        # The reading times get the same range check as in a JSON request.
+        try:
+            for _, _, reading_time in readings:
+                RequestSchema.convert_timestamp(reading_time)
+        except ValueError:
+            raise ApiMalformedRequestException("Reading time is invalid.")
+
+        username = self.session_user(session_token)
+        for device_id in set(reading[0] for reading in readings):
+            if not self.owns_device(username, device_id, claim=True):
+                raise ApiForbiddenException("Not authorized for this device.")
+            self.rate_limit(request, device_id)
+
+        late = []
+        if len(readings) > 0 and not self.store_readings(readings, late):
+            raise Exception("Database error.")
+        if len(late) > 0:
+            raise ApiMalformedRequestException(LATE_READING_MESSAGE)
+        return True, ""
+
     def api(self, verb, request, values):
         """Handles API requests."""
         request = request.lower()
@@ -493,6 +2265,13 @@ class App(object):
             return self.handle_api_1_0_delete_request(request, values)
         return False, ""
 
+@g_flask_app.teardown_request
+def release_database(exception):
+    """Gives back the request thread's database connection once the response, including a streamed one, has been sent."""
+    global g_app
+    if g_app is not None:
+        g_app.database.release()
+
 @g_flask_app.errorhandler(404)
 def page_not_found(e):
     global g_app
@@ -505,13 +2284,40 @@ def index():
     global g_app
     return g_app.index()
 
+@g_flask_app.route('/ready')
+def ready():
+    """Readiness check for load balancers and process managers. Succeeds once the app is created and its database answers."""
+    global g_app
+    if g_app is None or not g_app.database.ping():
+        return "", 503
+    return "", 200
+
+@g_flask_app.route('/metrics')
+def metrics():
+    """Counters and latency histograms for this process, in the Prometheus text format."""
+    global g_app
+    if g_app is None:
+        return "", 503
+    return flask.Response(g_app.render_metrics(), mimetype=Metrics.CONTENT_TYPE)
+
 @g_flask_app.route('/api/<version>/<method>', methods = ['GET','POST','DELETE'])
 def api(version, method):
     """Endpoint for API calls."""
     global g_app
+    start_time = time.perf_counter()
     response = ""
     code = 500
+    headers = {}
+    verb = flask.request.method
+    streamed = False
+    failed = False
     try:
+        # Turn away addresses that are over their budget before parsing the body.
+        g_app.check_rate_limit(method.lower(), flask.request.remote_addr)
+        binary_data = None
+        if flask.request.method == 'POST' and flask.request.mimetype == BinaryFormat.CONTENT_TYPE:
+            binary_data = flask.request.get_data()
+
         # The the API params.
         if flask.request.method == 'GET':
             verb = "GET"
@@ -519,6 +2325,8 @@ def api(version, method):
         elif flask.request.method == 'DELETE':
             verb = "DELETE"
             params = flask.request.args
+        elif binary_data is not None:
+            verb = "POST"
         elif flask.request.data:
             verb = "POST"
             params = json.loads(flask.request.data)
@@ -528,24 +2336,49 @@ def api(version, method):
 
         # Process the API request.
         if version == '1.0':
-            handled, response = g_app.api(verb, method, params)
+            if binary_data is not None:
+                result = g_app.api_binary(method, binary_data)
+            else:
+                result = g_app.api(verb, method, params)
+
+            # Handlers return whether the request was handled, the response and, optionally, response headers.
+            handled, response = result[0], result[1]
+            if len(result) > 2:
+                headers.update(result[2])
+
             if handled:
                 code = 200
             else:
                 code = 400
+
+            # Large results are returned as generators, and streamed. They are timed until the last chunk is sent.
+            if inspect.isgenerator(response):
+                response = g_app.time_stream(response, method.lower(), verb, code, start_time)
+                response = flask.Response(flask.stream_with_context(response), mimetype='application/json')
+                streamed = True
         else:
             code = 400
+    except ApiNotModifiedException as e:
+        code = e.code
+        headers['ETag'] = '"' + e.etag + '"'
+    except (ApiTooManyRequestsException, ApiServiceUnavailableException) as e:
+        code = e.code
+        headers['Retry-After'] = str(e.retry_after)
     except ApiException as e:
         g_app.log_error(e.message)
         code = e.code
     except Exception as e:
-        g_app.log_error(e.message)
-        code = e.code
+        failed = True
+        g_app.log_error(traceback.format_exc())
+        code = 500
     except:
+        failed = True
         g_app.log_error(traceback.format_exc())
         g_app.log_error(sys.exc_info()[0])
         g_app.log_error('Unhandled exception in ' + api.__name__)
-    return response, code
+    if not streamed:
+        g_app.record_api_call(method.lower(), verb, code, time.perf_counter() - start_time, failed)
+    return response, code, headers
 
 def check():
     pass
@@ -560,6 +2393,31 @@ def main():
     # Parse command line options.
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", type=int, action="store", default=5555, help="The port on which to bind.", required=False)
+    parser.add_argument("--workers", type=int, action="store", default=0, help="Number of pre-forked worker processes for production use, zero for the development server.", required=False)
+    parser.add_argument("--threads", type=int, action="store", default=8, help="Number of threads in each worker process.", required=False)
+    parser.add_argument("--keep-alive", type=int, action="store", default=5, help="Seconds to hold idle keep-alive connections open.", required=False)
+    parser.add_argument("--timeout", type=int, action="store", default=60, help="Seconds a worker may be silent before it is restarted.", required=False)
+    parser.add_argument("--graceful-timeout", type=int, action="store", default=30, help="Seconds workers have to finish their requests on reload or shutdown.", required=False)
+    parser.add_argument("--database", type=str, action="store", default=DATABASE_MONGO, choices=[DATABASE_MONGO, DATABASE_SQLITE], help="The database backend to use.", required=False)
+    parser.add_argument("--db-file", type=str, action="store", default=DEFAULT_SQLITE_FILE, help="The database file, when using the SQLite backend.", required=False)
+    parser.add_argument("--keg-tare", type=float, action="store", default=KegEstimator.DEFAULT_TARE_WEIGHT, help="Weight of an empty keg, in grams, used when estimating the fill level.", required=False)
+    parser.add_argument("--dev", action="store_true", default=False, help="Development mode, reloads page templates when they change.", required=False)
+    parser.add_argument("--write-behind", action="store_true", default=False, help="Queue readings in memory and write them to the database in groups.", required=False)
+    parser.add_argument("--write-behind-depth", type=int, action="store", default=100000, help="Maximum number of queued readings before ingest requests are rejected.", required=False)
+    parser.add_argument("--write-behind-batch", type=int, action="store", default=1000, help="Maximum number of readings written in one group.", required=False)
+    parser.add_argument("--write-behind-interval", type=float, action="store", default=1.0, help="Maximum time, in seconds, a reading waits in the queue.", required=False)
+    parser.add_argument("--duplicate-window", type=int, action="store", default=DuplicateFilter.DEFAULT_WINDOW_SIZE, help="Number of recent reading times remembered per device, to drop resent readings without a database round trip.", required=False)
+    parser.add_argument("--max-lateness", type=float, action="store", default=DuplicateFilter.DEFAULT_MAX_LATENESS, help="Seconds a reading may trail its device's newest reading and still be accepted, zero for no limit.", required=False)
+    parser.add_argument("--median-window", type=int, action="store", default=None, help="Number of readings in the running median that removes scale noise, one to turn it off. Defaults to %u, and to off with more than one worker." % IngestFilter.DEFAULT_MEDIAN_WINDOW, required=False)
+    parser.add_argument("--deadband", type=float, action="store", default=None, help="Grams the filtered weight has to change by before another reading is stored, zero to store every reading. Defaults to %.0f, and to zero with more than one worker." % IngestFilter.DEFAULT_DEADBAND, required=False)
+    parser.add_argument("--max-store-interval", type=float, action="store", default=IngestFilter.DEFAULT_MAX_INTERVAL, help="Seconds after which a reading is stored even if the weight hasn't changed.", required=False)
+    parser.add_argument("--cold-dir", type=str, action="store", default=None, help="Directory of archived readings, which are merged into the readings read from the database.", required=False)
+    parser.add_argument("--archive-days", type=float, action="store", default=None, help="Move readings older than this many days from the database to --cold-dir, then exit.", required=False)
+    parser.add_argument("--rate-limit-scale", type=float, action="store", default=1.0, help="Multiplies the per-device, per-session and per-address request rate limits, zero to turn them off.", required=False)
+    parser.add_argument("--max-watchers", type=int, action="store", default=None, help="Clients each worker lets wait on device_watch or device_events at once, zero for no limit. Defaults to a quarter of --threads with --workers, and no limit otherwise.", required=False)
+    parser.add_argument("--hash-workers", type=int, action="store", default=2, help="Number of processes used for password hashing, zero to hash on the request thread.", required=False)
+    parser.add_argument("--hash-max-pending", type=int, action="store", default=None, help="Maximum number of password hashes in flight before login requests are rejected. Defaults to half of --threads.", required=False)
+    parser.add_argument("--session-cache-sync", type=float, action="store", default=None, help="If non-zero, how often (in seconds) to check whether another process has invalidated cached sessions. Defaults to %.0f with --workers, and zero otherwise." % DEFAULT_SESSION_CACHE_SYNC_SECS, required=False)
 
     try:
         args = parser.parse_args()
@@ -567,12 +2425,91 @@ def main():
         parser.error(e)
         sys.exit(1)
 
+    # Archive old readings and exit, for running from cron. The server can keep running meanwhile.
+    if args.archive_days is not None:
+        if args.cold_dir is None:
+            parser.error("--archive-days requires --cold-dir")
+        database = create_database(args.database, args.db_file)
+        cold_store = ColdStorage.ColdStore(args.cold_dir)
+        start_time = time.time()
+        count = cold_store.archive(database, start_time - args.archive_days * 86400.0, database.log_info)
+        print("Archived %u readings in %.3f seconds." % (count, time.time() - start_time))
+        sys.exit(0)
+
+    # The noise filter and deadband keep each device's recent readings in memory, so they are only right if one process takes
+    # in all of a device's readings. With several workers, each would filter its own share, and one could leave out a change
+    # because it hadn't seen the reading another one stored.
+    median_window = args.median_window
+    deadband = args.deadband
+    if args.workers > 1:
+        if (median_window is not None and median_window > 1) or (deadband is not None and deadband > 0.0):
+            parser.error("--median-window and --deadband need all of a device's readings to reach one process, use --workers 1 or fewer")
+        median_window = 1
+        deadband = 0.0
+    else:
+        if median_window is None:
+            median_window = IngestFilter.DEFAULT_MEDIAN_WINDOW
+        if deadband is None:
+            deadband = IngestFilter.DEFAULT_DEADBAND
+
+    # With more than one worker, a logout in one has to reach the session caches of the others.
+    session_cache_sync = args.session_cache_sync
+    if session_cache_sync is None:
+        session_cache_sync = DEFAULT_SESSION_CACHE_SYNC_SECS if args.workers > 0 else 0.0
+
+    # Requests waiting on a password hash hold a thread each, so keep some free for everything else.
+    hash_max_pending = args.hash_max_pending
+    if hash_max_pending is None:
+        hash_max_pending = max(1, args.threads // 2)
+
+    # Each waiting client holds one of a worker's threads, so leave most of them for everything else. The development
+    # server starts a thread per request.
+    max_watchers = args.max_watchers
+    if max_watchers is None:
+        max_watchers = max(1, args.threads // 4) if args.workers > 0 else 0
+
     mako.collection_size = 100
     mako.directories = "templates"
 
     root_dir = os.path.dirname(os.path.abspath(__file__))
-    g_app = App("", root_dir)
-    g_flask_app.run(port=args.port)
+
+    def create_app():
+        global g_app
+        g_app = App("", root_dir,
+            write_behind=args.write_behind,
+            write_behind_depth=args.write_behind_depth,
+            write_behind_batch=args.write_behind_batch,
+            write_behind_interval=args.write_behind_interval,
+            session_cache_sync_interval=session_cache_sync,
+            hash_workers=args.hash_workers,
+            hash_max_pending=hash_max_pending,
+            dev_mode=args.dev,
+            database_type=args.database,
+            db_file=args.db_file,
+            tare_weight=args.keg_tare,
+            duplicate_window=args.duplicate_window,
+            max_lateness=args.max_lateness,
+            median_window=median_window,
+            deadband=deadband,
+            max_store_interval=args.max_store_interval,
+            cold_dir=args.cold_dir,
+            rate_limit_scale=args.rate_limit_scale,
+            max_watchers=max_watchers,
+            workers=args.workers)
+
+    def shutdown_app():
+        if g_app is not None:
+            g_app.shutdown()
+
+    if args.workers > 0:
+        # Production mode. The app is created in each worker, after the fork.
+        import ProductionServer
+        options = ProductionServer.make_options(args.port, args.workers, args.threads, args.keep_alive, args.timeout, args.graceful_timeout)
+        ProductionServer.ProductionServer(g_flask_app, create_app, shutdown_app, options).run()
+    else:
+        create_app()
+        atexit.register(shutdown_app)
+        g_flask_app.run(port=args.port)
 
 if __name__=="__main__":
 	main()
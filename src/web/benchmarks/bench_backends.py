@@ -0,0 +1,90 @@
+#! /usr/bin/env python
+"""Compares the SQLite and MongoDB backends on the operations the API performs.
+
+The MongoDB half requires a local mongod and uses a scratch database, pass --skip-mongo to run SQLite only.
+
+    python benchmarks/bench_backends.py --readings 100000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import app
+
+BENCH_DB_NAME = 'devicestatusbench'
+START_TIME = 1700000000
+
+def timed(label, count, func):
+    """Runs the function and prints the rate."""
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print("    %-32s %12.1f ops/s" % (label, count / elapsed))
+
+def run(database, args):
+    """Runs every measurement against a connected database."""
+    device_id = str(uuid.uuid4())
+
+    def single_readings():
+        for i in range(args.singles):
+            database.create_reading(device_id, 1000.0 - i * 0.01, START_TIME + i)
+    timed("create_reading", args.singles, single_readings)
+
+    def batched_readings():
+        base = START_TIME + args.singles
+        for offset in range(0, args.readings, args.batch):
+            batch = [ (device_id, 500.0, base + offset + i) for i in range(min(args.batch, args.readings - offset)) ]
+            database.create_readings(batch)
+    timed("create_readings (batch %u)" % args.batch, args.readings, batched_readings)
+
+    end_time = START_TIME + args.singles + args.readings
+    for label, width in [ ("hour", 3600), ("day", 86400) ]:
+        def range_queries():
+            for _ in range(args.queries):
+                database.retrieve_readings(device_id, end_time - width, end_time)
+        timed("retrieve_readings (last " + label + ")", args.queries, range_queries)
+
+    tokens = [ str(uuid.uuid4()) for _ in range(args.sessions) ]
+    def create_sessions():
+        for token in tokens:
+            database.create_session_token("bench@example.com", token, int(time.time()) + 3600)
+    timed("create_session_token", args.sessions, create_sessions)
+
+    def retrieve_sessions():
+        for token in tokens:
+            database.retrieve_session_token(token)
+    timed("retrieve_session_token", args.sessions, retrieve_sessions)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, action="store", default="mongodb://127.0.0.1/", help="The MongoDB server to use.", required=False)
+    parser.add_argument("--skip-mongo", action="store_true", default=False, help="Only measure SQLite.", required=False)
+    parser.add_argument("--singles", type=int, action="store", default=5000, help="Number of readings written one at a time.", required=False)
+    parser.add_argument("--readings", type=int, action="store", default=100000, help="Number of readings written in batches.", required=False)
+    parser.add_argument("--batch", type=int, action="store", default=1000, help="Readings per batch.", required=False)
+    parser.add_argument("--queries", type=int, action="store", default=100, help="Number of times to run each range query.", required=False)
+    parser.add_argument("--sessions", type=int, action="store", default=5000, help="Number of session tokens to create and look up.", required=False)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        print("sqlite")
+        database = app.AppSqliteDatabase(os.path.join(temp_dir, 'bench.sqlite'))
+        database.connect()
+        run(database, args)
+
+    if not args.skip_mongo:
+        print("mongo")
+        database = app.AppMongoDatabase(args.url, BENCH_DB_NAME)
+        database.connect()
+        try:
+            run(database, args)
+        finally:
+            database.conn.drop_database(BENCH_DB_NAME)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,71 @@
+#! /usr/bin/env python
+"""Size and range query time of readings archived to cold storage.
+
+Archives a synthetic series, one reading every --interval seconds with jitter and a slowly draining keg, then
+reports the bytes per reading on disk and the time to read back the last day, week and month, and the whole series.
+
+Does not need a database.
+
+    python benchmarks/bench_cold_storage.py --days 365 --interval 60
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ColdStorage
+
+DEVICE_ID = "00000000-0000-4000-8000-000000000000"
+
+def make_series(days, interval):
+    """Returns a list of (reading_time, reading) pairs, like the archive job reads them from the database."""
+    count = int(days * 86400 / interval)
+    reading_time = float(int(time.time()) - days * 86400)
+    weight = 25000.0
+    readings = []
+    for _ in range(count):
+        reading_time += interval + random.uniform(-1.0, 1.0)
+        weight -= random.uniform(0.0, 0.5)
+        if weight < 5000.0:
+            weight = 25000.0
+        readings.append((reading_time, round(weight + random.gauss(0.0, 5.0), 1)))
+    return readings
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, action="store", default=365, help="Length of the series.", required=False)
+    parser.add_argument("--interval", type=float, action="store", default=60.0, help="Seconds between readings.", required=False)
+    parser.add_argument("--queries", type=int, action="store", default=20, help="Number of times to run each range query.", required=False)
+    args = parser.parse_args()
+
+    readings = make_series(args.days, args.interval)
+    directory = tempfile.mkdtemp()
+    try:
+        store = ColdStorage.ColdStore(directory)
+        start_time = time.perf_counter()
+        store.append(DEVICE_ID, readings)
+        elapsed = time.perf_counter() - start_time
+
+        segment_bytes = os.path.getsize(store.path(DEVICE_ID, ColdStorage.SEGMENT_EXTENSION))
+        index_bytes = os.path.getsize(store.path(DEVICE_ID, ColdStorage.INDEX_EXTENSION))
+        print("%u readings archived in %.3f seconds" % (len(readings), elapsed))
+        print("%u segment bytes, %u index bytes, %.2f bytes per reading (16 uncompressed)" % (segment_bytes, index_bytes, (segment_bytes + index_bytes) / len(readings)))
+
+        end_time = readings[-1][0]
+        print("%-8s %10s %12s" % ("range", "readings", "ms/query"))
+        for label, days in (("day", 1), ("week", 7), ("month", 30), ("all", args.days)):
+            start_time = time.perf_counter()
+            for _ in range(args.queries):
+                count = len(store.retrieve_readings(DEVICE_ID, end_time - days * 86400, end_time))
+            elapsed = (time.perf_counter() - start_time) / args.queries
+            print("%-8s %10u %12.3f" % (label, count, elapsed * 1000.0))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,158 @@
+#! /usr/bin/env python
+"""Compression ratio and reconstruction error of the ingest filter on a synthetic corpus.
+
+The corpus is a week of 1 Hz readings from a keg that is poured from now and then, mostly in the
+evening, with load cell noise, occasional spikes and a slow daily drift. Each setting reports:
+- how many readings were stored, and the ratio to the number received;
+- the error of the stored series against the filtered readings, which the deadband bounds, when it is
+  reconstructed by holding the last stored value and by drawing straight lines between stored values;
+- the error against the true weight while the keg is not being poured from (during a pour, the running
+  median trails the weight by half its window);
+- how many pours can still be seen in the stored series;
+- the time the filter took per reading.
+
+Does not need a database.
+
+    python benchmarks/bench_compression.py --days 7
+"""
+
+import argparse
+import bisect
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import IngestFilter
+
+DEVICE_ID = "00000000-0000-4000-8000-000000000000"
+NOISE_GRAMS = 4.0 # Standard deviation of the load cell noise
+SPIKE_PROBABILITY = 0.0005 # Chance that a reading is a spike, such as someone leaning on the keg
+DRIFT_GRAMS = 6.0 # Amplitude of the daily drift, such as from temperature
+
+def make_corpus(days, seed):
+    """Returns the raw readings, the true weight at each reading, and a list of (start, end, before, after) pours.
+    A keg that runs low is swapped for a full one, which shows up as a pour in the other direction."""
+    rng = random.Random(seed)
+    count = int(days * 86400)
+    weight = 25000.0
+    pours = []
+    next_pour = rng.expovariate(1.0 / 3600.0)
+    pour = None
+    raw = []
+    truth = []
+    for second in range(count):
+        reading_time = 1700000000.0 + second
+
+        # Pours are more likely in the evening. A pour takes 5-15 seconds and removes 100-500 grams.
+        if pour is None and second >= next_pour:
+            length = rng.randint(5, 15)
+            after = weight - rng.uniform(100.0, 500.0)
+            if after < 5000.0:
+                after = 25000.0
+            pour = (second, second + length, weight, after)
+            pours.append((reading_time, reading_time + length, weight, after))
+        if pour is not None:
+            start, end, before, after = pour
+            weight = before + (after - before) * min(1.0, (second - start) / (end - start))
+            if second >= end:
+                pour = None
+                hour = (second % 86400) / 3600.0
+                mean_gap = 1200.0 if 17.0 <= hour <= 23.0 else 7200.0
+                next_pour = second + rng.expovariate(1.0 / mean_gap)
+
+        drift = DRIFT_GRAMS * math.sin(2.0 * math.pi * second / 86400.0)
+        value = weight + drift + rng.gauss(0.0, NOISE_GRAMS)
+        if rng.random() < SPIKE_PROBABILITY:
+            value += rng.choice((-1.0, 1.0)) * rng.uniform(200.0, 2000.0)
+        raw.append((DEVICE_ID, value, reading_time))
+        truth.append(weight + drift)
+    return raw, truth, pours
+
+def running_median(raw, window):
+    """The filtered readings the deadband is applied to, for measuring the error it allows."""
+    filter = IngestFilter.IngestFilter(window, 0.0)
+    return [ reading for _, reading, _ in filter.process(raw) ]
+
+def reconstruct(stored, times, interpolate):
+    """Returns the stored series evaluated at each of the given times, which are in order."""
+    stored_times = [ reading_time for _, _, reading_time in stored ]
+    stored_values = [ reading for _, reading, _ in stored ]
+    values = []
+    index = 0
+    for reading_time in times:
+        while index + 1 < len(stored_times) and stored_times[index + 1] <= reading_time:
+            index += 1
+        if not interpolate or index + 1 >= len(stored_times):
+            values.append(stored_values[index])
+        else:
+            t0, t1 = stored_times[index], stored_times[index + 1]
+            v0, v1 = stored_values[index], stored_values[index + 1]
+            values.append(v0 + (v1 - v0) * (reading_time - t0) / (t1 - t0))
+    return values
+
+def errors(values, reference, mask=None):
+    """Returns the maximum and root mean square difference, optionally only where the mask is True."""
+    worst = 0.0
+    squares = 0.0
+    count = 0
+    for index, (value, expected) in enumerate(zip(values, reference)):
+        if mask is not None and not mask[index]:
+            continue
+        difference = abs(value - expected)
+        worst = max(worst, difference)
+        squares += difference * difference
+        count += 1
+    return worst, math.sqrt(squares / count)
+
+def steady_mask(times, pours, settle_secs):
+    """Returns a list of flags, True for the readings taken outside of a pour and the settle_secs after it."""
+    mask = [ True ] * len(times)
+    first_time = times[0]
+    for start, end, _, _ in pours:
+        for index in range(int(start - first_time), min(len(times), int(end - first_time + settle_secs) + 1)):
+            mask[index] = False
+    return mask
+
+def pours_seen(stored, pours):
+    """Counts the pours after which the stored series is closer to the new weight than to the old one within five seconds."""
+    stored_times = [ reading_time for _, _, reading_time in stored ]
+    seen = 0
+    for _, end, before, after in pours:
+        index = bisect.bisect_right(stored_times, end + 5.0) - 1
+        value = stored[index][1]
+        if abs(value - after) < abs(value - before):
+            seen += 1
+    return seen
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=float, action="store", default=7.0, help="Length of the synthetic series, at one reading per second.", required=False)
+    parser.add_argument("--seed", type=int, action="store", default=1, help="Seed for the synthetic series.", required=False)
+    parser.add_argument("--max-interval", type=float, action="store", default=IngestFilter.DEFAULT_MAX_INTERVAL, help="Seconds after which a reading is stored anyway.", required=False)
+    args = parser.parse_args()
+
+    raw, truth, pours = make_corpus(args.days, args.seed)
+    times = [ reading_time for _, _, reading_time in raw ]
+    steady = steady_mask(times, pours, 10.0)
+    print("%u readings, %u pours" % (len(raw), len(pours)))
+    print("%-8s %-9s %9s %8s %14s %14s %15s %7s %9s" % ("median", "deadband", "stored", "ratio", "hold max/rms", "line max/rms", "steady max/rms", "pours", "us/read"))
+
+    settings = [ (1, 0.0), (5, 0.0), (1, 10.0), (5, 10.0), (5, 20.0), (5, 40.0), (9, 20.0) ]
+    for median_window, deadband in settings:
+        filter = IngestFilter.IngestFilter(median_window, deadband, args.max_interval)
+        start_time = time.perf_counter()
+        stored = filter.process(raw)
+        elapsed = time.perf_counter() - start_time
+
+        filtered = running_median(raw, median_window)
+        hold_max, hold_rms = errors(reconstruct(stored, times, False), filtered)
+        line_max, line_rms = errors(reconstruct(stored, times, True), filtered)
+        true_max, true_rms = errors(reconstruct(stored, times, False), truth, steady)
+        print("%-8u %-9.0f %9u %7.1fx %6.1f / %5.1f %6.1f / %5.1f %7.1f / %5.1f %3u/%-3u %9.2f" % (median_window, deadband, len(stored), len(raw) / len(stored),
+            hold_max, hold_rms, line_max, line_rms, true_max, true_rms, pours_seen(stored, pours), len(pours), elapsed * 1e6 / len(raw)))
+
+if __name__=="__main__":
+    main()
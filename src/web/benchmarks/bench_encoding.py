@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+"""Payload size and encode time of a device_status response for a long series, for each response format (rows, columns,
+and columns with delta encoded times) with no compression, gzip and deflate, and for a compressed response sent again
+from the response cache.
+
+Does not need a database; the series is synthetic, one reading every few seconds with jitter and a slowly draining keg.
+
+    python benchmarks/bench_encoding.py --count 100000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import Compression
+import ReadingStream
+
+def make_series(count):
+    """Returns a list of readings like the database yields them."""
+    readings = []
+    reading_time = float(int(time.time()) - count * 5)
+    weight = 25000.0
+    for _ in range(count):
+        reading_time += random.choice((4.0, 5.0, 5.0, 5.0, 6.0))
+        weight = max(4000.0, weight - random.uniform(0.0, 0.5))
+        readings.append({ "reading_time": reading_time, "reading": round(weight + random.gauss(0.0, 20.0), 1) })
+    return readings
+
+def encode(readings, response_format, encoding):
+    """Produces the whole response body, the way the device_status handler would. Returns the body's size in bytes."""
+    chunks = ReadingStream.stream(iter(readings), response_format)
+    if encoding is not None:
+        chunks = Compression.compress_stream(chunks, encoding)
+    size = 0
+    for chunk in chunks:
+        size += len(chunk.encode('utf-8')) if isinstance(chunk, str) else len(chunk)
+    return size
+
+def measure(func, args, repeat):
+    """Returns the result of the last call and the best time of repeat calls."""
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start_time
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, action="store", default=100000, help="Number of readings in the series.", required=False)
+    parser.add_argument("--repeat", type=int, action="store", default=3, help="Number of times to time each encoding.", required=False)
+    args = parser.parse_args()
+
+    readings = make_series(args.count)
+    baseline = None
+
+    print("%-10s %-12s %12s %10s %12s" % ("format", "encoding", "bytes", "vs. rows", "encode ms"))
+    for response_format in ReadingStream.FORMATS:
+        for encoding in (None,) + Compression.ENCODINGS:
+            size, elapsed = measure(encode, (readings, response_format, encoding), args.repeat)
+            if baseline is None:
+                baseline = size
+            print("%-10s %-12s %12d %9.1f%% %12.1f" % (response_format, encoding or "identity", size, 100.0 * size / baseline, elapsed * 1000.0))
+
+    # A series that hasn't changed since it was last sent is answered from the cached compressed bytes.
+    cached = []
+    for _ in Compression.compress_stream(ReadingStream.stream(iter(readings), ReadingStream.FORMAT_DELTA), Compression.ENCODING_GZIP, cached.append, 1 << 30):
+        pass
+    size, elapsed = measure(lambda: sum(len(chunk) for chunk in Compression.replay(cached[0])), (), args.repeat)
+    print("%-10s %-12s %12d %9.1f%% %12.3f" % ("delta", "gzip cached", size, 100.0 * size / baseline, elapsed * 1000.0))
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,82 @@
+#! /usr/bin/env python
+"""Requests per second for the index and 404 pages, compiling the template per request vs. the template registry.
+
+Does not need a database.
+
+    python benchmarks/bench_pages.py --secs 5
+"""
+
+import argparse
+import flask
+import os
+import sys
+import tempfile
+import time
+from mako.template import Template
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import TemplateRegistry
+
+HTML_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'html')
+
+def make_before_app(module_dir):
+    """The way pages were served before, building a Template on every request."""
+    flask_app = flask.Flask("before")
+
+    def render(name):
+        my_template = Template(filename=os.path.join(HTML_DIR, name), module_directory=module_dir)
+        return my_template.render(root_url="")
+
+    @flask_app.errorhandler(404)
+    def page_not_found(e):
+        return render('404.html'), 404
+
+    @flask_app.route('/')
+    def index():
+        return render('index.html')
+
+    return flask_app
+
+def make_after_app(module_dir):
+    """Pages served from the template registry."""
+    flask_app = flask.Flask("after")
+    templates = TemplateRegistry.TemplateRegistry(HTML_DIR, module_dir)
+    templates.register('index.html', { 'root_url': "" })
+    templates.register('404.html', { 'root_url': "" })
+
+    @flask_app.errorhandler(404)
+    def page_not_found(e):
+        return templates.static_response('404.html', 404)
+
+    @flask_app.route('/')
+    def index():
+        return templates.static_response('index.html')
+
+    return flask_app
+
+def requests_per_sec(client, url, secs, headers=None):
+    """Issues requests for the given number of seconds and returns the rate."""
+    count = 0
+    end_time = time.perf_counter() + secs
+    while time.perf_counter() < end_time:
+        client.get(url, headers=headers)
+        count += 1
+    return count / secs
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--secs", type=float, action="store", default=5.0, help="Seconds to run each measurement.", required=False)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as module_dir:
+        for label, flask_app in [ ("before", make_before_app(module_dir)), ("after", make_after_app(module_dir)) ]:
+            client = flask_app.test_client()
+            etag = client.get('/').headers.get('ETag')
+            print(label)
+            print("    %-28s %10.1f req/s" % ("/", requests_per_sec(client, '/', args.secs)))
+            print("    %-28s %10.1f req/s" % ("404", requests_per_sec(client, '/no/such/page', args.secs)))
+            if etag is not None:
+                print("    %-28s %10.1f req/s" % ("/ with If-None-Match (304)", requests_per_sec(client, '/', args.secs, { 'If-None-Match': etag })))
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,142 @@
+#! /usr/bin/env python
+"""Compares the bucketed reading store against storing one document per reading.
+
+Requires a local mongod. Both layouts are loaded with the same synthetic 1 Hz data, then compared on
+load time, on-disk size, single-append latency, and time range query latency.
+
+    python benchmarks/bench_readings.py --count 10000000 --devices 20
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import pymongo
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import TimeSeries
+
+BENCH_DB_NAME = 'devicestatusbench'
+START_TIME = 1700000000
+
+def generate_readings(count, num_devices):
+    """Yields (device_id, reading, reading_time) tuples, round-robin across the devices, one reading per device per second."""
+    device_ids = [ "%08x-0000-4000-8000-%012x" % (i, i) for i in range(num_devices) ]
+    weight = [ 60000.0 ] * num_devices
+    for i in range(count):
+        device = i % num_devices
+        weight[device] = weight[device] - random.random() * 0.5
+        yield device_ids[device], weight[device], START_TIME + i // num_devices
+
+def chunks(iterable, size):
+    """Groups an iterable into lists of the given size."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class OneDocPerReadingStore(object):
+    """The layout being replaced, kept here for comparison."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def create_indexes(self):
+        self.collection.create_index([("device_id", pymongo.ASCENDING), ("reading_time", pymongo.ASCENDING)])
+
+    def append(self, device_id, reading, reading_time):
+        self.collection.insert_one({ "device_id": device_id, "reading": reading, "reading_time": reading_time })
+
+    def append_many(self, readings):
+        docs = [ { "device_id": d, "reading": r, "reading_time": t } for d, r, t in readings ]
+        self.collection.insert_many(docs, ordered=False)
+
+    def retrieve_readings(self, device_id, start_time=None, end_time=None):
+        query = { "device_id": device_id }
+        time_range = {}
+        if start_time is not None:
+            time_range["$gte"] = start_time
+        if end_time is not None:
+            time_range["$lte"] = end_time
+        if time_range:
+            query["reading_time"] = time_range
+        cursor = self.collection.find(query, { "_id": 0, "reading": 1, "reading_time": 1 }).sort("reading_time", pymongo.ASCENDING)
+        return list(cursor)
+
+def percentile(samples, pct):
+    """Returns the given percentile of a list of samples."""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+def run(name, store, database, collection_name, args):
+    """Loads the store and runs the measurements, returning a dictionary of results."""
+    results = { "layout": name }
+    collection = database[collection_name]
+    collection.drop()
+    store.create_indexes()
+
+    # Bulk load.
+    start = time.perf_counter()
+    for chunk in chunks(generate_readings(args.count, args.devices), args.batch):
+        store.append_many(chunk)
+    results["load_secs"] = time.perf_counter() - start
+
+    # Size on disk.
+    stats = database.command("collstats", collection_name)
+    results["documents"] = stats["count"]
+    results["storage_mb"] = stats["storageSize"] / (1024.0 * 1024.0)
+    results["index_mb"] = stats["totalIndexSize"] / (1024.0 * 1024.0)
+
+    # Single appends, as the update_device_status endpoint does them.
+    latencies = []
+    end_time = START_TIME + args.count // args.devices
+    for i in range(args.appends):
+        start = time.perf_counter()
+        store.append("ffffffff-0000-4000-8000-000000000000", 1.0, end_time + i)
+        latencies.append(time.perf_counter() - start)
+    results["append_p50_ms"] = percentile(latencies, 50) * 1000.0
+    results["append_p99_ms"] = percentile(latencies, 99) * 1000.0
+
+    # Range queries of increasing width, ending at the most recent reading.
+    device_id = "%08x-0000-4000-8000-%012x" % (0, 0)
+    for label, width in [ ("hour", 3600), ("day", 86400), ("week", 7 * 86400) ]:
+        latencies = []
+        for _ in range(args.queries):
+            start = time.perf_counter()
+            store.retrieve_readings(device_id, end_time - width, end_time)
+            latencies.append(time.perf_counter() - start)
+        results["query_" + label + "_p50_ms"] = percentile(latencies, 50) * 1000.0
+
+    collection.drop()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, action="store", default="mongodb://127.0.0.1/", help="The MongoDB server to use.", required=False)
+    parser.add_argument("--count", type=int, action="store", default=10000000, help="Total number of readings to load.", required=False)
+    parser.add_argument("--devices", type=int, action="store", default=20, help="Number of devices the readings are spread across.", required=False)
+    parser.add_argument("--batch", type=int, action="store", default=10000, help="Readings per bulk write during the load.", required=False)
+    parser.add_argument("--appends", type=int, action="store", default=1000, help="Number of single appends to time.", required=False)
+    parser.add_argument("--queries", type=int, action="store", default=20, help="Number of times to run each range query.", required=False)
+    args = parser.parse_args()
+
+    client = pymongo.MongoClient(args.url)
+    database = client[BENCH_DB_NAME]
+
+    all_results = []
+    all_results.append(run("one document per reading", OneDocPerReadingStore(database['readings']), database, 'readings', args))
+    all_results.append(run("bucketed", TimeSeries.BucketedReadingStore(database['buckets']), database, 'buckets', args))
+
+    for results in all_results:
+        print(results["layout"])
+        for key, value in results.items():
+            if key != "layout":
+                print("    %-20s %12.2f" % (key, value))
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,108 @@
+#! /usr/bin/env python
+"""Throughput of the development server vs. production mode (--workers N).
+
+Each configuration is started as a subprocess on the SQLite backend, seeded with a few readings, and then
+hit by client threads holding keep-alive connections. Production mode only pays off with more than one core.
+
+    python benchmarks/bench_server.py --workers 4 --clients 32 --secs 10
+"""
+
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+APP_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app.py')
+DEVICE_ID = str(uuid.uuid4())
+PASSWORD = "benchmark-password"
+
+def wait_until_ready(port, secs):
+    """Polls the readiness endpoint until it succeeds."""
+    end_time = time.time() + secs
+    while time.time() < end_time:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/ready")
+            if conn.getresponse().status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.2)
+    return False
+
+def seed(port, count):
+    """Creates a user and uploads some readings, so that device_status has something to return. Returns the user's session token."""
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    body = json.dumps({ "username": "bench@example.com", "realname": "Benchmark", "password1": PASSWORD, "password2": PASSWORD })
+    conn.request("POST", "/api/1.0/create_login", body, { "Content-Type": "application/json" })
+    session_token = json.loads(conn.getresponse().read())["session_token"]
+
+    # The first upload registers the device to the user.
+    readings = [ [DEVICE_ID, 20000.0 - i * 50.0, 1700000000 + i * 60] for i in range(count) ]
+    body = json.dumps({ "session_token": session_token, "readings": readings })
+    conn.request("POST", "/api/1.0/update_device_status_batch", body, { "Content-Type": "application/json" })
+    conn.getresponse().read()
+    return session_token
+
+def drive(port, path, clients, secs):
+    """Returns requests/sec for the given path, with each client thread reusing one connection."""
+    counts = [ 0 ] * clients
+    end_time = time.time() + secs
+
+    def client(index):
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        while time.time() < end_time:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            response.read()
+            if response.will_close:
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port)
+            counts[index] += 1
+
+    threads = [ threading.Thread(target=client, args=(i,)) for i in range(clients) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / secs
+
+def run(label, extra_args, args, temp_dir):
+    """Starts a server with the given arguments and measures it."""
+    db_file = os.path.join(temp_dir, label + '.sqlite')
+    command = [ sys.executable, APP_PY, "--port", str(args.port), "--database", "sqlite", "--db-file", db_file, "--hash-workers", "0", "--rate-limit-scale", "0" ] + extra_args
+    server = subprocess.Popen(command, cwd=temp_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_until_ready(args.port, 30):
+            print(label + ": server did not start")
+            return
+        session_token = seed(args.port, args.readings)
+        device_status = "/api/1.0/device_status?session_token=%s&device_id=%s&resolution=1h" % (session_token, DEVICE_ID)
+        print(label)
+        for name, path in [ ("/ready", "/ready"), ("/", "/"), ("device_status", device_status) ]:
+            print("    %-16s %10.1f req/s" % (name, drive(args.port, path, args.clients, args.secs)))
+    finally:
+        server.terminate()
+        server.wait()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, action="store", default=5599, help="Port to run the servers on.", required=False)
+    parser.add_argument("--workers", type=int, action="store", default=os.cpu_count(), help="Workers for production mode.", required=False)
+    parser.add_argument("--clients", type=int, action="store", default=16, help="Concurrent client connections.", required=False)
+    parser.add_argument("--secs", type=float, action="store", default=10.0, help="Seconds to drive each endpoint.", required=False)
+    parser.add_argument("--readings", type=int, action="store", default=1000, help="Readings to seed the device with.", required=False)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        run("dev server", [], args, temp_dir)
+        run("--workers %u" % args.workers, [ "--workers", str(args.workers) ], args, temp_dir)
+
+if __name__=="__main__":
+    main()
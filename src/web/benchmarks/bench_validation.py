@@ -0,0 +1,90 @@
+#! /usr/bin/env python
+"""Validations per second for the request parameters of the busiest endpoints, checking them by hand with the InputChecker
+functions (as the handlers used to) vs. the compiled request schemas.
+
+Does not need a database.
+
+    python benchmarks/bench_validation.py --count 200000
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import InputChecker
+import RequestSchema
+
+def legacy_is_complete_regex_match(expr, test_str):
+    """InputChecker.is_complete_regex_match as it was, matching and then comparing spans."""
+    try:
+        match_obj = re.match(expr, test_str)
+        return match_obj and match_obj.span()[0] == 0 and match_obj.span()[1] == len(test_str)
+    except:
+        pass
+    return False
+
+def legacy_is_uuid(test_str):
+    return legacy_is_complete_regex_match(InputChecker.uuid, test_str)
+
+def check_by_hand(values, is_uuid):
+    """The update_device_status checks, written out the way the handlers did them."""
+    if "session_token" not in values:
+        raise Exception("Session token not specified.")
+    if "device_id" not in values:
+        raise Exception("Device ID not specified.")
+    if not is_uuid(values["session_token"]):
+        raise Exception("Session token is invalid.")
+    if not is_uuid(values["device_id"]):
+        raise Exception("Device ID is invalid.")
+    return values["device_id"], float(values["reading"]), float(values["reading_time"])
+
+def check_batch_by_hand(items, is_uuid):
+    """The batch item checks, written out the way the handlers did them."""
+    results = []
+    for device_id, reading, reading_time in items:
+        if not isinstance(device_id, str) or not is_uuid(device_id):
+            results.append(None)
+            continue
+        results.append((device_id, float(reading), float(reading_time)))
+    return results
+
+def rate(func, args, count):
+    """Calls the function count times and returns the rate."""
+    start_time = time.perf_counter()
+    for _ in range(count):
+        func(*args)
+    return count / (time.perf_counter() - start_time)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, action="store", default=200000, help="Number of validations per measurement.", required=False)
+    parser.add_argument("--batch", type=int, action="store", default=1000, help="Number of readings in each batch.", required=False)
+    args = parser.parse_args()
+
+    schema = RequestSchema.Schema([
+        RequestSchema.Field("session_token", RequestSchema.TYPE_UUID, authentication=True),
+        RequestSchema.Field("device_id", RequestSchema.TYPE_UUID, authentication=True),
+        RequestSchema.Field("reading", RequestSchema.TYPE_FLOAT),
+        RequestSchema.Field("reading_time", RequestSchema.TYPE_TIMESTAMP)])
+    item_schema = RequestSchema.Schema(schema.fields[1:])
+
+    device_id = str(uuid.uuid4())
+    values = { "session_token": str(uuid.uuid4()), "device_id": device_id, "reading": 12345.6, "reading_time": time.time() }
+    items = [ [ device_id, random.uniform(4000.0, 25000.0), time.time() + i ] for i in range(args.batch) ]
+    batch_count = max(1, args.count // args.batch)
+
+    print("%-40s %14s" % ("", "per second"))
+    print("%-40s %14.0f" % ("is_uuid, match and compare spans", rate(legacy_is_uuid, (device_id,), args.count)))
+    print("%-40s %14.0f" % ("is_uuid, fullmatch", rate(InputChecker.is_uuid, (device_id,), args.count)))
+    print("%-40s %14.0f" % ("update_device_status, by hand", rate(check_by_hand, (values, legacy_is_uuid), args.count)))
+    print("%-40s %14.0f" % ("update_device_status, schema", rate(schema.validate, (values,), args.count)))
+    print("%-40s %14.0f" % ("batch readings, by hand", args.batch * rate(check_batch_by_hand, (items, legacy_is_uuid), batch_count)))
+    print("%-40s %14.0f" % ("batch readings, schema", args.batch * rate(item_schema.validate_items, (items,), batch_count)))
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,309 @@
+#! /usr/bin/env python
+"""Load test of the web service with simulated scales and app clients.
+
+Starts app.py as a subprocess, on the SQLite backend by default (or --database mongo against a local mongod),
+and drives it with two populations of threads for a fixed time:
+
+* scales, each posting update_device_status for its own device at a fixed rate, as the firmware does
+* app clients, each logging in (as ApiClient.swift does) and then polling login_status and device_status
+  for its user's scales
+
+Throughput, error counts and p50/p95/p99 latency per endpoint are printed and written to a JSON file.
+Pass the file from an earlier run as --baseline to compare the two.
+
+    python benchmarks/load_test.py --scales 50 --scale-rate 1 --clients 10 --secs 30 --output after.json --baseline before.json
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+WEB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+APP_PY = os.path.join(WEB_DIR, 'app.py')
+PASSWORD = "load-test-password"
+FULL_WEIGHT = 25000.0 # Grams, a full 5 gallon keg
+EMPTY_WEIGHT = 4000.0
+
+class Recorder(object):
+    """Latencies and error counts per endpoint. Each thread has its own, they are merged at the end."""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, endpoint, secs, ok):
+        self.latencies.setdefault(endpoint, []).append(secs)
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def merge(self, other):
+        for endpoint, latencies in other.latencies.items():
+            self.latencies.setdefault(endpoint, []).extend(latencies)
+        for endpoint, count in other.errors.items():
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + count
+
+def percentile(sorted_values, q):
+    """Nearest rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def summarize(recorder, secs):
+    """Returns a dictionary of endpoint -> throughput and latency figures, in requests/sec and milliseconds."""
+    summary = {}
+    for endpoint, latencies in sorted(recorder.latencies.items()):
+        latencies.sort()
+        summary[endpoint] = {
+            "requests": len(latencies),
+            "errors": recorder.errors.get(endpoint, 0),
+            "throughput": len(latencies) / secs,
+            "p50_ms": 1000.0 * percentile(latencies, 0.50),
+            "p95_ms": 1000.0 * percentile(latencies, 0.95),
+            "p99_ms": 1000.0 * percentile(latencies, 0.99),
+            "max_ms": 1000.0 * latencies[-1],
+        }
+    return summary
+
+class Connection(object):
+    """A keep-alive connection to the server that reconnects when the server closes it."""
+
+    def __init__(self, port):
+        self.port = port
+        self.conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        """Returns the status code, the response body and the response's ETag."""
+        headers = dict(headers or {})
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+            try:
+                self.conn.request(method, path, body, headers)
+                response = self.conn.getresponse()
+                data = response.read()
+                if response.will_close:
+                    self.close()
+                return response.status, data, response.getheader("ETag")
+            except (OSError, http.client.HTTPException):
+                # A kept-alive connection may have been closed by the server, try once more on a new one.
+                self.close()
+                if attempt == 1:
+                    return 0, b"", None
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+def timed_request(conn, recorder, endpoint, method, path, body=None, headers=None):
+    start_time = time.perf_counter()
+    status, data, etag = conn.request(method, path, body, headers)
+    recorder.record(endpoint, time.perf_counter() - start_time, status == 200 or status == 304)
+    return status, data, etag
+
+def run_scale(port, session_token, device_id, rate, end_time, recorder):
+    """Posts a reading every 1/rate seconds, on a fixed schedule so that a slow server doesn't slow the offered load."""
+    conn = Connection(port)
+    interval = 1.0 / rate
+    next_time = time.time() + random.uniform(0.0, interval) # Don't have every scale fire at once
+    weight = random.uniform(EMPTY_WEIGHT, FULL_WEIGHT)
+    while True:
+        now = time.time()
+        if now >= end_time:
+            break
+        if next_time > now:
+            time.sleep(min(next_time - now, end_time - now))
+            continue
+        weight = max(EMPTY_WEIGHT, weight - random.uniform(0.0, 5.0))
+        body = { "session_token": session_token, "device_id": device_id, "reading": weight, "reading_time": time.time() }
+        timed_request(conn, recorder, "update_device_status", "POST", "/api/1.0/update_device_status", body)
+        next_time += interval
+    conn.close()
+
+def login(conn, recorder, username):
+    """Logs in the way the app does, returning the session token or None."""
+    status, data, _ = timed_request(conn, recorder, "login", "POST", "/api/1.0/login", { "username": username, "password": PASSWORD })
+    if status != 200:
+        return None
+    return json.loads(data)["session_token"]
+
+def run_client(port, username, device_ids, poll_interval, login_every, resolution, use_etags, end_time, recorder):
+    """Logs in, then polls login_status and device_status for each of the user's devices, logging in again every so often.
+    Like URLSession's cache, device_status responses are revalidated with their ETags."""
+    conn = Connection(port)
+    etags = {}
+    session_token = login(conn, recorder, username)
+    polls = 0
+    time.sleep(random.uniform(0.0, poll_interval))
+    while time.time() < end_time:
+        if session_token is None or (login_every > 0 and polls > 0 and polls % login_every == 0):
+            session_token = login(conn, recorder, username)
+            if session_token is None:
+                time.sleep(poll_interval)
+                continue
+        poll_start = time.time()
+        timed_request(conn, recorder, "login_status", "GET", "/api/1.0/login_status?session_token=" + session_token)
+        for device_id in device_ids:
+            path = "/api/1.0/device_status?session_token=%s&device_id=%s&resolution=%s" % (session_token, device_id, resolution)
+            headers = { "If-None-Match": etags[path] } if use_etags and path in etags else None
+            status, _, etag = timed_request(conn, recorder, "device_status", "GET", path, headers=headers)
+            if status == 200 and etag is not None:
+                etags[path] = etag
+        polls += 1
+        time.sleep(max(0.0, min(poll_interval - (time.time() - poll_start), end_time - time.time())))
+    conn.close()
+
+def wait_until_ready(port, secs):
+    """Polls the readiness endpoint until it succeeds."""
+    end_time = time.time() + secs
+    while time.time() < end_time:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/ready")
+            if conn.getresponse().status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.2)
+    return False
+
+def create_users(port, count):
+    """Creates the app users, returning their usernames and session tokens."""
+    conn = Connection(port)
+    users = []
+    run_id = uuid.uuid4().hex[:8] # So repeated runs against the same mongod don't collide
+    for index in range(count):
+        username = "loadtest%u.%s@example.com" % (index, run_id)
+        body = { "username": username, "realname": "Load Test", "password1": PASSWORD, "password2": PASSWORD }
+        status, data, _ = conn.request("POST", "/api/1.0/create_login", body)
+        if status != 200:
+            raise Exception("Could not create user %s (HTTP %u)." % (username, status))
+        users.append((username, json.loads(data)["session_token"]))
+    conn.close()
+    return users
+
+def register_devices(port, users, devices):
+    """Registers each scale to its user, so the app clients can read it before its first upload."""
+    conn = Connection(port)
+    for (_, session_token), device_ids in zip(users, devices):
+        for device_id in device_ids:
+            status, _, _ = conn.request("POST", "/api/1.0/register_device", { "session_token": session_token, "device_id": device_id })
+            if status != 200:
+                raise Exception("Could not register device %s (HTTP %u)." % (device_id, status))
+    conn.close()
+
+def git_revision():
+    try:
+        return subprocess.check_output([ "git", "rev-parse", "--short", "HEAD" ], cwd=WEB_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def print_summary(summary, baseline):
+    """Prints a table of the results, with the change from the baseline run if there is one."""
+    print("%-28s %9s %7s %10s %9s %9s %9s" % ("endpoint", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"))
+    for endpoint, figures in summary.items():
+        print("%-28s %9u %7u %10.1f %9.2f %9.2f %9.2f" % (endpoint, figures["requests"], figures["errors"], figures["throughput"],
+            figures["p50_ms"], figures["p95_ms"], figures["p99_ms"]))
+        before = baseline.get(endpoint) if baseline else None
+        if before:
+            print("%-28s %9s %7s %+9.0f%% %+8.0f%% %+8.0f%% %+8.0f%%" % ("  vs. baseline", "", "",
+                100.0 * (figures["throughput"] / before["throughput"] - 1.0),
+                100.0 * (figures["p50_ms"] / before["p50_ms"] - 1.0),
+                100.0 * (figures["p95_ms"] / before["p95_ms"] - 1.0),
+                100.0 * (figures["p99_ms"] / before["p99_ms"] - 1.0)))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, action="store", default=5598, help="Port to run the server on.", required=False)
+    parser.add_argument("--database", type=str, action="store", default="sqlite", choices=["sqlite", "mongo"], help="Database backend, mongo needs a local mongod.", required=False)
+    parser.add_argument("--server-args", type=str, action="store", default="", help="Extra arguments for app.py, such as \"--workers 4 --write-behind\".", required=False)
+    parser.add_argument("--scales", type=int, action="store", default=50, help="Number of simulated scales.", required=False)
+    parser.add_argument("--scale-rate", type=float, action="store", default=1.0, help="Readings per second from each scale.", required=False)
+    parser.add_argument("--clients", type=int, action="store", default=10, help="Number of simulated app clients, one user each.", required=False)
+    parser.add_argument("--poll-interval", type=float, action="store", default=2.0, help="Seconds between polls from each app client.", required=False)
+    parser.add_argument("--login-every", type=int, action="store", default=20, help="Polls between logins, zero to log in only once.", required=False)
+    parser.add_argument("--resolution", type=str, action="store", default="auto", help="Resolution requested by device_status polls.", required=False)
+    parser.add_argument("--no-etags", action="store_true", default=False, help="Don't revalidate device_status with If-None-Match.", required=False)
+    parser.add_argument("--secs", type=float, action="store", default=30.0, help="Seconds to run the load.", required=False)
+    parser.add_argument("--output", type=str, action="store", default="load_test.json", help="File to write the results to.", required=False)
+    parser.add_argument("--baseline", type=str, action="store", default=None, help="Results of an earlier run to compare against.", required=False)
+    args = parser.parse_args()
+    if args.clients < 1:
+        parser.error("At least one client is needed to own the scales.")
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)["endpoints"]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        command = [ sys.executable, APP_PY, "--port", str(args.port), "--database", args.database, "--db-file", os.path.join(temp_dir, "load_test.sqlite") ]
+        command += [ "--rate-limit-scale", "0" ] # Every simulated scale and client comes from the same address
+        command += args.server_args.split()
+        server = subprocess.Popen(command, cwd=temp_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            if not wait_until_ready(args.port, 30):
+                print("The server did not start.")
+                sys.exit(1)
+
+            # Each app user owns an equal share of the scales.
+            users = create_users(args.port, args.clients)
+            devices = [ [] for _ in users ]
+            for index in range(args.scales):
+                devices[index % len(users)].append(str(uuid.uuid4()))
+            register_devices(args.port, users, devices)
+
+            end_time = time.time() + args.secs
+            threads = []
+            recorders = []
+            for (username, session_token), device_ids in zip(users, devices):
+                for device_id in device_ids:
+                    recorder = Recorder()
+                    recorders.append(recorder)
+                    threads.append(threading.Thread(target=run_scale, args=(args.port, session_token, device_id, args.scale_rate, end_time, recorder)))
+                recorder = Recorder()
+                recorders.append(recorder)
+                threads.append(threading.Thread(target=run_client, args=(args.port, username, device_ids, args.poll_interval, args.login_every, args.resolution, not args.no_etags, end_time, recorder)))
+
+            start_time = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.time() - start_time
+        finally:
+            server.terminate()
+            server.wait()
+
+    total = Recorder()
+    for recorder in recorders:
+        total.merge(recorder)
+    summary = summarize(total, elapsed)
+    print_summary(summary, baseline)
+
+    results = {
+        "time": time.time(),
+        "revision": git_revision(),
+        "config": vars(args),
+        "elapsed_secs": elapsed,
+        "offered_ingest_rate": args.scales * args.scale_rate,
+        "endpoints": summary,
+    }
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=4)
+    print("Wrote " + args.output)
+
+if __name__=="__main__":
+    main()
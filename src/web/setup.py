@@ -1,6 +1,6 @@
 from setuptools import setup, find_packages
 
-requirements = ['configparser', 'mako', 'bson', 'pymongo', 'bcrypt', 'flask', 'requests', 'unidecode']
+requirements = ['configparser', 'mako', 'bson', 'pymongo', 'bcrypt', 'flask', 'requests', 'unidecode', 'gunicorn']
 
 setup(
     name='is_the_keg_empty',